@@ -0,0 +1,164 @@
+"""
+Compare the encodings (and grounding) on the docker-swarm scheduling model.
+Each configuration is built in its own Workspace, and solved with a timeout.
+
+    python examples/benchmark.py [timeout in seconds]
+"""
+from src.model import *
+from z3 import *
+
+import sys
+import yaml
+import timeit
+
+
+classes_yaml = """
+-
+  name: Element
+  reference: [{name: label, type: Label, multiple: true}]
+-
+  name: Service
+  supertype: Element
+  attribute:
+    - {name: ports, type: Integer, multiple: true}
+  reference:
+    - {name: deploy, type: Node, mandatory: true}
+    - {name: affinityLabel, type: Label}
+    - {name: nodeLabel, type: Label, multiple: true}
+    - {name: nNodeLabel, type: Label, multiple: true}
+    - {name: nodeDirect, type: Node}
+    - {name: link, type: Service, multiple: true}
+-
+  name: Node
+  supertype: Element
+  attribute:
+    - {name: isMaster, type: Boolean}
+    - {name: slots, type: Integer}
+  reference:
+    - {name: host, type: Service, multiple: true, opposite: deploy}
+-
+  name: Label
+-
+  name: UniqueLabel
+  supertype: Label
+-
+  name: FunctionLabel
+  supertype: Label
+-
+  name: StorageLabel
+  supertype: UniqueLabel
+-
+  name: Db
+  supertype: Service
+-
+  name: Wordpress
+  supertype: Service
+  reference: [{name: cache, type: Redis, mandatory: true}]
+-
+  name: Redis
+  supertype: Service
+-
+  name: SmallVm
+  supertype: Node
+-
+  name: LargeVm
+  supertype: Node
+"""
+
+
+def build_swarm(ws):
+    """The model of examples/docker-swarm.py, in ws. Returns the label assignments"""
+    Element, Service, Node, Label, UniqueLabel, \
+    FunctionLabel, StorageLabel, Db, Wordpress, Redis, SmallVm, LargeVm \
+        = ws.load_all_classes(yaml.load(classes_yaml))
+
+    ws.generate_meta_constraints()
+
+    e1 = ws.ObjectVar(Element, 'e1')
+    s1, s2 = ws.ObjectVars(Service, 's1', 's2')
+    n1 = ws.ObjectVar(Node, 'n1')
+    l1, l2 = ws.ObjectVars(FunctionLabel, 'l1', 'l2')
+    i1 = ws.DeclareVar(IntSort(ws.ctx), 'i1')
+    w1 = ws.ObjectVar(Wordpress, 'w1')
+
+    db = ws.DefineObject('db', Db)
+    ws.DefineObjects(['wordpress%d' % n for n in range(0, 3)], Wordpress)
+    ws.DefineObjects(['redis%d' % n for n in range(0, 3)], Redis, suspended=True)
+    lb_wordpressdb, lb_cachedb = ws.DefineObjects(['lb_wordpressdb', 'lb_cachedb'], FunctionLabel)
+    lb_ssd, lb_disk = ws.DefineObjects(['lb_ssd', 'lb_disk'], StorageLabel)
+    ws.DefineObject('vm1', LargeVm, suspended=True)
+    vm3, vm4 = ws.DefineObjects(['vm3', 'vm4'], SmallVm, suspended=True)
+
+    ws.generate_config_constraints()
+
+    ws.meta_facts(
+        Element.forall(e1, e1.label.forall(
+            l1, Implies(l1.isinstance(UniqueLabel), Not(e1.label.exists(
+                l2, And(l1.sametype(l2), l1 != l2))
+            ))
+        )),
+        Service.forall(s1, Or(
+            s1.affinityLabel == Undefined,
+            s1['deploy']['host'].exists(s2, And(s2 != s1, s2['label'].contains(s1['affinityLabel'])))
+        )),
+        Service.forall(s1, s1['link'].forall(s2, s2['deploy'] == s1['deploy'])),
+        Service.forall(s1, s1['nodeLabel'].forall(l1, s1['deploy']['label'].contains(l1))),
+        Service.forall(s1, s1['nNodeLabel'].forall(l1, Not(s1['deploy']['label'].contains(l1)))),
+        Service.forall(s1, Or(s1['nodeDirect'].undefined(), s1['nodeDirect'] == s1['deploy'])),
+        Service.forall(s1, s1['ports'].forall(
+            i1, s1['deploy']['host'].forall(s2, Or(s1 == s2, Not(s2['ports'].contains(i1))))
+        )),
+        Node.exists(n1, n1['isMaster']),
+        Node.forall(n1, Or(n1['slots'] <= 0, n1['host'].count() <= n1['slots'])),
+        Wordpress.forall(w1, w1['link'].contains(w1['cache']))
+    )
+
+    return [
+        db['label'] == [lb_wordpressdb],
+        db['nodeLabel'].contains(lb_ssd),
+        Wordpress['affinityLabel'] == Undefined,
+        Wordpress['label'] == [],
+        Wordpress['ports'] == [8080],
+        SmallVm['slots'] == 4,
+        LargeVm['slots'] == 16,
+        vm3['label'].contains(lb_ssd)
+    ]
+
+
+def run(encoding, grounded, timeout):
+    ws = Workspace(encoding=encoding)
+    start = timeit.default_timer()
+    assigns = build_swarm(ws)
+    if grounded:
+        facts = ws.ground_facts(*(ws.meta_constraints + ws.config_constraints + assigns))
+    else:
+        facts = ws.once_for_all() + ws.encode(*assigns)
+    solver = Solver(ctx=ws.ctx)
+    solver.set('timeout', timeout * 1000)
+    solver.add(*facts)
+    built = timeit.default_timer()
+    result = solver.check()
+    checked = timeit.default_timer()
+    if result == sat:
+        ws.decode_model(solver.model(), features=['deploy']).to_dict()
+    return result, built - start, checked - built
+
+
+def main(timeout):
+    print '%-14s %-8s %-8s %8s %8s' % ('encoding', 'ground', 'result', 'build', 'check')
+    checks = {}
+    for grounded in (False, True):
+        for encoding in Workspace.ENCODINGS:
+            result, build, check = run(encoding, grounded, timeout)
+            checks[encoding, grounded] = check if result != unknown else None
+            print '%-14s %-8s %-8s %8.2f %8.2f' % (encoding, grounded, result, build, check)
+    for grounded in (False, True):
+        base, enum = checks['uninterpreted', grounded], checks['enum', grounded]
+        if base is None or enum is None:
+            print 'speedup of enum (ground=%s): n/a, timeout' % grounded
+        else:
+            print 'speedup of enum (ground=%s): %.2fx' % (grounded, base / enum)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 60)
@@ -0,0 +1,139 @@
+"""
+Compare the two backends of generate_config_constraints on the docker-swarm-paper model,
+with every group of objects scaled up by a factor (10 by default):
+'z3' builds the terms through the Python API, 'smtlib' writes SMT-LIB2 text parsed at once.
+Each backend runs in its own process, to measure its peak memory.
+
+    python examples/benchmark_smtlib.py [scale] [replay.smt2]
+
+With a file name, the config constraints are also written there, with their declarations,
+for an offline replay (e.g. z3 replay.smt2).
+"""
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.model import *
+from z3 import *
+
+import resource
+import subprocess
+import timeit
+import yaml
+
+
+classes_yaml = """
+-
+  name: Element
+  reference: [{name: label, type: Label, multiple: true}]
+-
+  name: Container
+  supertype: Element
+  abstract: True
+  attribute:
+    - {name: ports, type: Integer, multiple: true}
+  reference:
+    - {name: deploy, type: Node, mandatory: true}
+    - {name: affinityLabel, type: Label}
+    - {name: naffinity, type: Label}
+    - {name: nodeLabel, type: Label, multiple: true}
+    - {name: link, type: Container, multiple: true}
+-
+  name: Node
+  supertype: Element
+  abstract: True
+  attribute:
+    - {name: isMaster, type: Boolean}
+    - {name: slots, type: Integer}
+    - {name: price, type: Integer}
+  reference:
+    - {name: host, type: Container, multiple: true, opposite: deploy}
+-
+  name: Label
+-
+  name: UniqueLabel
+  supertype: Label
+-
+  name: TypeLabel
+  supertype: Label
+-
+  name: StorageLabel
+  supertype: UniqueLabel
+-
+  name: Resource
+  supertype: Label
+-
+  name: Throughput
+  supertype: UniqueLabel
+-
+  name: Web
+  supertype: Container
+-
+  name: Admin
+  supertype: Container
+-
+  name: SingleContainer
+  supertype: Container
+-
+  name: Fast
+  supertype: Node
+-
+  name: Solid
+  supertype: Node
+"""
+
+
+def build_swarm_paper(ws, scale):
+    """The objects of examples/docker-swarm-paper.py, each group scaled, with the labels forced"""
+    Element, Container, Node, Label, UniqueLabel, TypeLabel, StorageLabel, Resource, Throughput, \
+        Web, Admin, SingleContainer, Fast, Solid = ws.load_all_classes(yaml.load(classes_yaml))
+    ws.generate_meta_constraints()
+
+    group = lambda name, n, type_, **kwargs: ws.DefineObjects(['%s%d' % (name, i) for i in range(n)], type_, **kwargs)
+    ssds, disks = group('ssd', scale, StorageLabel), group('disk', scale, StorageLabel)
+    highs, rams = group('high', scale, Throughput), group('ram', scale, Resource)
+    lbdbs, lbuis = group('lbdb', scale, TypeLabel), group('lbui', scale, TypeLabel)
+    for i in range(scale):
+        for db in group('db%d_' % i, 2, SingleContainer):
+            db.force_value('label', [lbdbs[i]]).force_value('nodeLabel', [ssds[i]])
+        for web in group('web%d_' % i, 8, Web):
+            web.force_value('label', [lbuis[i], rams[i]]).force_value('nodeLabel', []).force_value('link', [])
+        for admin in group('admin%d_' % i, 1, Admin):
+            admin.force_value('label', [rams[i]]).force_value('nodeLabel', [])
+        group('other%d_' % i, 3, SingleContainer)
+        group('sn%d_' % i, 7, Node, suspended=True)
+        master, = group('master%d_' % i, 1, Fast)
+        master.force_value('label', [highs[i]]).force_value('slots', 3).force_value('isMaster', True)
+        slave, = group('slave%d_' % i, 1, Solid)
+        slave.force_value('label', [disks[i]]).force_value('slots', 50).force_value('isMaster', False)
+
+
+def child(backend, scale, replay=None):
+    ws = Workspace()
+    build_swarm_paper(ws, scale)
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = timeit.default_timer()
+    ws.generate_config_constraints(backend=backend)
+    elapsed = timeit.default_timer() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    if replay:
+        with open(replay, 'w') as stream:
+            stream.write(ws.config_smtlib(declare=True))
+    print '%d %f %d' % (len(ws.objects), elapsed, peak)
+
+
+def main(scale, replay=None):
+    print '%-8s %8s %10s %16s' % ('backend', 'objects', 'build (s)', 'peak memory (kB)')
+    for backend in ('z3', 'smtlib'):
+        args = [sys.executable, os.path.abspath(__file__), '--child', backend, str(scale)]
+        if replay and backend == 'smtlib':
+            args.append(replay)
+        objects, elapsed, peak = subprocess.check_output(args).split()
+        print '%-8s %8s %10.2f %16s' % (backend, objects, float(elapsed), peak)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], int(sys.argv[3]), *sys.argv[4:5])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 10, *sys.argv[2:3])
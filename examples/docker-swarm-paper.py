@@ -95,7 +95,7 @@ imageindex = DefineObject('imageindex', SingleContainer)
 
 webs = [DefineObject('web%d'%i, Web) for i in range(0, NWEB)]
 admins = [DefineObject('admin%d'%i, Admin) for i in range(0, NADM)]
-sns = [DefineObject('sn%d' % i, Node, suspended=True) for i in range(0, NSN)]
+sns = DefineObjects(['sn%d' % i for i in range(0, NSN)], Node, suspended=True, symmetric=True)
 
 master = DefineObject('master', Fast)
 slave = DefineObject('slave', Solid)
@@ -193,7 +193,7 @@ solver.add(*get_all_config_facts())
 
 
 def print_model_deploy(model):
-    result = cast_all_objects(model)
+    result = decode_model(model, features=['deploy'])
     for v in result.values():
         if 'deploy' in v:
             print '%s(%s) -> %s(%s) ' % (v['name'], v['type'], v['deploy'], result[v['deploy']]['type'])
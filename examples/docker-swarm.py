@@ -138,7 +138,7 @@ solver.add(*get_all_config_facts())
 
 
 def print_model_deploy(model):
-    result = cast_all_objects(model)
+    result = decode_model(model, features=['deploy'])
     for v in result.values():
         if 'deploy' in v:
             print '%s(%s) -> %s(%s) ' % (v['name'], v['type'], v['deploy'], result[v['deploy']]['type'])
@@ -1,4 +1,13 @@
 from z3 import *
+from z3.z3 import _to_ast_array, _to_expr_ref
+import itertools
+import re
+import hashlib
+import os
+import json
+import collections
+import contextlib
+import time
 
 
 class ConsolasException(Exception):
@@ -18,23 +27,7 @@ def _consolas_assert(cond, msg):
         raise ConsolasException(msg)
 
 
-# Here begins the definition of predefined Sorts and functions
-
-_Type = DeclareSort('Type')
-_Inst = DeclareSort('Inst')
-
-# The 'Default' type and Instance
-
-NilType = Const('NilType', _Type)
-nil = Const('nil', _Inst)
-
-super_type = Function('super', _Type, _Type)
-actual_type = Function('actual_type', _Inst, _Type)
-
-is_subtype = Function('is_subtype', _Type, _Type, BoolSort())
-is_instance = Function('is_instance', _Inst, _Type, BoolSort())
-alive = Function('alive', _Inst, BoolSort())
-is_abstract = Function('is_abstract', _Type, BoolSort())
+# The predefined Sorts and functions are created per workspace, see Workspace below
 
 
 # Now begins the definition of models
@@ -46,7 +39,8 @@ class ConsolasElement:
 
     def z3(self):
         """Convert a Consolas Element to a Z3 expression"""
-        return self.z3_element
+        workspace = self.__dict__.get('workspace')
+        return self.z3_element if workspace is None else workspace._api(self.z3_element)
 
     def __str__(self):
         return str(self.z3_element)
@@ -69,7 +63,7 @@ Undefined = ConsolasElement()
 class Class(ConsolasElement):
     """Typeical class as defined in MOF"""
 
-    def __init__(self, name, supertype=None, abstract=False):
+    def __init__(self, name, supertype=None, abstract=False, workspace=None):
         """
         DockerImage = Class('DockerImage', None, True)
         UbuntuImage = Class('UbuntuImage', DockerImage)
@@ -77,13 +71,18 @@ class Class(ConsolasElement):
         :param name: Unique class name
         :param supertype: super class
         :param abstract: An abstract class cannot be instantiated
+        :param workspace: The workspace of the class, by default the one of the module-level functions
         """
+        self.workspace = workspace if workspace is not None else _default_workspace
         self.name = name
         self.attributes = {}
         self.references = {}
-        self.z3_element = Const(name, _Type)
+        self.z3_element = Const(name, self.workspace.Type)
         self.supertype = supertype
         self.abstract = abstract
+        self._feature_table = None
+        self._feature_names = None
+        self._feature_version = None
 
     def define_attribute(self, name, type, multiple=False):
         """
@@ -92,44 +91,68 @@ class Class(ConsolasElement):
         >>> DockerImage.define_attribute('mem', IntSort())
 
         :param name: attribute name
-        :param type: primitive z3 types (IntSort(), BoolSort()), and Enum (not supported yet)
+        :param type: primitive z3 types (IntSort(), BoolSort()), and Enum (not supported yet),
+                     created in the context of the workspace
         :param multiple:
         :return:
         """
         self.attributes[name] = Attribute(name, self, type, multiple, mandatory=True)
+        self.workspace._feature_version += 1
 
-    def define_reference(self, name, type, multiple=False, mandatory=False, opposite=None):
-        self.references[name] = Reference(name, self, type, multiple, mandatory)
+    def define_reference(self, name, type, multiple=False, mandatory=False, opposite=None, bitvector=False,
+                         closure=None, root=None):
+        """
+        >>> Vm.define_reference('host', DockerImage, multiple=True, opposite='deploy')
+        >>> Feature.define_reference('allsup', Feature, multiple=True, closure='sup')
+        >>> Feature.define_reference('root', Feature, root='sup')
+
+        :param bitvector: encode a multi-valued reference as a bit-vector over the objects that
+                          can be its items, instead of a relation. Set equality, subset and union
+                          then become bitwise operations. It can be only used after all objects are defined.
+        :param closure: the name of another reference of the class, with the same type. This multi-valued
+                        reference is then its transitive closure, e.g. all the ancestors from a parent reference.
+        :param root: the name of another single-valued reference of the class, with the same type.
+                     This single-valued reference is then the last object reached by following it,
+                     or the object itself when it is undefined.
+        """
+        _consolas_assert(multiple or not bitvector, 'Only multi-valued references can be bit-vectors')
+        _consolas_assert(multiple or not closure, 'The closure of %s must be a multi-valued reference' % closure)
+        _consolas_assert(not (multiple and root), 'The root of %s must be a single-valued reference' % root)
+        self.references[name] = Reference(name, self, type, multiple, mandatory, bitvector)
         self.references[name].opposite = opposite
+        self.references[name].closure = closure
+        self.references[name].root = root
+        self.workspace._feature_version += 1
+
+    def _features(self):
+        """
+        The features of the class and its ancestors, flattened in one table. The table is
+        rebuilt after a feature is defined on any class of the workspace.
+        """
+        version = self.workspace._feature_version
+        if self._feature_version != version:
+            table = dict(self.supertype._features()) if self.supertype else {}
+            table.update(self.references)
+            table.update(self.attributes)
+            self._feature_table = table
+            self._feature_names = list(set(table))
+            self._feature_version = version
+        return self._feature_table
 
     def get_feature(self, feature):
-        if feature in self.attributes:
-            return self.attributes[feature]
-        elif feature in self.references:
-            return self.references[feature]
-        else:
-            if self.supertype:
-                return self.supertype.get_feature(feature)
-            else:
-                return None
+        return self._features().get(feature)
 
     def all_instances(self):
-        var = ObjectVar(self)
-        return SetExpr(PartialExpr(var, And(alive(var.z3()), is_instance(var.z3(), self.z3()))), self)
+        ws = self.workspace
+        var = ws.set_var(self)
+        return SetExpr(PartialExpr(var, And(ws.alive(var.z3()), ws.is_instance(var.z3(), self.z3()))), self, workspace=ws)
 
     def compose_new_class(self, type):
         return CompositeClass(self, type)
 
     def get_all_feature_names(self):
-        result = set()
-        t = self
-        while t:
-            for i in t.attributes:
-                result.add(i)
-            for i in t.references:
-                result.add(i)
-            t = t.supertype
-        return list(result);
+        self._features()
+        return list(self._feature_names)
 
     def __str__(self):
         return self.name
@@ -167,14 +190,15 @@ class Class(ConsolasElement):
 
     def forcevalue(self, feature, value):
         _consolas_assert(isinstance(feature, str), 'We require a feature name in string')
-        var = ObjectVar(self)
-        return self.forall(var, var[feature] == value)
+        with self.workspace.var_scope():
+            var = self.workspace.ObjectVar(self)
+            return self.forall(var, var[feature] == value)
 
     def __mul__(self, other):
         return self.join(other)
 
     def __getitem__(self, item):
-        _consolas_assert(item in self.get_all_feature_names(), '%s is not a defined feature' % item)
+        _consolas_assert(item in self._features(), '%s is not a defined feature' % item)
         return ForceValueSeed(self, item)
 
     def __getattr__(self, item):
@@ -209,6 +233,8 @@ class CompositeClass(Class):
 
 class Feature(ConsolasElement):
 
+    bitvector = False
+
     def __init__(self, name, parent, type, multiple=False, mandatory=False):
         self.name = name
         self.parent = parent
@@ -222,6 +248,9 @@ class Feature(ConsolasElement):
     def _create_z3_element(self):
         pass
 
+    def z3(self):
+        return self.parent.workspace._api(self.z3_element)
+
     def is_reference(self):
         return isinstance(self, Reference)
 
@@ -231,32 +260,66 @@ class Feature(ConsolasElement):
 
 class Attribute(Feature):
     def _create_z3_element(self):
+        ws = self.parent.workspace
         if self.multiple:
             # Do not support it in the first stage
-            self.z3_element = Function(self.name, _Inst, self.type, BoolSort())
+            self.z3_element = Function(self.name, ws.Inst, self.type, BoolSort(ws.ctx))
         else:
-            self.z3_element = Function(self.name, _Inst, self.type)
+            self.z3_element = Function(self.name, ws.Inst, self.type)
 
 
 class Reference(Feature):
+    def __init__(self, name, parent, type, multiple=False, mandatory=False, bitvector=False):
+        self.bitvector = bitvector
+        self.closure = None
+        self.root = None
+        self._rank = None
+        Feature.__init__(self, name, parent, type, multiple, mandatory)
+
     def _create_z3_element(self):
+        if self.bitvector:
+            return  # the width is known once the objects are defined, see z3()
         self.z3_element = self._create_multiple_function() if self.multiple else self._create_single_function()
 
+    def z3(self):
+        if self.z3_element is None and self.bitvector:
+            self.z3_element = self._create_bitvector_function()
+        return self.parent.workspace._api(self.z3_element)
+
     def _create_single_function(self):
-        function = Function(self.name, _Inst, _Inst)
+        ws = self.parent.workspace
+        function = Function(self.name, ws.Inst, ws.Inst)
         return function
 
     def _create_multiple_function(self):
-        function = Function(self.name, _Inst, _Inst, BoolSort())
+        ws = self.parent.workspace
+        function = Function(self.name, ws.Inst, ws.Inst, BoolSort(ws.ctx))
+        return function
+
+    def _create_bitvector_function(self):
+        ws = self.parent.workspace
+        width = max(len(ws.set_members(self.type)), 1)
+        function = Function(self.name, ws.Inst, BitVecSort(width, ws.ctx))
         return function
 
+    def rank(self):
+        """
+        For a closure decided by the solver, the number of steps from an object to an item of its
+        closure, which must decrease along the base reference so that no item is made up
+        """
+        if self._rank is None:
+            ws = self.parent.workspace
+            self._rank = Function('%s_rank' % self.name, ws.Inst, ws.Inst, IntSort(ws.ctx))
+        return self._rank
+
 
 class Object(ConsolasElement):
 
     def __init__(self, name, type, suspended=False):
         self.name = name
         self.type = type
-        self.z3_element = Const(name, _Inst)
+        self.workspace = type.workspace
+        self.z3_element = Const(name, self.workspace.Inst)
         self.suspended = suspended
         self.solved_model = None
         self.forced_values = {}
@@ -266,7 +329,7 @@ class Object(ConsolasElement):
         if isinstance(feature, str):
             feature = self.type.get_feature(feature)
         if isinstance(feature, Reference) and isinstance(value, str):
-            value = _all_objects[value]
+            value = self.workspace.objects[value]
         self.forced_values[feature.name] = value
         return self
 
@@ -283,28 +346,16 @@ class Object(ConsolasElement):
         return self.const
 
     def cast(self, feature, model):
-        feature = self.type.get_feature(feature)
-        const = self.get_constant()
-        if not feature:
-            return None
-        if feature.is_attribute() and not feature.multiple:  #TODO integer set
-            result = model.eval(const[feature])
-            if is_bool(result):
-                return is_true(result)
-            if is_int_value(result):
-                return int(str(result))
-            return str(result) # suppose it is an enum item
-        elif feature.is_reference() and not feature.multiple:
-            for obj in _all_objects.values():
-                if str(model.eval(const[feature]==obj.get_constant())) == 'True':
-                    return str(obj)
-        elif feature.is_reference() and feature.multiple:
-            result = []
-            for obj in _all_objects.values():
-                if str(model.eval(const[feature].contains(obj.get_constant()))) == 'True':
-                    result.append(str(obj))
-            return result
-        return None
+        """
+        Read the value of a feature from a model
+
+        :param feature: feature name
+        :param model: a Z3 model, or a ModelDecoder to share between several calls
+        :return: a python value, an object name, or a list of object names
+        """
+        if not isinstance(model, ModelDecoder):
+            model = ModelDecoder(model, self.workspace)
+        return model.cast(self, feature)
 
     def isinstance_by_decl(self, type_):
         current = self.type
@@ -359,23 +410,37 @@ class ObjectExpr(ConsolasExpr):
     def __init__(self, z3expr, type):
         self.z3_element = z3expr
         self.type = type
+        self.workspace = type.workspace
 
     def __getitem__(self, item):
         if isinstance(item, Feature):
             item = item.name
         _consolas_assert(isinstance(item, str), 'item should be a string')
         _consolas_assert(isinstance(self.type, Class), 'no reference on primitive types')
+        _domain = self.type
+        # the same navigation gives the same expression, and the same bound variable for a set
+        key = (self.z3().get_id(), _domain.name, item, self.workspace._feature_version)
+        navigations = self.workspace._navigations
+        result = navigations.get(key)
+        if result is None:
+            result = self._navigate(item)
+            navigations.put(key, result)
+        return result
+
+    def _navigate(self, item):
         _domain = self.type
         feature = _domain.get_feature(item)
         _consolas_assert(feature, '"\%s" is not defined in class "%s"' % (item, _domain))
         z3fun = feature.z3()
         _range = feature.type
 
-        if feature.multiple:
+        if feature.bitvector:
+            return SetExpr.of_bits(z3fun(self.z3()), _range)
+        elif feature.multiple:
             # _consolas_assert(isinstance(_range, Class), "No support of multiple attributes")
-            var = DeclareVar(_range)
+            var = self.workspace.set_var(_range)
             guard = PartialExpr(var, z3fun(self.z3(), var.z3()))
-            return SetExpr(guard, _range)
+            return SetExpr(guard, _range, workspace=self.workspace)
         elif isinstance(feature, Reference):
             return ObjectExpr(z3fun(self.z3()), _range)
         elif isinstance(feature, Attribute):
@@ -386,18 +451,18 @@ class ObjectExpr(ConsolasExpr):
             return self.__getitem__(item)
 
     def undefined(self):
-        return self.z3() == nil
+        return self.z3() == self.workspace.nil
 
     def alive(self):
-        return alive(self.z3())
+        return self.workspace.alive(self.z3())
 
     def isinstance(self, clazz):
         _consolas_assert(isinstance(clazz, Class), 'We only check the type of object classes')
-        return is_instance(self.z3(), clazz.z3())
+        return self.workspace.is_instance(self.z3(), clazz.z3())
 
     def sametype(self, other):
         _consolas_assert(isinstance(other, ObjectExpr) or isinstance(other, Object), 'An Object or ObjectExpr is expected')
-        return is_instance(other.z3(), actual_type(self.z3()))
+        return self.workspace.is_instance(other.z3(), self.workspace.actual_type(self.z3()))
 
     def __eq__(self, other):
         if other is Undefined:
@@ -411,7 +476,10 @@ class ObjectExpr(ConsolasExpr):
 class ObjectConst(ObjectExpr):
 
     def __init__(self, type, name):
-        self.z3_element = Const(name, _Inst)
+        self.workspace = type.workspace
+        object_ = self.workspace.objects.get(name)
+        # the constant of an object is over the uninterpreted sort, even once the enum encoding is used
+        self.z3_element = object_.z3_element if object_ is not None else Const(name, self.workspace.Inst)
         self.type = type
 
 
@@ -433,15 +501,75 @@ def ObjectConsts(type_, *names):
     return [ObjectConst(type_, name) for name in names]
 
 
+def _substitute_each(expr, var, values):
+    """[substitute(expr, (var, v)) for v in values], in one pass sharing the Z3 argument arrays"""
+    ctx = expr.ctx
+    src = (Ast * 1)(var.as_ast())
+    dst = (Ast * 1)()
+    result = []
+    for v in values:
+        dst[0] = v.as_ast()
+        result.append(_to_expr_ref(Z3_substitute(ctx.ref(), expr.as_ast(), 1, src, dst), ctx))
+    return result
+
+
+def _sum_of(terms, ctx):
+    """Sum(terms) of integer terms, without coercing them one by one"""
+    if not terms:
+        return IntVal(0, ctx)
+    if len(terms) == 1:
+        return terms[0]
+    args, size = _to_ast_array(terms)
+    return _to_expr_ref(Z3_mk_add(ctx.ref(), size, args), ctx)
+
+
+class _Lru:
+    """A dictionary of up to capacity entries, the least recently used ones evicted first"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """The value of a key, or None, made the most recently used"""
+        if key not in self._entries:
+            return None
+        value = self._entries.pop(key)
+        self._entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Bounds of the memos of navigations (per workspace) and of completions (per partial expression)
+_NAVIGATION_MEMO_SIZE = 4096
+_COMPLETION_MEMO_SIZE = 256
+
+
 class PartialExpr(ConsolasExpr):
 
     def __init__(self, var, z3expr):
         self.vars = []
         self.z3_element = z3expr
+        self._completed = _Lru(_COMPLETION_MEMO_SIZE)
         if isinstance(var, list):
             self.vars = [(i, None) for i in var]
         else:
             self.vars=[(var, None)]
+        self.workspace = getattr(self.vars[0][0], 'workspace', None) if self.vars else None
 
     def bind(self, index, z3expr):
         self.vars[index] = (self.vars[index][0], z3expr)
@@ -460,7 +588,7 @@ class PartialExpr(ConsolasExpr):
         return self.vars[0][0]
 
     def complete(self):
-        result = self.z3_element
+        result = self.z3()
         for i in range(0,len(self.vars)):
             k,v = self.vars[i]
             _consolas_assert(v is not None, 'Free variable "%s" is not bound' % k)
@@ -470,8 +598,14 @@ class PartialExpr(ConsolasExpr):
         #print (i, self.vars[i])
         #print result
 
-        result = substitute(result, *[(k.z3(), v) for k, v in self.vars])
-        return result
+        # The result refers to the bound values, so their ids are not reused while it is cached.
+        # A value that does not occur in the result does not change it either.
+        key = tuple(v.get_id() if isinstance(v, AstRef) else v for k, v in self.vars)
+        completed = self._completed.get(key)
+        if completed is None:
+            completed = substitute(result, *[(k.z3(), v) for k, v in self.vars])
+            self._completed.put(key, completed)
+        return completed
 
     def __str__(self):
         return '(%s | %s)' % ([k for k, v in self.vars], self.z3_element)
@@ -485,11 +619,109 @@ class PartialExpr(ConsolasExpr):
 #         self.z3_element = Const(name, _Inst)
 
 
+class CountExpr(ArithRef):
+    """
+    The number of items in a set, as the integer expression Sum(If(item_k, 1, 0)).
+    Compared with a constant, it becomes a cardinality constraint (AtMost, AtLeast, PbEq)
+    instead of linear arithmetic.
+    """
+
+    def __init__(self, literals, ctx):
+        self.literals = literals
+        one, zero = IntVal(1, ctx), IntVal(0, ctx)
+        sum_ = _sum_of([_to_expr_ref(Z3_mk_ite(ctx.ref(), l.as_ast(), one.as_ast(), zero.as_ast()), ctx)
+                        for l in literals], ctx)
+        ArithRef.__init__(self, sum_.as_ast(), ctx)
+
+    def _bound(self, other):
+        """The constant value of other, or None"""
+        if not self.literals:
+            return None
+        if isinstance(other, (int, long)):
+            return other
+        if is_int_value(other):
+            return other.as_long()
+        return None
+
+    def _at_most(self, k):
+        if k < 0:
+            return BoolVal(False, self.ctx)
+        return AtMost(*(self.literals + [k]))
+
+    def _at_least(self, k):
+        if k <= 0:
+            return BoolVal(True, self.ctx)
+        return AtLeast(*(self.literals + [k]))
+
+    def __le__(self, other):
+        k = self._bound(other)
+        return ArithRef.__le__(self, other) if k is None else self._at_most(k)
+
+    def __lt__(self, other):
+        k = self._bound(other)
+        return ArithRef.__lt__(self, other) if k is None else self._at_most(k - 1)
+
+    def __ge__(self, other):
+        k = self._bound(other)
+        return ArithRef.__ge__(self, other) if k is None else self._at_least(k)
+
+    def __gt__(self, other):
+        k = self._bound(other)
+        return ArithRef.__gt__(self, other) if k is None else self._at_least(k + 1)
+
+    def __eq__(self, other):
+        k = self._bound(other)
+        return ArithRef.__eq__(self, other) if k is None else PbEq([(l, 1) for l in self.literals], k)
+
+    def __ne__(self, other):
+        k = self._bound(other)
+        return ArithRef.__ne__(self, other) if k is None else Not(PbEq([(l, 1) for l in self.literals], k))
+
+
 class SetExpr(ConsolasExpr):
-    def __init__(self, guard, type, seed=None):
+    def __init__(self, guard, type, seed=None, workspace=None, bits=None):
+        """
+        :param bits: the bit-vector of the set, if it comes from a bit-vector reference.
+                     Bit k is set if the k-th object of workspace.set_members(type) is in the set
+        """
         self.guard = guard
         self.type = type
         self.seed = seed
+        self.workspace = workspace if workspace is not None else _default_workspace
+        self._bits = bits
+
+    @property
+    def bits(self):
+        return self.workspace._api(self._bits)
+
+    @staticmethod
+    def of_bits(bits, type_):
+        """The set of type_ objects whose bits are set in a bit-vector expression"""
+        ws = type_.workspace
+        var = ws.set_var(type_)
+        members = ws.set_members(type_)
+        guard = PartialExpr(var, Or([And(var.z3() == m.z3(), SetExpr._bit(bits, k)) for k, m in enumerate(members)]
+                                    + [BoolVal(False, ws.ctx)]))
+        return SetExpr(guard, type_, workspace=ws, bits=bits)
+
+    @staticmethod
+    def _bit(bits, k):
+        return Extract(k, k, bits) == BitVecVal(1, 1, bits.ctx)
+
+    def _mask(self, items):
+        """The bit-vector value of a list of objects, or None if one of them is not a member"""
+        index = dict((m.name, k) for k, m in enumerate(self.workspace.set_members(self.type)))
+        mask = 0
+        for item in items:
+            name = item.name if isinstance(item, Object) else str(item)
+            if not isinstance(item, (Object, ObjectExpr)) or name not in index:
+                return None
+            mask |= 1 << index[name]
+        return BitVecVal(mask, self.bits.size(), self.workspace.ctx)
+
+    def _same_bits(self, other):
+        return self.bits is not None and isinstance(other, SetExpr) and other.bits is not None \
+            and self.type == other.type
 
     def contains(self, item):
         _consolas_assert(not isinstance(self.guard, list), 'contains only on simple sets. Try check items one by one')
@@ -505,11 +737,14 @@ class SetExpr(ConsolasExpr):
 
         # _consolas_assert(not isinstance(self.guard, list), 'check single item in multi-dimension set')
         if self.seed:
-            v = ObjectVar(self.type)
-            return self.exists(v, v == item)
+            with self.workspace.var_scope():
+                v = self.workspace.ObjectVar(self.type)
+                return self.exists(v, v == item)
+        elif self.bits is not None and self._mask([item]) is not None:
+            return self._mask([item]) & self.bits != 0
         else:
             if isinstance(item, int):
-                item = IntSort().cast(item)
+                item = IntSort(self.workspace.ctx).cast(item)
             return self.guard.bindOne(item).complete()
 
     def forall(self, var, expr):
@@ -521,9 +756,19 @@ class SetExpr(ConsolasExpr):
         return Exists(mainvar, And(guard, body))
 
     def existsOne(self, var, expr):
-        v = ObjectVar(self.type)
-        expr2 = PartialExpr(var, expr).bindOne(v).complete()
-        return And(self.exists(var, expr), self.forall(v, Or(v==var, Not(expr2))))
+        if not self.seed and not isinstance(self.guard, list) and self.workspace.config_generated():
+            # exactly one of the objects that may be in the set
+            guard = self.guard.bindOne(var).complete()
+            if isinstance(expr, ConsolasExpr):
+                expr = expr.z3()
+            item = And(guard, expr)
+            candidates = self.workspace.may_be_instances(self.type)
+            return PbEq([(l, 1) for l in _substitute_each(item, var.z3(), [x.z3() for x in candidates])], 1) \
+                if candidates else BoolVal(False, self.workspace.ctx)
+        with self.workspace.var_scope():
+            v = self.workspace.ObjectVar(self.type)
+            expr2 = PartialExpr(var, expr).bindOne(v).complete()
+            return And(self.exists(var, expr), self.forall(v, Or(v==var, Not(expr2))))
 
     def otherwise(self, var, expr):
         mainvar, guard, body = self._prepare_quantifier(var, expr)
@@ -562,7 +807,7 @@ class SetExpr(ConsolasExpr):
         else:
             type_ = None
         seed = PartialExpr(var, expr)
-        return SetExpr(self.guard, type_, seed)
+        return SetExpr(self.guard, type_, seed, self.workspace)
 
     def filter(self, var, cond):
         _consolas_assert(
@@ -571,8 +816,8 @@ class SetExpr(ConsolasExpr):
         )
         _consolas_assert(is_bool(cond), 'filter condition should be a valid, boolean z3 expression')
         cond1 = PartialExpr(var, cond).bindOne(self.guard.get_one_var()).complete()
-        newguard = PartialExpr(self.guard.get_one_var(), And(self.guard.z3_element, cond1))
-        return SetExpr(newguard, self.type, self.seed)
+        newguard = PartialExpr(self.guard.get_one_var(), And(self.guard.z3(), cond1))
+        return SetExpr(newguard, self.type, self.seed, self.workspace)
 
     def join(self, other):
         _consolas_assert(not isinstance(other.guard, list), 'Only join a single set')
@@ -588,39 +833,67 @@ class SetExpr(ConsolasExpr):
             new_seed = [self.seed]
         new_seed.append(other.seed)
 
-        return SetExpr(new_guard, new_type, new_seed)
+        return SetExpr(new_guard, new_type, new_seed, self.workspace)
 
     def sum(self):
         _consolas_assert(not isinstance(self.guard, list), 'Sum only works on a simple set')
         _consolas_assert(
-            _config_constraints,
+            self.workspace.config_generated(),
             'Sum can be only used after all objects are defined and the object constraints are generated'
         )
         var = self.guard.get_one_var()
         value = self.seed.bindOne(var).complete()
-        item = If(self.guard.z3_element, value, 0)
-        return Sum([substitute(item, (var.z3(), x.z3()))
-                    for x in _all_objects.values()
-                    if x.isinstance_by_decl(var.type)])
+        item = If(self.guard.z3(), value, 0)
+        objects = self.workspace.instances_by_decl(var.type)
+        return _sum_of(_substitute_each(item, var.z3(), [x.z3() for x in objects]), self.workspace.ctx)
 
     def count(self):
         _consolas_assert(not isinstance(self.guard, list), 'Count only works on a simple set')
         _consolas_assert(
-            _config_constraints,
+            self.workspace.config_generated(),
             'Count can be only used after all objects are defined and the object constraints are generated'
         )
+        if self.bits is not None:
+            return CountExpr([SetExpr._bit(self.bits, k) for k in range(len(self.workspace.set_members(self.type)))],
+                             self.workspace.ctx)
         var = self.guard.get_one_var()
-        item = If(self.guard.z3_element, 1, 0)
-        return Sum([substitute(item, (var.z3(), x.z3()))
-                    for x in _all_objects.values()
-                    if x.isinstance_by_decl(var.type)])
+        objects = self.workspace.instances_by_decl(var.type)
+        return CountExpr(_substitute_each(self.guard.z3(), var.z3(), [x.z3() for x in objects]),
+                         self.workspace.ctx)
 
     def __eq__(self, other):
         _consolas_assert(not isinstance(self.guard, list), '== only works on a simple set')
         _consolas_assert(isinstance(other, list), '== only compares with a set literal (list) currently')
 
-        var = DeclareVar(self.type)
-        return And(And([self.contains(x) for x in other]), self.forall(var, Or([var == y for y in other])))
+        if self.bits is not None and self._mask(other) is not None:
+            return self.bits == self._mask(other)
+        ctx = self.workspace.ctx
+        with self.workspace.var_scope():
+            var = self.workspace.DeclareVar(self.type)
+            return And(And([self.contains(x) for x in other], ctx), self.forall(var, Or([var == y for y in other], ctx)))
+
+    def issubset(self, other):
+        """All the items of this set are in the other set"""
+        if self._same_bits(other):
+            return self.bits & ~other.bits == 0
+        with self.workspace.var_scope():
+            var = self.workspace.ObjectVar(self.type)
+            return self.forall(var, other.contains(var))
+
+    def issuperset(self, other):
+        return other.issubset(self)
+
+    def isunion(self, set1, set2):
+        """This set is the union of set1 and set2"""
+        if self._same_bits(set1) and self._same_bits(set2):
+            return self.bits == set1.bits | set2.bits
+        with self.workspace.var_scope():
+            var = self.workspace.ObjectVar(self.type)
+            return And(
+                self.forall(var, Or(set1.contains(var), set2.contains(var))),
+                set1.issubset(self),
+                set2.issubset(self)
+            )
 
     def __mul__(self, other):
         return self.join(other)
@@ -631,81 +904,1048 @@ class SetExpr(ConsolasExpr):
     # def __contains__(self, item):
     #     return self.contains(item)
 
-_all_enums = {}
-_all_classes = {}
-_all_objects = {}
-_all_vars = {}
-_meta_constraints = []
-_config_constraints = []
+class Workspace:
+    """
+    An isolated set of classes, objects, variables and facts, with its own predefined
+    Sorts and functions, created in its own Z3 context. Two workspaces can be built and
+    solved independently, for instance one per thread:
+
+    >>> ws = Workspace()
+    >>> Vm = ws.DefineClass('Vm')
+    >>> vm1 = ws.DefineObject('vm1', Vm)
+    >>> ws.generate_meta_constraints()
+    >>> ws.generate_config_constraints()
+    >>> solver = Solver(ctx=ws.ctx)
+    >>> solver.add(*ws.once_for_all())
+
+    The module-level functions (DefineClass, DefineObject, ...) work on a default
+    workspace in the main Z3 context, see get_default_workspace().
+
+    With encoding='enum', the classes and objects become the values of two Z3
+    enumeration sorts once generate_config_constraints() is called, so the solver
+    knows that the domains are finite without the closure axioms. From then on, the
+    constraints are built over the enumeration sorts, and the facts generated before
+    are translated when they are read (get_all_meta_facts(), once_for_all(), ...).
+    A constraint built before, or a raw Z3 term over the Type and Inst sorts, goes
+    through encode():
+
+    >>> ws = Workspace(encoding='enum')
+    >>> ...
+    >>> ws.generate_config_constraints()
+    >>> solver.add(*ws.once_for_all())
+    >>> solver.add(vm1.alive())
+    """
+
+    # the predefined Sorts and functions, given over the enumeration sorts by the enum encoding
+    PREDEFINED = ('Type', 'Inst', 'NilType', 'nil', 'super_type', 'actual_type', 'is_subtype', 'is_instance',
+                  'alive', 'is_abstract')
+
+    ENCODINGS = ('uninterpreted', 'enum')
+
+    def __init__(self, ctx=None, encoding='uninterpreted'):
+        """
+        :param ctx: the Z3 context of the workspace, a fresh one by default
+        :param encoding: 'uninterpreted' (the default) or 'enum', the encoding of the Type and Inst sorts
+        """
+        _consolas_assert(encoding in Workspace.ENCODINGS, 'Unknown encoding %s' % encoding)
+        self.encoding = encoding
+        self._enum_encoding = None
+        self._api_encoding = None
+        self.ctx = ctx if ctx is not None else Context()
+
+        self.Type = DeclareSort('Type', self.ctx)
+        self.Inst = DeclareSort('Inst', self.ctx)
+
+        # The 'Default' type and Instance
+
+        self.NilType = Const('NilType', self.Type)
+        self.nil = Const('nil', self.Inst)
+
+        self.super_type = Function('super', self.Type, self.Type)
+        self.actual_type = Function('actual_type', self.Inst, self.Type)
+
+        self.is_subtype = Function('is_subtype', self.Type, self.Type, BoolSort(self.ctx))
+        self.is_instance = Function('is_instance', self.Inst, self.Type, BoolSort(self.ctx))
+        self.alive = Function('alive', self.Inst, BoolSort(self.ctx))
+        self.is_abstract = Function('is_abstract', self.Type, BoolSort(self.ctx))
+
+        self.enums = {}
+        self.symbols = self._primitive_symbols()
+        self.classes = {}
+        self.objects = {}
+        self.vars = {}
+        self._temporaries = {}
+        self._levels = {}
+        self.meta_constraints = []
+        self.config_constraints = []
+        self.sink = None
+        self._keep = True
+        self._pending = []
+        self._config_generated = False
+        self._set_layouts = {}
+        self._pools = []
+        self._scope_literal = None
+        self._type_index = {}
+        self._feature_version = 0
+        self._navigations = _Lru(_NAVIGATION_MEMO_SIZE)
+
+    def get_all_objects(self):
+        return self.objects.values()
+
+    def get_object_by_name(self, name):
+        return self.objects[name]
+
+    def DefineClass(self, name, supertype=None, abstract=False):
+        _consolas_assert(not (name in self.symbols), 'Class name "%s" is already used' % name)
+
+        class_ = Class(name, supertype, abstract, workspace=self)
+        self.classes[name] = class_
+        self.symbols[name] = class_
+        return class_
+
+    def _primitive_symbols(self):
+        return {'Integer': IntSort(self.ctx), 'Boolean': BoolSort(self.ctx)}
+
+    def load_enums(self, desc):
+        for k, v in desc.items():
+            _consolas_assert(k not in self.symbols, 'Enum name "%s" is already used' % k)
+            enum, values = EnumSort(k, v, self.ctx)
+            self.enums[enum] = values
+            self.symbols[k] = enum
+
+    def load_class_head(self, desc):
+        desc = desc.copy()
+        desc.pop('reference', None)
+        desc.pop('attribute', None)
+        if 'supertype' in desc:
+            supertype = desc['supertype']
+            _consolas_assert(supertype in self.classes, 'supertype %s not defined' % supertype)
+            desc['supertype'] = self.classes[supertype]
+        return self.DefineClass(**desc)
+
+    def _resolve_type(self, type_):
+        _consolas_assert(type_ in self.symbols, 'type %s not defined' % type_)
+        return self.symbols[type_]
+
+    def load_class_body(self, desc):
+        name = desc['name']
+        _consolas_assert(name in self.classes, 'class %s not defined' % name)
+        class_ = self.classes[name]
+        for ref in desc.get('reference', []):
+            ref['type'] = self._resolve_type(ref['type'])
+            class_.define_reference(**ref)
+        for attr in desc.get('attribute', []):
+            attr['type'] = self._resolve_type(attr['type'])
+            class_.define_attribute(**attr)
+        return class_
+
+    def _check_descs(self, enums, descs):
+        """Validates the names, supertypes and feature types of a metamodel before loading it"""
+        names = set(self.symbols)
+        for name in enums:
+            _consolas_assert(name not in names, 'Enum name "%s" is already used' % name)
+            names.add(name)
+        classes = set(self.classes)
+        for desc in descs:
+            name = desc['name']
+            _consolas_assert(name not in names, 'Class name "%s" is already used' % name)
+            supertype = desc.get('supertype')
+            _consolas_assert(supertype is None or supertype in classes, 'supertype %s not defined' % supertype)
+            names.add(name)
+            classes.add(name)
+        for desc in descs:
+            for feature in desc.get('reference', []) + desc.get('attribute', []):
+                _consolas_assert(feature['type'] in names, 'type %s not defined' % feature['type'])
+
+    def load_all_classes(self, descs):
+        """
+        Loads a metamodel: an optional dictionary of enums, followed by class descriptions.
+        The whole metamodel is checked first, so an invalid one leaves the workspace unchanged.
+        """
+        enums = descs[0] if 'name' not in descs[0] else {}
+        self._check_descs(enums, descs[1:] if enums else descs)
+        if 'name' not in descs[0]:  #Then it is the enum definitions
+            self.load_enums(descs[0])
+            descs.pop(0)
+        classes = [self.load_class_head(x) for x in descs]
+        for x in descs:
+            self.load_class_body(x)
+        return [e for e in self.enums] + classes
+
+    def DefineObject(self, name, type, suspended=False):
+        _consolas_assert(type.workspace is self, 'Class %s is defined in another workspace' % type.name)
+        _consolas_assert(not (name in self.objects), 'Object name "%s" is already used' % name)
+        _consolas_assert(not self._set_layouts, 'Objects must be defined before bit-vector references are used')
+
+        object_ = Object(name, type, suspended)
+        self.objects[name] = object_
+        self._type_index.clear()
+        return object_
+
+    def DefineObjects(self, names, type, suspended=False, symmetric=False):
+        """
+        :param symmetric: the objects are interchangeable: no value is forced on them or to them, and
+                          no constraint names one of them. Every permutation of a solution is then
+                          a solution, and generate_config_constraints only keeps the ones in order,
+                          see _symmetry_facts.
+        """
+        objects = [self.DefineObject(name, type, suspended) for name in names]
+        if symmetric and len(objects) > 1:
+            self._pools.append(objects)
+        return objects
+
+    def get_enum(self, enum):
+        found = self.symbols.get(str(enum))
+        _consolas_assert(found is not None and found in self.enums, "Enum %s is not defined" % enum)
+        return found, self.enums[found]
+
+    def ObjectVar(self, type_, id=None):
+        _consolas_assert(isinstance(type_, Class), "use ObjectVar only on Consolas classes")
+        return self.DeclareVar(type_, id)
+
+    def DeclareVar(self, _type, id=None):
+        """
+        A variable named id, kept in vars. Without id, a temporary variable that is not kept:
+        it is taken from a pool per type, and given back at the end of the enclosing var_scope()
+        """
+        if not id:
+            return self._temporary(_type)
+        _consolas_assert(not (id in self.vars), 'id "%s" is already used' % id)
+        const = self._const(_type, id)
+        self.vars[id] = const
+        return const
+
+    def _const(self, _type, id):
+        if isinstance(_type, Class):
+            return ObjectConst(_type, id)
+        return DataConst(_type, id)
+
+    def _temporary(self, _type, level=None):
+        """The temporary variable of _type at a level, or at the next free level"""
+        key = str(_type)
+        pool = self._temporaries.setdefault(key, [])
+        if level is None:
+            level = self._levels.get(key, 1)
+            self._levels[key] = level + 1
+        while len(pool) <= level:
+            pool.append(self._const(_type, 'var%s_%d' % (key, len(pool))))
+        return pool[level]
+
+    def set_var(self, _type):
+        """
+        The free variable of the sets of _type (level 0). It is always substituted when a set is
+        used, so all the sets share it, and it is never a quantified variable.
+        """
+        return self._temporary(_type, 0)
+
+    @contextlib.contextmanager
+    def var_scope(self):
+        """
+        Gives back the temporary variables declared in the block when it ends, so that the next
+        ones reuse them. The constraints built in the block must not be left with a free
+        temporary variable, i.e. they are quantified or the block does not return them.
+
+        >>> with ws.var_scope():
+        ...     x = ws.ObjectVar(Vm)
+        ...     solver.add(Vm.forall(x, x['vmem'] > 0))
+        """
+        levels = dict(self._levels)
+        try:
+            yield
+        finally:
+            self._levels = levels
+
+    def ObjectVars(self, type_, *ids):
+        return [self.ObjectVar(type_, id) for id in ids]
+
+    def get_declared_var(self, id):
+        return self.vars[id]
+
+    def start_over(self):
+        """
+        Clear all the registries, in place, so that classes can be defined again.
+        The predefined Sorts and functions are kept.
+        """
+        self.vars.clear()
+        self._temporaries.clear()
+        self._levels.clear()
+        self.classes.clear()
+        self.objects.clear()
+        self.enums.clear()
+        self.symbols.clear()
+        self.symbols.update(self._primitive_symbols())
+        del self.meta_constraints[:]
+        del self.config_constraints[:]
+        self.sink = None
+        self._keep = True
+        del self._pending[:]
+        self._config_generated = False
+        self._use_encoding(None)
+        self._enum_encoding = None
+        self._set_layouts.clear()
+        del self._pools[:]
+        self._scope_literal = None
+        self._type_index.clear()
+        self._navigations.clear()
+
+    def stream_to(self, sink, keep=False):
+        """
+        Sends the constraints to sink as soon as they are generated, e.g. by meta_facts or
+        generate_config_constraints, so that they are not all held in Python lists first.
+
+        >>> ws.stream_to(solver) # or an Optimize, or an SmtLibWriter
+        >>> ws.generate_meta_constraints()
+
+        :param sink: anything with add(*constraints), or None to stop streaming
+        :param keep: also keep the constraints in meta_constraints and config_constraints,
+                     which grounding and the ConstraintCache need
+        """
+        self.sink = sink
+        self._keep = keep or sink is None
+
+    def _emit(self, registry, constraints):
+        if self.sink is not None:
+            if self.encoding == 'enum' and self._enum_encoding is None:
+                self._pending.extend(constraints)  # until the objects are known
+            else:
+                self.sink.add(*self.encode(*(self._pending + list(constraints))))
+                del self._pending[:]
+        if self._keep:
+            registry.extend(constraints)
+
+    def meta_fact(self, constraint):
+        self._emit(self.meta_constraints, [constraint])
+
+    def meta_facts(self, *constraints):
+        self._emit(self.meta_constraints, constraints)
+
+    def config_fact(self, constraint):
+        self._emit(self.config_constraints, [constraint])
+
+    def config_facts(self, *constraints):
+        self._emit(self.config_constraints, constraints)
+
+    def config_generated(self):
+        """If the objects are all defined and their constraints generated"""
+        return self._config_generated or bool(self.config_constraints)
+
+    def get_all_meta_facts(self):
+        return self.encode(*self.meta_constraints)
+
+    def get_all_config_facts(self):
+        return self.encode(*self.config_constraints)
+
+    def once_for_all(self):
+        return self.encode(*(self.meta_constraints + self.config_constraints))
+
+    def restore_facts(self, meta, config):
+        """Replaces the generated constraints, e.g. with the ones loaded by a ConstraintCache"""
+        self.meta_constraints[:] = meta
+        self.config_constraints[:] = config
+        self._config_generated = True
+        if self.encoding == 'enum':
+            self._use_encoding(None)
+            self._enum_encoding = _EnumEncoding(self)
+            self._use_encoding(self._enum_encoding)
+
+    def fingerprint(self, *extra):
+        """
+        A content hash of the metamodel, the objects and their forced values, and of extra
+        strings, e.g. the source code of the user constraints
+        """
+        def describe(value):
+            if isinstance(value, list):
+                return [describe(v) for v in value]
+            return str(value)
+
+        def features(class_):
+            return sorted((f.name, str(f.type), f.multiple, f.mandatory, getattr(f, 'opposite', None), f.bitvector,
+                           getattr(f, 'closure', None), getattr(f, 'root', None))
+                          for f in class_.attributes.values() + class_.references.values())
+
+        content = [
+            self.encoding, get_version_string(),
+            sorted((str(e), [str(v) for v in values]) for e, values in self.enums.items()),
+            sorted((c.name, str(c.supertype), c.abstract, features(c)) for c in self.classes.values()),
+            sorted((o.name, o.type.name, o.suspended, sorted((k, describe(v)) for k, v in o.forced_values.items()))
+                   for o in self.objects.values()),
+            [[o.name for o in pool] for pool in self._pools],
+            list(extra)
+        ]
+        return hashlib.sha1(repr(content)).hexdigest()
+
+    def encode(self, *constraints):
+        """
+        The constraints in the encoding of the workspace, unchanged unless it is 'enum'
+        """
+        constraints = [c.z3() if isinstance(c, ConsolasElement) else c for c in constraints]
+        if self.encoding != 'enum':
+            return constraints
+        _consolas_assert(self._enum_encoding, 'The enum encoding can be only used after all objects are defined '
+                                              'and the object constraints are generated')
+        return [self._enum_encoding.translate(c) for c in constraints]
+
+    def _encode_expr(self, expr):
+        return expr if self._enum_encoding is None else self._enum_encoding.translate(expr)
+
+    def _encode_decl(self, decl):
+        return decl if self._enum_encoding is None else self._enum_encoding.translate_decl(decl)
+
+    def _use_encoding(self, encoding):
+        """
+        Gives the predefined Sorts and functions, and the z3() of the classes, objects, features and
+        expressions, in encoding (an _EnumEncoding), so that the constraints built from now on are
+        already encoded. None gives them back over the uninterpreted sorts.
+        """
+        if encoding is self._api_encoding:
+            return
+        if self._api_encoding is not None:
+            for name, value in self._api_encoding.predefined.items():
+                setattr(self, name, value)
+        self._api_encoding = encoding
+        if encoding is not None:
+            for name, value in encoding.predefined.items():
+                setattr(self, name, self._api(value))
+        self._navigations.clear()
+
+    def _api(self, z3_element):
+        """A term, a declaration or a sort, in the encoding of the constraints built now"""
+        encoding = self._api_encoding
+        if encoding is None or z3_element is None:
+            return z3_element
+        if isinstance(z3_element, FuncDeclRef):
+            return encoding.translate_decl(z3_element)
+        if isinstance(z3_element, SortRef):
+            return encoding.translate_sort(z3_element)
+        return encoding.translate(z3_element)
+
+    def generate_meta_constraints(self):
+        del self.meta_constraints[:]
+        meta_fact = self.meta_fact
+        NilType, super_type, is_subtype = self.NilType, self.super_type, self.is_subtype
+        is_instance, actual_type, alive, is_abstract = self.is_instance, self.actual_type, self.alive, self.is_abstract
+
+        all_class_z3 = [i.z3() for i in self.classes.values()] + [NilType]
+
+        t1 = Const('t1', self.Type)
+        i1 = Const('i1', self.Inst)
+        i2 = Const('i2', self.Inst)
+
+        if self.encoding != 'enum':  # the enumeration sort is already closed
+            meta_fact(Distinct(*all_class_z3))
+            meta_fact(ForAll(t1, Or([t1 == i for i in all_class_z3])))
+        meta_fact(And([super_type(x.z3()) ==
+                      (x.supertype.z3() if x.supertype else NilType)
+                      for x in self.classes.values()], self.ctx
+                      ))
+        # The hierarchy is known, so is_subtype is a table rather than a recursive definition.
+        # Every type is a subtype of NilType, see generate_config_constraints for is_instance
+        all_classes = self.classes.values() + [None]
+        meta_fact(And([_literal(is_subtype(_type_z3(self, sub), _type_z3(self, sup)),
+                                sup is None or (sub is not None and sup in get_ancestors(sub)))
+                       for sub in all_classes for sup in all_classes]))
+        meta_fact(ForAll(i1, Or(Not(alive(i1)), Or([actual_type(i1) == x for x in all_class_z3]))))
+
+        meta_fact(And([is_abstract(i.z3()) for i in self.classes.values() if i.abstract] + [is_abstract(NilType)]))
+        meta_fact(ForAll(i1, Implies(alive(i1), Not(is_abstract(actual_type(i1))))))
+
+        meta_fact(And([super_type(NilType) == NilType, actual_type(self.nil) == NilType, Not(alive(self.nil))]))
+
+        for class_ in self.classes.values():
+            with self.var_scope():
+                vdomain = self.ObjectVar(class_)
+                for ref in class_.references.values():
+                    if not self._on_objects(ref):
+                        self.meta_facts(*self._reference_facts(class_, ref, vdomain))
+
+        return self.meta_constraints
+
+    def _on_objects(self, ref):
+        """The facts of a bit-vector reference (or of its opposite) need the objects"""
+        return ref.bitvector or (ref.opposite and ref.type.references[ref.opposite].bitvector)
+
+    def _reference_facts(self, class_, ref, vdomain):
+        result = []
+        allinst = class_.all_instances()
+        if ref.multiple or ref.opposite:
+            vrange = self.ObjectVar(ref.type)
+        if ref.bitvector:
+            bits = vdomain[ref].bits
+            members = self.set_members(ref.type)
+            body = And([Implies(SetExpr._bit(bits, k), And(m.alive(), m.isinstance(ref.type)))
+                        for k, m in enumerate(members)] + ([] if members else [bits == 0]))
+            result.append(allinst.forall(vdomain, body))
+        elif ref.multiple:
+            result.append(allinst.forall(vdomain, ref.type.all_instances().otherwise(vrange, Not(vdomain[ref].contains(vrange)))))
+            # meta_fact(allinst.otherwise(vdomain, ForAll(i1, Not(ref.z3()(vdomain.z3(), i1)))))
+        else:
+            body = And(vdomain[ref].alive(), vdomain[ref].isinstance(ref.type))
+            if not ref.mandatory:
+                body = Or(vdomain[ref].undefined(), body)
+            result.append(allinst.forall(vdomain, body))
+            # meta_fact(allinst.otherwise(vdomain, vdomain[ref].undefined()))
+        if ref.opposite:
+            other_ref = ref.type.references[ref.opposite]
+            this_side = vdomain[ref] == vrange \
+                if not ref.multiple else \
+                vdomain[ref].contains(vrange)
+            other_side = vrange[other_ref] == vdomain \
+                if not other_ref.multiple \
+                else vrange[other_ref].contains(vdomain)
+            result.append((class_.all_instances() * ref.type.all_instances())
+                          .forall([vdomain, vrange], this_side == other_side))
+        return result
+
+    def instances_by_decl(self, type_):
+        """The objects declared as type_ or one of its subclasses, indexed once per type"""
+        key = ('decl', type_.name)
+        if key not in self._type_index:
+            self._type_index[key] = [o for o in self.objects.values() if o.isinstance_by_decl(type_)]
+        return self._type_index[key]
+
+    def may_be_instances(self, type_):
+        """The objects that may be solved as instances of type_: declared as type_, one of its
+        subclasses, or one of its ancestors"""
+        key = ('may', type_.name)
+        if key not in self._type_index:
+            ancestors = get_ancestors(type_)
+            self._type_index[key] = [o for o in self.objects.values()
+                                     if o.isinstance_by_decl(type_) or o.type in ancestors]
+        return self._type_index[key]
+
+    def set_members(self, type_):
+        """
+        The objects that can be in a bit-vector set of type_, i.e., declared as type_, one
+        of its subclasses or one of its ancestors. Bit k of the set stands for the k-th object.
+        """
+        if type_.name not in self._set_layouts:
+            self._set_layouts[type_.name] = sorted(self.may_be_instances(type_), key=lambda o: o.name)
+        return self._set_layouts[type_.name]
+
+    def generate_config_constraints(self, backend='z3'):
+        """
+        :param backend: 'z3' builds the constraints term by term through the Python API,
+                        'smtlib' writes them as SMT-LIB2 text (see config_smtlib) parsed in one call
+        """
+        _consolas_assert(backend in ('z3', 'smtlib'), 'Unknown backend %s' % backend)
+        del self.config_constraints[:]
+        self._config_generated = True
+        self._use_encoding(None)  # the facts are generated over the uninterpreted sorts
+        if backend == 'smtlib':
+            facts = self._config_smtlib_facts(qualified=True)
+            parsed = iter(self.parse_smtlib('\n'.join('(assert %s)' % f for f in facts if isinstance(f, str))))
+            self.config_facts(*[next(parsed) if isinstance(f, str) else f for f in facts])
+            return self.config_constraints
+        config_fact = self.config_fact
+
+        all_object_z3 = [i.z3() for i in self.objects.values()] + [self.nil]
+        if self.encoding != 'enum':
+            config_fact(Distinct(*all_object_z3))
+            o1 = Const('o1', self.Inst)
+            closure = ForAll(o1, Or([o1 == i for i in all_object_z3]))
+            config_fact(closure if self._scope_literal is None else Implies(self._scope_literal, closure))
+        else:
+            self._enum_encoding = _EnumEncoding(self)
+
+        config_fact(And([obj.get_constant().isinstance(obj.type) for obj in self.objects.values()], self.ctx))
+        config_fact(And([obj.get_constant().alive() for obj in self.objects.values() if not obj.suspended], self.ctx))
+
+        # is_instance is given per object from the declared types, instead of a quantified definition
+        classes = self.classes.values()
+        config_fact(And([_literal(self.is_instance(self.nil, _type_z3(self, c)), c is None) for c in classes + [None]]))
+        subclasses_of = self._subclasses_of()
+        for object_ in self.objects.values():
+            config_fact(self._instance_facts(object_, subclasses_of))
+
+        for class_ in self.classes.values():
+            deferred = [ref for ref in class_.references.values() if self._on_objects(ref)]
+            if deferred:
+                with self.var_scope():
+                    vdomain = self.ObjectVar(class_)
+                    for ref in deferred:
+                        self.config_facts(*self._reference_facts(class_, ref, vdomain))
+
+        for name, object_ in self.objects.items():
+            for k, v in object_.forced_values.items():
+                config_fact(self._forced_fact(object_, object_.type.get_feature(k), v))
+
+        self.config_facts(*self._symmetry_facts())
+
+        values, facts = self._derivations()
+        for object_, ref, value in values:
+            config_fact(self._forced_fact(object_, ref, value))
+        self.config_facts(*facts)
+
+        if self._enum_encoding is not None:
+            self._use_encoding(self._enum_encoding)
+        return self.config_constraints
+
+    def _subclasses_of(self):
+        """The classes by name, with the list of the class and its subclasses"""
+        classes = self.classes.values()
+        return dict((c.name, [d for d in classes if d == c or c in get_ancestors(d)]) for c in classes)
+
+    def _instance_facts(self, object_, subclasses_of):
+        """The actual type of an object and is_instance on it, from its declared type"""
+        subclasses = subclasses_of[object_.type.name]
+        ancestors = [object_.type] + get_ancestors(object_.type)
+        actual = self.actual_type(object_.z3())
+        facts = [Or([actual == c.z3() for c in subclasses]),
+                 self.is_instance(object_.z3(), self.NilType)]
+        for class_ in self.classes.values():
+            instance = self.is_instance(object_.z3(), class_.z3())
+            if class_ in ancestors:
+                facts.append(instance)
+            elif class_ in subclasses:  # decided by the actual type
+                facts.append(instance == Or([actual == c.z3() for c in subclasses_of[class_.name]]))
+            else:
+                facts.append(Not(instance))
+        return And(facts)
+
+    def _forced_fact(self, object_, feature, value):
+        oconst = object_.get_constant()
+        if not feature.multiple:
+            if isinstance(feature, Attribute):
+                return oconst[feature] == value
+            elif value is None:
+                return oconst[feature].undefined()
+            return oconst[feature] == value.get_constant()
+        _consolas_assert(isinstance(feature, Reference), 'Multiple Attributes not supported yet...')
+        if isinstance(value, list):
+            return oconst[feature] == value
+        return oconst[feature].contains(value)
+
+    def _derivations(self, solver=True):
+        """
+        The closure and root references (see Class.define_reference). When their base reference is
+        forced on all the objects that may have it, their values are computed here, in linear time,
+        and returned as (object, reference, value) to be forced. Otherwise they are left to the
+        solver, and returned as facts (unless solver is False).
+        """
+        values, facts = [], []
+        for class_ in self.classes.values():
+            for ref in class_.references.values():
+                if not (ref.closure or ref.root):
+                    continue
+                base = class_.get_feature(ref.closure or ref.root)
+                _consolas_assert(isinstance(base, Reference) and base.type == ref.type,
+                                 '%s must be a reference to %s' % (ref.closure or ref.root, ref.type))
+                _consolas_assert(ref.closure or not base.multiple, 'The root of %s needs a single-valued reference'
+                                 % base.name)
+                domain = self.may_be_instances(class_)
+                if all(o.isinstance_by_decl(class_) and self._forced_fully(o, base) for o in domain):
+                    values.extend(self._derived_values(ref, base, domain))
+                elif solver:
+                    with self.var_scope():
+                        facts.extend(self._derived_facts(class_, ref, base, domain))
+        return values, facts
+
+    def _symmetry_facts(self):
+        """
+        Lex-leader constraints on the symmetric pools of objects: each object of a pool comes before
+        the next one by (alive first, actual type, single-valued features). These keys move with
+        the objects in a permutation, as none of them refers to an object of the pool, so sorting
+        any solution gives one that satisfies the constraints.
+        """
+        facts = []
+        for pool in self._pools:
+            members = set(o.name for o in pool)
+            for object_ in self.objects.values():
+                for k, v in object_.forced_values.items():
+                    values = v if isinstance(v, list) else [v]
+                    _consolas_assert(object_.name not in members and
+                                     not any(isinstance(x, Object) and x.name in members for x in values),
+                                     'The objects of a symmetric pool cannot be forced, or be forced values (%s.%s)'
+                                     % (object_.name, k))
+            keys = [self._symmetry_keys(o, pool[0].type, members) for o in pool]
+            for before, after in zip(keys, keys[1:]):
+                facts.append(_lex_leq(before, after))
+        return facts
+
+    def _symmetry_keys(self, object_, type_, members):
+        subclasses = self._subclasses_of()[type_.name]
+        actual = self.actual_type(object_.z3())
+        keys = [If(object_.alive(), 0, 1), _sum_of([If(actual == c.z3(), k, 0) for k, c in enumerate(subclasses)],
+                                                   self.ctx)]
+        for name in sorted(type_.get_all_feature_names()):
+            feature = type_.get_feature(name)
+            if feature.multiple:
+                continue
+            value = object_[name]
+            if isinstance(feature, Reference):
+                targets = self.may_be_instances(feature.type)
+                if any(t.name in members for t in targets):
+                    continue
+                keys.append(_sum_of([If(value == t, k + 1, 0) for k, t in enumerate(targets)], self.ctx))
+            elif feature.type == IntSort(self.ctx):
+                keys.append(value)
+            elif feature.type == BoolSort(self.ctx):
+                keys.append(If(value, 1, 0))
+        return keys
+
+    def _forced_fully(self, object_, ref):
+        """The value of ref is forced on object_, not only some of its items"""
+        if ref.name not in object_.forced_values:
+            return False
+        return isinstance(object_.forced_values[ref.name], list) or not ref.multiple
+
+    def _derived_values(self, ref, base, domain):
+        by_name = dict((o.name, o) for o in domain)
+
+        def successors(name):
+            if name not in by_name:
+                return []
+            value = by_name[name].forced_values[base.name]
+            return [v.name for v in (value if isinstance(value, list) else [value]) if v is not None]
+
+        reach = _transitive_closure(sorted(by_name), successors)
+        for object_ in domain:
+            if ref.closure:
+                yield object_, ref, [self.objects[n] for n in sorted(reach[object_.name])]
+            else:
+                roots = [n for n in reach[object_.name] if not successors(n)]
+                yield object_, ref, self.objects[roots[0]] if roots else object_
+
+    def _derived_facts(self, class_, ref, base, domain):
+        """
+        The closure is encoded over the candidate objects with a ranking: an object reaches an item
+        in one step, or through an object that reaches it in fewer steps. The root follows the
+        base reference, assuming that it has no cycle.
+        """
+        facts = []
+        for object_ in domain:
+            x = object_.get_constant()
+            nxt = x[base]
+            if ref.root:
+                nested = If(nxt.isinstance(class_), nxt[ref].z3(), nxt.z3())
+                facts.append(x[ref].z3() == If(nxt.undefined(), x.z3(), nested))
+                continue
+            if base.multiple:
+                steps = [(nxt.contains(y), y.get_constant()) for y in domain]
+            else:
+                steps = [(And(Not(nxt.undefined()), nxt.isinstance(class_)), nxt)]
+            rank = ref.rank()
+            for z in self.may_be_instances(ref.type):
+                direct = nxt.contains(z) if base.multiple else nxt == z
+                through = [(cond, y[ref].contains(z)) for cond, y in steps]
+                decreasing = [rank(y.z3(), z.z3()) < rank(x.z3(), z.z3()) for cond, y in steps]
+                facts.append(x[ref].contains(z) == Or([direct] + [And(c, r, d) for (c, r), d in zip(through, decreasing)]))
+                facts.append(And([Implies(And(c, r), x[ref].contains(z)) for c, r in through], self.ctx))
+        return facts
+
+    def config_smtlib(self, declare=False):
+        """
+        The constraints of generate_config_constraints as SMT-LIB2 text. The type facts, the closure of
+        the objects and the simple forced values are written directly, instead of building a Python
+        wrapper and a Z3 call per term. The facts of the deferred references, of the derived closures
+        and of the symmetric pools, and the forced values of bit-vectors or with expressions, are still
+        built as Z3 terms, and only written with sexpr(): generate_config_constraints(backend='smtlib')
+        adds them to the constraints as they are.
+
+        :param declare: start with the declarations of the sorts and functions, so that the
+                        text can be replayed offline. The features are then written with their own
+                        names, which must not be shared by features of different sorts. Without
+                        declarations, the text is meant for parse_smtlib, and the features written
+                        directly are named Class.feature
+        """
+        facts = self._config_smtlib_facts(qualified=not declare)
+        text = '\n'.join('(assert %s)' % (f if isinstance(f, str) else f.sexpr()) for f in facts)
+        return self._declarations_smtlib() + text if declare else text
+
+    def _config_smtlib_facts(self, qualified):
+        """The facts of config_smtlib, as SMT-LIB2 text or Z3 terms"""
+        _consolas_assert(self.encoding != 'enum', 'The SMT-LIB2 backend only supports the uninterpreted encoding')
+        sym = _smt_symbol
+        objects = self.objects.values()
+        names = [sym(o.name) for o in objects] + ['nil']
+        facts = [
+            '(distinct %s)' % ' '.join(names) if len(names) > 1 else 'true',
+            self._guarded_smtlib('(forall ((o1 Inst)) %s)' % _smt_app('or', ['(= o1 %s)' % n for n in names], 'false')),
+            _smt_app('and', ['(is_instance %s %s)' % (sym(o.name), sym(o.type.name)) for o in objects], 'true'),
+            _smt_app('and', ['(alive %s)' % sym(o.name) for o in objects if not o.suspended], 'true')
+        ]
+
+        classes = self.classes.values()
+        facts.append(_smt_app('and', [_smt_literal('(is_instance nil %s)' % (sym(c.name) if c else 'NilType'), c is None)
+                                      for c in classes + [None]], 'true'))
+        subclasses_of = self._subclasses_of()
+        for object_ in objects:
+            name = sym(object_.name)
+            subclasses = subclasses_of[object_.type.name]
+            ancestors = [object_.type] + get_ancestors(object_.type)
+            actual = '(actual_type %s)' % name
+            is_actual = lambda cs: _smt_app('or', ['(= %s %s)' % (actual, sym(c.name)) for c in cs], 'false')
+            table = [is_actual(subclasses), '(is_instance %s NilType)' % name]
+            for class_ in classes:
+                instance = '(is_instance %s %s)' % (name, sym(class_.name))
+                if class_ in ancestors:
+                    table.append(instance)
+                elif class_ in subclasses:
+                    table.append('(= %s %s)' % (instance, is_actual(subclasses_of[class_.name])))
+                else:
+                    table.append('(not %s)' % instance)
+            facts.append(_smt_app('and', table, 'true'))
+
+        for class_ in classes:
+            deferred = [ref for ref in class_.references.values() if self._on_objects(ref)]
+            if deferred:
+                with self.var_scope():
+                    vdomain = self.ObjectVar(class_)
+                    for ref in deferred:
+                        facts.extend(self._reference_facts(class_, ref, vdomain))
+
+        for object_ in objects:
+            for k, v in object_.forced_values.items():
+                facts.append(self._forced_smtlib(object_, object_.type.get_feature(k), v, qualified))
+
+        values, derived = self._derivations()
+        facts.extend(self._forced_smtlib(object_, ref, value, qualified) for object_, ref, value in values)
+        facts.extend(derived + self._symmetry_facts())
+        return facts
+
+    def _guarded_smtlib(self, closure):
+        if self._scope_literal is None:
+            return closure
+        return '(=> %s %s)' % (self._scope_literal.sexpr(), closure)
+
+    def _forced_smtlib(self, object_, feature, value, qualified=False):
+        """
+        A forced value as SMT-LIB2, the same constraint as in generate_config_constraints,
+        or as a Z3 term for a bit-vector or a value given by expressions
+        """
+        sym = _smt_symbol
+        name, fun = sym(object_.name), _feature_smtlib(feature, qualified)
+        if not feature.multiple:
+            if isinstance(feature, Attribute):
+                return '(= (%s %s) %s)' % (fun, name, _smt_value(value))
+            return '(= (%s %s) %s)' % (fun, name, sym(value.name) if value is not None else 'nil')
+        _consolas_assert(isinstance(feature, Reference), 'Multiple Attributes not supported yet...')
+        simple = all(isinstance(v, Object) for v in (value if isinstance(value, list) else [value]))
+        if feature.bitvector or not simple:
+            oconst = object_.get_constant()
+            expr = oconst[feature] == value if isinstance(value, list) else oconst[feature].contains(value)
+            return expr if isinstance(expr, BoolRef) else expr.z3()
+        if not isinstance(value, list):
+            return '(%s %s %s)' % (fun, name, sym(value.name))
+        items = [sym(v.name) for v in value]
+        return '(and %s (forall ((o1 Inst)) (=> (%s %s o1) %s)))' % (
+            _smt_app('and', ['(%s %s %s)' % (fun, name, i) for i in items], 'true'),
+            fun, name, _smt_app('or', ['(= o1 %s)' % i for i in items], 'false'))
+
+    def _smtlib_symbols(self):
+        """
+        The sorts and functions of the workspace, by name. The features are also given by
+        Class.feature, since features of different classes can have the same name
+        """
+        sorts = {'Type': self.Type, 'Inst': self.Inst}
+        for enum in self.enums:
+            sorts[str(enum)] = enum
+        decls = [self.NilType.decl(), self.nil.decl(), self.super_type, self.actual_type, self.is_subtype,
+                 self.is_instance, self.alive, self.is_abstract]
+        decls += [c.z3().decl() for c in self.classes.values()] + [o.z3().decl() for o in self.objects.values()]
+        qualified = {}
+        for class_ in self.classes.values():
+            for feature in class_.attributes.values() + class_.references.values():
+                decls.append(feature.z3())
+                qualified[_feature_smtlib(feature, True)] = feature.z3()
+            decls += [f.rank() for f in class_.references.values() if f.closure]
+        if self._scope_literal is not None:
+            decls.append(self._scope_literal.decl())
+        symbols = dict((d.name(), d) for d in decls)
+        symbols.update(qualified)
+        return sorts, symbols
+
+    def _declarations_smtlib(self):
+        sorts, symbols = self._smtlib_symbols()
+        decls = dict((d.name(), d) for d in symbols.values())
+        for d in symbols.values():
+            _consolas_assert(d.eq(decls[d.name()]), 'Features of different sorts are named %s' % d.name())
+        lines = ['(declare-sort Type 0)', '(declare-sort Inst 0)']
+        for enum, values in self.enums.items():
+            lines.append('(declare-datatypes ((%s 0)) ((%s)))' % (
+                _smt_symbol(str(enum)), ' '.join('(%s)' % _smt_symbol(str(v)) for v in values)))
+        lines.extend(d.sexpr() for d in decls.values())
+        return '\n'.join(lines) + '\n'
+
+    def parse_smtlib(self, text):
+        """The assertions of SMT-LIB2 text, with the sorts and functions of the workspace"""
+        sorts, decls = self._smtlib_symbols()
+        return [e for e in parse_smt2_string(text, sorts=sorts, decls=decls, ctx=self.ctx)]
+
+    def de_quantifer_single(self, expr):
+        return de_quantifer_single(expr, self)
+
+    def ground_facts(self, *constraints, **kwargs):
+        return ground_facts(*constraints, **dict(kwargs, workspace=self))
+
+    def decode_model(self, model, objects=None, features=None):
+        return DecodedModel(ModelDecoder(model, self), objects, features)
+
+    def cast_all_objects(self, model):
+        return self.decode_model(model).to_dict()
+
+
+def _lex_leq(left, right):
+    """The integer vector left is lexicographically before or equal to right"""
+    result = BoolVal(True, left[0].ctx)
+    for l, r in reversed(zip(left, right)):
+        result = Or(l < r, And(l == r, result))
+    return result
+
+
+def _transitive_closure(nodes, successors):
+    """
+    The nodes reachable in one or more steps from each node of a graph, as a dictionary of sets,
+    in time linear in the graph and the result. The strongly connected components are found with
+    Tarjan's algorithm, without recursion, and each one is closed once, from the closures of the
+    components it leads to, which are found before it.
+    """
+    index, low, stack, on_stack, result = {}, {}, [], set(), {}
+
+    def visit(node):
+        index[node] = low[node] = len(index)
+        stack.append(node)
+        on_stack.add(node)
+        return node, iter(successors(node))
+
+    for start in nodes:
+        if start in index:
+            continue
+        work = [visit(start)]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    work.append(visit(child))
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[node])
+                if low[node] == index[node]:
+                    component = set()
+                    while node not in component:
+                        component.add(stack.pop())
+                    on_stack.difference_update(component)
+                    reach = set()
+                    for member in component:
+                        for child in successors(member):
+                            reach.add(child)
+                            if child not in component:
+                                reach.update(result[child])
+                    for member in component:
+                        result[member] = reach
+    return result
+
+
+def _type_z3(workspace, class_):
+    return class_.z3() if class_ is not None else workspace.NilType
+
+
+def _literal(expr, value):
+    return expr if value else Not(expr)
+
+
+_SMT_SIMPLE_SYMBOL = re.compile(r'^[A-Za-z~!@$%^&*_+=<>.?/-][A-Za-z0-9~!@$%^&*_+=<>.?/-]*$')
+_SMT_RESERVED = set(['let', 'forall', 'exists', 'match', 'par', 'as', '_', '!'])
+
+
+def _smt_symbol(name):
+    return name if _SMT_SIMPLE_SYMBOL.match(name) and name not in _SMT_RESERVED else '|%s|' % name
+
+
+def _feature_smtlib(feature, qualified):
+    """The symbol of a feature, qualified by its class (Class.feature) or its own name"""
+    return _smt_symbol('%s.%s' % (feature.parent.name, feature.name) if qualified else feature.name)
+
+
+def _smt_app(op, args, empty):
+    """(op args...), or empty without arguments, or the argument itself if it is alone"""
+    if not args:
+        return empty
+    if len(args) == 1:
+        return args[0]
+    return '(%s %s)' % (op, ' '.join(args))
+
+
+def _smt_literal(atom, value):
+    return atom if value else '(not %s)' % atom
+
+
+def _smt_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, long)):
+        return str(value) if value >= 0 else '(- %d)' % -value
+    if isinstance(value, ConsolasElement):
+        value = value.z3()
+    return value.sexpr()
+
+
+_default_workspace = Workspace(main_ctx())
+
+
+def get_default_workspace():
+    """The workspace of the module-level functions, in the main Z3 context"""
+    return _default_workspace
+
+
+# The predefined Sorts and functions, and the registries of the default workspace
+
+_Type = _default_workspace.Type
+_Inst = _default_workspace.Inst
+
+NilType = _default_workspace.NilType
+nil = _default_workspace.nil
+
+super_type = _default_workspace.super_type
+actual_type = _default_workspace.actual_type
+
+is_subtype = _default_workspace.is_subtype
+is_instance = _default_workspace.is_instance
+alive = _default_workspace.alive
+is_abstract = _default_workspace.is_abstract
+
+_all_enums = _default_workspace.enums
+_all_classes = _default_workspace.classes
+_all_objects = _default_workspace.objects
+_all_vars = _default_workspace.vars
+_meta_constraints = _default_workspace.meta_constraints
+_config_constraints = _default_workspace.config_constraints
 
 
 def get_all_objects():
-    return _all_objects.values();
+    return _default_workspace.get_all_objects()
 
 
 def get_object_by_name(name):
-    return _all_objects[name]
+    return _default_workspace.get_object_by_name(name)
 
 
 def DefineClass(name, supertype=None, abstract=False):
-    _consolas_assert(not (name in _all_classes), 'Class name "%s" is already used' % name)
-
-    class_ = Class(name, supertype, abstract)
-    _all_classes[name] = class_
-    return class_
+    return _default_workspace.DefineClass(name, supertype, abstract)
 
 
 def load_enums(desc):
-    for k, v in desc.items():
-        enum, values = EnumSort(k, v)
-        _all_enums[enum] = values
+    _default_workspace.load_enums(desc)
+
 
 def load_class_head(desc):
-    desc = desc.copy()
-    desc.pop('reference', None)
-    desc.pop('attribute', None)
-    if 'supertype' in desc:
-        supertype = desc['supertype']
-        _consolas_assert(supertype in _all_classes, 'supertype %s not defined' % supertype)
-        desc['supertype'] = _all_classes[supertype]
-    return DefineClass(**desc)
+    return _default_workspace.load_class_head(desc)
 
 
 def _resolve_type(type_):
-    if type_ in _all_classes:
-        return _all_classes[type_]
-    elif type_ == 'Integer':
-        return IntSort()
-    elif type_ == 'Boolean':
-        return BoolSort()
-    else:
-        enum = [e for e in _all_enums.keys() if str(e)==type_]
-        if enum:
-            return enum[0]
-    _consolas_assert(False, 'type %s not defined' % type_)
+    return _default_workspace._resolve_type(type_)
 
 
 def load_class_body(desc):
-    name = desc['name']
-    _consolas_assert(name in _all_classes, 'class %s not defined' % name)
-    class_ = _all_classes[name]
-    for ref in desc.get('reference', []):
-        ref['type'] = _resolve_type(ref['type'])
-        class_.define_reference(**ref)
-    for attr in desc.get('attribute', []):
-        attr['type'] = _resolve_type(attr['type'])
-        class_.define_attribute(**attr)
-    return class_
+    return _default_workspace.load_class_body(desc)
 
 
 def load_all_classes(descs):
-    if 'name' not in descs[0]:  #Then it is the enum definitions
-        load_enums(descs[0])
-        descs.pop(0)
-    classes = [load_class_head(x) for x in descs]
-    for x in descs:
-        load_class_body(x)
-    return [e for e in _all_enums] + classes
+    return _default_workspace.load_all_classes(descs)
 
 
 def DistinctConsts(*consts):
@@ -713,15 +1953,11 @@ def DistinctConsts(*consts):
     return Distinct(*z3consts)
 
 def DefineObject(name, type, suspended=False):
-    _consolas_assert(not (name in _all_objects), 'Object name "%s" is already used' % name)
-
-    object_ = Object(name, type, suspended)
-    _all_objects[name] = object_
-    return object_
+    return type.workspace.DefineObject(name, type, suspended)
 
 
-def DefineObjects(names, type, suspended=False):
-    return [DefineObject(name, type, suspended) for name in names]
+def DefineObjects(names, type, suspended=False, symmetric=False):
+    return type.workspace.DefineObjects(names, type, suspended, symmetric)
 
 
 def get_ancestors(clazz):
@@ -733,36 +1969,32 @@ def get_ancestors(clazz):
     return result
 
 def get_enum(enum):
-    found = [e for e in _all_enums if str(e)==str(enum)]
-    _consolas_assert(found, "Enum %s is not defined" % enum)
-    found = found[0]
-    return found, _all_enums[found]
+    return _default_workspace.get_enum(enum)
+
+
+def _workspace_of(type_):
+    return type_.workspace if isinstance(type_, Class) else _default_workspace
 
 
 def ObjectVar(type_, id=None):
     _consolas_assert(isinstance(type_, Class), "use ObjectVar only on Consolas classes")
-    return DeclareVar(type_, id)
+    return type_.workspace.ObjectVar(type_, id)
 
 
 def DeclareVar(_type, id=None):
-    if id:
-        _consolas_assert(not (id in _all_vars), 'id "%s" is already used' % id)
-    else:
-        id = 'var%s%d' % (_type.name, len(_all_vars)+1)
-    if isinstance(_type, Class):
-        const = ObjectConst(_type, id)
-    else:
-        const = DataConst(_type, id)
-    _all_vars[id] = const
-    return const
+    return _workspace_of(_type).DeclareVar(_type, id)
 
 
 def ObjectVars(type_, *ids):
     return [ObjectVar(type_, id) for id in ids]
 
 
+def var_scope():
+    return _default_workspace.var_scope()
+
+
 def get_declared_var(id):
-    return _all_vars[id]
+    return _default_workspace.get_declared_var(id)
 
 
 def start_over():
@@ -770,12 +2002,7 @@ def start_over():
     Clear all the global variables and define classes again. Now only used in unittest...
     :return:
     """
-    _all_vars.clear()
-    _all_classes.clear()
-    _all_objects.clear()
-    _all_enums.clear()
-    del _meta_constraints[:]
-    del _config_constraints[:]
+    _default_workspace.start_over()
 
 ##############################################
 #
@@ -784,135 +2011,491 @@ def start_over():
 ###############################################
 
 
+def stream_to(sink, keep=False):
+    _default_workspace.stream_to(sink, keep)
+
+
 def meta_fact(constraint):
-    _meta_constraints.append(constraint)
+    _default_workspace.meta_fact(constraint)
 
 
 def meta_facts(*constraints):
-    _meta_constraints.extend(constraints)
+    _default_workspace.meta_facts(*constraints)
 
 
 def config_fact(constraint):
-    _config_constraints.append(constraint)
+    _default_workspace.config_fact(constraint)
 
 
 def config_facts(*constraints):
-    _config_constraints.extend(constraints)
+    _default_workspace.config_facts(*constraints)
 
 
 def get_all_meta_facts():
-    return list(_meta_constraints);
+    return _default_workspace.get_all_meta_facts()
 
 
 def get_all_config_facts():
-    return list(_config_constraints);
+    return _default_workspace.get_all_config_facts()
 
 
 def once_for_all():
     #generate_meta_constraints()
     #generate_config_constraints()
-    return list(_meta_constraints) + list(_config_constraints)
+    return _default_workspace.once_for_all()
 
 
 def generate_meta_constraints():
-    del _meta_constraints[:]
-
-    all_class_z3 = [i.z3() for i in _all_classes.values()] + [NilType]
-    meta_fact(Distinct(*all_class_z3))
-
-    t1 = Const('t1', _Type)
-    t2 = Const('t2', _Type)
-    t3 = Const('t3', _Type)
-    i1 = Const('i1', _Inst)
-    i2 = Const('i2', _Inst)
-
-    meta_fact(ForAll(t1, Or([t1 == i for i in all_class_z3])))
-    meta_fact(And([super_type(x.z3()) ==
-                  (x.supertype.z3() if x.supertype else NilType)
-                  for x in _all_classes.values()]
-                  ))
-    meta_fact(ForAll([t1, t2], is_subtype(t1, t2) == Or(super_type(t1) == t2, Exists(t3, And(super_type(t1)==t3, is_subtype(t3, t2))))))
-    meta_fact(ForAll([t1, i1], is_instance(i1, t1) == Or(actual_type(i1) == t1, is_subtype(actual_type(i1), t1))))
-    meta_fact(ForAll(t1, Implies(is_subtype(NilType, t1), t1 == NilType)))
-    meta_fact(ForAll(i1, Or(Not(alive(i1)), Or([actual_type(i1) == x for x in all_class_z3]))))
-
-    meta_fact(And([is_abstract(i.z3()) for i in _all_classes.values() if i.abstract] + [is_abstract(NilType)]))
-    meta_fact(ForAll(i1, Implies(alive(i1), Not(is_abstract(actual_type(i1))))))
-
-    meta_fact(And([super_type(NilType) == NilType, actual_type(nil) == NilType, Not(alive(nil))]))
-
-    for class_ in _all_classes.values():
-        vdomain = ObjectVar(class_)
-        allinst = class_.all_instances()
-        for ref in class_.references.values():
-            if ref.multiple:
-                vrange = ObjectVar(ref.type)
-                meta_fact(allinst.forall(vdomain, ref.type.all_instances().otherwise(vrange, Not(vdomain[ref].contains(vrange)))))
-                # meta_fact(allinst.otherwise(vdomain, ForAll(i1, Not(ref.z3()(vdomain.z3(), i1)))))
-            else:
-                body = And(vdomain[ref].alive(), vdomain[ref].isinstance(ref.type))
-                if not ref.mandatory:
-                    body = Or(vdomain[ref].undefined(), body)
-                meta_fact(allinst.forall(vdomain, body))
-                # meta_fact(allinst.otherwise(vdomain, vdomain[ref].undefined()))
-            if ref.opposite:
-                other_ref = ref.type.references[ref.opposite]
-                this_side = vdomain[ref] == vrange \
-                    if not ref.multiple else \
-                    vdomain[ref].contains(vrange)
-                other_side = vrange[other_ref] == vdomain \
-                    if not other_ref.multiple \
-                    else vrange[other_ref].contains(vdomain)
-                meta_fact((class_.all_instances() * ref.type.all_instances())
-                          .forall([vdomain, vrange], this_side == other_side))
+    return _default_workspace.generate_meta_constraints()
 
-    return _meta_constraints
 
+def generate_config_constraints(backend='z3'):
+    return _default_workspace.generate_config_constraints(backend)
 
-def generate_config_constraints():
 
-    del _config_constraints[:]
+def encode(*constraints):
+    return _default_workspace.encode(*constraints)
 
-    all_object_z3 = [i.z3() for i in _all_objects.values()] + [nil]
-    config_fact(Distinct(*all_object_z3))
-    o1 = Const('o1', _Inst)
-    config_fact(ForAll(o1, Or([o1 == i for i in all_object_z3])))
 
-    t1 = Const('t1', _Type)
+######################################################
+#
+# De-Quantifier
+#
+######################################################
 
-    config_fact(And([obj.get_constant().isinstance(obj.type) for obj in _all_objects.values()]))
-    config_fact(And([obj.get_constant().alive() for obj in _all_objects.values() if not obj.suspended]))
-    config_fact(ForAll(t1, Or(t1 == NilType, Not(is_instance(nil, t1)))))
 
-    for name, object_ in _all_objects.items():
-        oconst = object_.get_constant()
-        type_ = object_.type
-        for k, v in object_.forced_values.items():
-            feature = type_.get_feature(k)
-            if not feature.multiple:
-                if isinstance(feature, Attribute):
-                    config_fact(oconst[feature] == v)
-                else:
-                    config_fact(oconst[feature] == v.get_constant())
+def _mk_app(decl, args):
+    """decl(*args), also for n-ary operators (And, +, ...) applied to any number of arguments"""
+    z3args, size = _to_ast_array(args)
+    return _to_expr_ref(Z3_mk_app(decl.ctx_ref(), decl.ast, size, z3args), decl.ctx)
+
+
+def _is_value(expr):
+    return is_true(expr) or is_false(expr) or is_int_value(expr) or is_rational_value(expr) or is_bv_value(expr)
+
+
+def _finite_domain(workspace, sort):
+    """The values a bound variable of this sort can take once all the objects are
+    defined, or None if the sort is not finite (Int, Real, ...)"""
+    if sort == workspace.Inst:
+        return [o.z3() for o in workspace.objects.values()] + [workspace.nil]
+    if sort == workspace.Type:
+        return [c.z3() for c in workspace.classes.values()] + [workspace.NilType]
+    if sort == BoolSort(sort.ctx):
+        return [BoolVal(False, sort.ctx), BoolVal(True, sort.ctx)]
+    if isinstance(sort, DatatypeSortRef):
+        constructors = [sort.constructor(i) for i in range(sort.num_constructors())]
+        if all(c.arity() == 0 for c in constructors):
+            return [c() for c in constructors]
+    return None
+
+
+class _Grounder:
+    """
+    Expands the quantifiers over finite sorts into And/Or over the declared
+    objects (and classes, enum items), and folds the guards that are decided
+    by the object declarations:
+
+      - alive(o) is True for a non-suspended object, and False for nil
+      - is_instance(o, C) is True if o is declared as C or a subclass, and False
+        if C is neither an ancestor nor a descendant of the declared type
+      - two distinct objects (or classes) are never equal
+
+    Every folded literal is recorded, so that it can be asserted again and the
+    model still tells the same story about alive and is_instance.
+
+    With propagate, the features of an object whose values are forced (or derived, see
+    Class.define_reference) are replaced by these values as well, and the operations
+    on values are evaluated. They are recorded in known, to be asserted again.
+    """
+
+    def __init__(self, workspace, propagate=False):
+        self.workspace = workspace
+        self.objects = dict(workspace.objects)
+        self.objects['nil'] = None
+        self.classes = dict(workspace.classes)
+        self.classes['NilType'] = None
+        self.folded = {}
+        self.known = {}
+        self._forced = self._forced_values() if propagate else {}
+        self._cache = {}
+        self._fresh = 0
+
+    def _forced_values(self):
+        """The forced and derived values, by feature and object name"""
+        ws = self.workspace
+        values = [(o, o.type.get_feature(k), v) for o in ws.objects.values() for k, v in o.forced_values.items()]
+        values += ws._derivations(solver=False)[0]
+        return dict(((f.name, o.name), (f, v)) for o, f, v in values)
+
+    def _static_value(self, decl, args):
+        """The value of a feature of an object, or None if it is not forced"""
+        oname = self._object_of(args[0]) if args else None
+        forced = self._forced.get((decl.name(), oname))
+        if forced is None or not decl.eq(forced[0].z3()):
+            return None
+        feature, value = forced
+        ws = self.workspace
+        if len(args) == 2:  # a relation, known for all items only if the whole set is forced
+            item = self._object_of(args[1])
+            if item is None or not (isinstance(value, list) or item == value.name):
+                return None
+            return BoolVal(item in [v.name for v in value] if isinstance(value, list) else True, ws.ctx)
+        if isinstance(feature, Attribute):
+            return feature.type.cast(value)
+        if not feature.multiple:
+            return ws.nil if value is None else value.z3()
+        if feature.bitvector and isinstance(value, list):
+            names = [v.name for v in value]
+            members = ws.set_members(feature.type)
+            mask = sum(1 << k for k, m in enumerate(members) if m.name in names)
+            return BitVecVal(mask, decl.range().size(), ws.ctx)
+        return None
+
+    def _object_of(self, expr):
+        if is_const(expr) and expr.sort() == self.workspace.Inst and expr.decl().name() in self.objects:
+            return expr.decl().name()
+        return None
+
+    def _class_of(self, expr):
+        if is_const(expr) and expr.sort() == self.workspace.Type and expr.decl().name() in self.classes:
+            return expr.decl().name()
+        return None
+
+    def _is_domain_const(self, expr):
+        return self._object_of(expr) is not None or self._class_of(expr) is not None
+
+    def _static_alive(self, oname):
+        if oname == 'nil':
+            return False
+        return None if self.objects[oname].suspended else True
+
+    def _static_instance(self, oname, cname):
+        if oname == 'nil':
+            return cname == 'NilType'
+        class_ = self.classes[cname]
+        if class_ is None:
+            return None
+        object_ = self.objects[oname]
+        if object_.isinstance_by_decl(class_):
+            return True
+        if object_.type in get_ancestors(class_):
+            return None  # may be solved as a subclass of the declared type
+        return False
+
+    def _fold_literal(self, expr, value):
+        if value is None:
+            return expr
+        self.folded[expr.get_id()] = (expr, value)
+        return BoolVal(value, expr.ctx)
+
+    def ground(self, expr):
+        key = expr.get_id()
+        if key in self._cache:
+            return self._cache[key][1]
+        if is_quantifier(expr):
+            result = self._ground_quantifier(expr)
+        elif is_app(expr) and expr.num_args() > 0:
+            result = self._ground_app(expr)
+        else:
+            result = expr
+        # keep expr alive, otherwise Z3 may recycle its id
+        self._cache[key] = (expr, result)
+        return result
+
+    def _ground_quantifier(self, expr):
+        if not (expr.is_forall() or expr.is_exists()):
+            return expr
+        nvars = expr.num_vars()
+        domains = [_finite_domain(self.workspace, expr.var_sort(i)) for i in range(nvars)]
+        body = expr.body()
+        if any(d is None for d in domains):
+            # keep the quantifier, but still ground what is inside
+            consts = []
+            for i in range(nvars):
+                self._fresh += 1
+                consts.append(Const('%s!g%d' % (expr.var_name(i), self._fresh), expr.var_sort(i)))
+            # the last declared variable is de Bruijn index 0
+            inner = self.ground(substitute_vars(body, *reversed(consts)))
+            return ForAll(consts, inner) if expr.is_forall() else Exists(consts, inner)
+        connective, unit, zero = (And, True, False) if expr.is_forall() else (Or, False, True)
+        instances = []
+        for values in itertools.product(*domains):
+            inst = self.ground(substitute_vars(body, *reversed(values)))
+            if is_true(inst) if unit else is_false(inst):
+                continue
+            if is_true(inst) if zero else is_false(inst):
+                return BoolVal(zero, expr.ctx)
+            instances.append(inst)
+        if not instances:
+            return BoolVal(unit, expr.ctx)
+        return instances[0] if len(instances) == 1 else connective(instances)
+
+    def _ground_app(self, expr):
+        ctx = expr.ctx
+        decl = expr.decl()
+        kind = decl.kind()
+        if kind == Z3_OP_AND or kind == Z3_OP_OR:
+            absorbing = kind == Z3_OP_OR
+            args = []
+            for c in expr.children():
+                c = self.ground(c)
+                if is_true(c) if absorbing else is_false(c):
+                    return BoolVal(absorbing, ctx)
+                if not (is_false(c) if absorbing else is_true(c)):
+                    args.append(c)
+            if not args:
+                return BoolVal(not absorbing, ctx)
+            if len(args) == 1:
+                return args[0]
+            return Or(args) if absorbing else And(args)
+        if kind == Z3_OP_IMPLIES:
+            cond = self.ground(expr.arg(0))
+            if is_false(cond):
+                return BoolVal(True, ctx)
+            then = self.ground(expr.arg(1))
+            if is_true(cond) or is_false(then):
+                return then if is_true(cond) else Not(cond)
+            return BoolVal(True, ctx) if is_true(then) else Implies(cond, then)
+        if kind == Z3_OP_NOT:
+            arg = self.ground(expr.arg(0))
+            if is_true(arg) or is_false(arg):
+                return BoolVal(is_false(arg), ctx)
+            return Not(arg)
+        if kind == Z3_OP_ITE:
+            cond = self.ground(expr.arg(0))
+            if is_true(cond):
+                return self.ground(expr.arg(1))
+            if is_false(cond):
+                return self.ground(expr.arg(2))
+            return If(cond, self.ground(expr.arg(1)), self.ground(expr.arg(2)))
+
+        args = [self.ground(c) for c in expr.children()]
+        if (kind == Z3_OP_EQ or kind == Z3_OP_DISTINCT) and all(self._is_domain_const(a) for a in args):
+            names = [str(a) for a in args]
+            if kind == Z3_OP_EQ:
+                return BoolVal(names[0] == names[1], ctx)
+            return BoolVal(len(set(names)) == len(names), ctx)
+        if kind == Z3_OP_EQ and is_bool(args[0]):
+            for a, b in (args, reversed(args)):
+                if is_true(a) or is_false(a):
+                    return b if is_true(a) else self.ground(Not(b))
+
+        result = expr if all(a.eq(c) for a, c in zip(args, expr.children())) else _mk_app(decl, args)
+        if self._forced and kind == Z3_OP_UNINTERPRETED:
+            value = self._static_value(decl, args)
+            if value is not None:
+                self.known[result.get_id()] = (result, value)
+                return value
+        elif self._forced and all(_is_value(a) for a in args):
+            return simplify(result)
+        if decl.eq(self.workspace.alive):
+            oname = self._object_of(args[0])
+            if oname is not None:
+                return self._fold_literal(result, self._static_alive(oname))
+        elif decl.eq(self.workspace.is_instance):
+            oname, cname = self._object_of(args[0]), self._class_of(args[1])
+            if oname is not None and cname is not None:
+                return self._fold_literal(result, self._static_instance(oname, cname))
+        return result
+
+    def closure(self, exprs):
+        """Restrict every remaining Inst or Type term to the declared objects or classes.
+        Replaces the ForAll(o1, Or(o1 == ...)) axiom once no quantifier over Inst is left"""
+        self.open_universe = False
+        ws = self.workspace
+        result = []
+        has_var = {}
+
+        def visit(e):
+            key = e.get_id()
+            if key in has_var:
+                return has_var[key][1]
+            if is_var(e):
+                found = True
+            elif is_quantifier(e):
+                if any(e.var_sort(i) in (ws.Inst, ws.Type) for i in range(e.num_vars())):
+                    self.open_universe = True
+                visit(e.body())
+                found = True
             else:
-                _consolas_assert(isinstance(feature, Reference), 'Multiple Attributes not supported yet...')
-                if isinstance(v, list):
-                    config_fact(oconst[feature] == v)
-                else:
-                    config_fact(oconst[feature].contains(v))
+                found = False
+                for c in e.children():
+                    found = visit(c) or found
+            has_var[key] = (e, found)
+            if not found and not self._is_domain_const(e):
+                if e.sort() == ws.Inst:
+                    result.append(Or([e == o for o in _finite_domain(ws, ws.Inst)]))
+                elif e.sort() == ws.Type:
+                    result.append(Or([e == t for t in _finite_domain(ws, ws.Type)]))
+            return found
+
+        for e in exprs:
+            visit(e)
+        return result
+
 
-    return _config_constraints
+def de_quantifer_single(expr, workspace=None):
+    """
+    Expand one quantifier over the declared objects. Nested quantifiers are expanded as well,
+    and the guards that are decided by object declarations are folded.
+
+    :param expr: A ForAll or Exists, as generated by SetExpr.forall and SetExpr.exists
+    :param workspace: the workspace of the objects, by default the one of the module-level functions
+    :return: A quantifier-free And/Or over the objects
+    """
+    workspace = workspace if workspace is not None else _default_workspace
+    _consolas_assert(isinstance(expr, QuantifierRef), "De-Quantifier only works on quantifiers")
+    _consolas_assert(workspace.config_generated(), 'De-Quantifier can be only used after all objects are defined '
+                                          'and the object constraints are generated')
+    return _Grounder(workspace).ground(expr)
+
+
+def ground_facts(*constraints, **kwargs):
+    """
+    Expand all the quantifiers over objects and classes into ground facts.
+    Use it instead of get_all_meta_facts() and get_all_config_facts() to give Z3 a
+    quantifier-free problem (apart from quantifiers over integers):
+
+    >>> solver.add(*ground_facts())
+    >>> solver.add(*ground_facts(wanted.alive(), ...)) # with additional constraints
+
+    Constraints added to the solver afterwards should also go through ground_facts,
+    since the closure axiom on the objects is not kept in the result.
+
+    :param constraints: the constraints to ground, by default all the meta and config facts
+    :param workspace: (keyword only) the workspace of the objects, by default the one of
+                      the module-level functions
+    :param propagate: (keyword only) also replace the forced values of the objects, and evaluate
+                      what they decide, so that only the open part of the problem is left
+    :return: a list of equisatisfiable constraints
+    """
+    ws = kwargs.pop('workspace', None) or _default_workspace
+    propagate = kwargs.pop('propagate', False)
+    _consolas_assert(not kwargs, 'Unexpected arguments %s' % kwargs.keys())
+    _consolas_assert(ws.config_generated(), 'Grounding can be only used after all objects are defined '
+                                          'and the object constraints are generated')
+    if not constraints:
+        constraints = ws.meta_constraints + ws.config_constraints
+    if ws.encoding == 'enum':  # the terms built before and after the sorts are generated
+        constraints = ws.encode(*constraints)
+    grounder = _Grounder(ws, propagate)
+    result = []
+    for c in constraints:
+        if isinstance(c, ConsolasElement):
+            c = c.z3()
+        g = grounder.ground(c)
+        if not is_true(g):
+            result.append(g)
+    if ws.encoding == 'enum':  # the enumeration sorts are already closed
+        result.extend(e if v else Not(e) for e, v in grounder.folded.values())
+        result.extend(e == v for e, v in grounder.known.values())
+        return ws.encode(*result)
+    result.extend(grounder.closure(result))
+    result.append(Distinct(*_finite_domain(ws, ws.Inst)))
+    result.append(Distinct(*_finite_domain(ws, ws.Type)))
+    result.extend(e if v else Not(e) for e, v in grounder.folded.values())
+    result.extend(e == v for e, v in grounder.known.values())
+    if grounder.open_universe:
+        o1 = Const('o1', ws.Inst)
+        t1 = Const('t1', ws.Type)
+        result.append(ForAll(o1, Or([o1 == i for i in _finite_domain(ws, ws.Inst)])))
+        result.append(ForAll(t1, Or([t1 == i for i in _finite_domain(ws, ws.Type)])))
+    return result
 
 
 ######################################################
 #
-# De-Quantifier
+# Enumerated encoding of the Type and Inst sorts
 #
 ######################################################
 
 
-def de_quantifer_single(expr):
-    _consolas_assert(isinstance(expr, QuantifierRef), "De-Quantifier only works on quantifiers")
+class _EnumEncoding:
+    """
+    Translates constraints over the uninterpreted Type and Inst sorts of a workspace
+    into constraints over two enumeration sorts, whose values are the classes and the
+    objects (plus NilType and nil). The predefined functions and the features are
+    declared again over the new sorts, with the same names.
+    """
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.predefined = dict((name, getattr(workspace, name)) for name in Workspace.PREDEFINED)
+        ctx = workspace.ctx
+        classes = workspace.classes.values() + [None]
+        objects = workspace.objects.values() + [None]
+        self.Type, type_values = EnumSort('TypeEnum', [c.name if c else 'NilType' for c in classes], ctx)
+        self.Inst, inst_values = EnumSort('InstEnum', [o.name if o else 'nil' for o in objects], ctx)
+        self._cache = {}
+        for element, value in zip(classes, type_values) + zip(objects, inst_values):
+            const = element.z3() if element else self.predefined['NilType' if value.sort() == self.Type else 'nil']
+            self._cache[const.get_id()] = (const, value)
+        self._decls = {}
+        self._fresh = 0
+
+    def translate_sort(self, sort):
+        if sort == self.predefined['Type']:
+            return self.Type
+        if sort == self.predefined['Inst']:
+            return self.Inst
+        return sort
+
+    def translate_decl(self, decl):
+        key = decl.get_id()
+        if key not in self._decls:
+            sorts = [decl.domain(i) for i in range(decl.arity())] + [decl.range()]
+            new_sorts = [self.translate_sort(s) for s in sorts]
+            if all(s.eq(n) for s, n in zip(sorts, new_sorts)):
+                self._decls[key] = (decl, decl)
+            else:
+                self._decls[key] = (decl, Function(decl.name(), *new_sorts))
+        return self._decls[key][1]
+
+    def translate(self, expr):
+        key = expr.get_id()
+        if key in self._cache:
+            return self._cache[key][1]
+        if is_quantifier(expr):
+            result = self._translate_quantifier(expr)
+        elif is_app(expr):
+            result = self._translate_app(expr)
+        else:
+            result = expr
+        # keep expr alive, otherwise Z3 may recycle its id
+        self._cache[key] = (expr, result)
+        return result
+
+    def _translate_quantifier(self, expr):
+        _consolas_assert(expr.is_forall() or expr.is_exists(), 'Lambdas are not supported by the enum encoding')
+        nvars = expr.num_vars()
+        consts = []
+        for i in range(nvars):
+            self._fresh += 1
+            const = Const('%s!e%d' % (expr.var_name(i), self._fresh), expr.var_sort(i))
+            new_const = Const(str(const), self.translate_sort(expr.var_sort(i)))
+            self._cache[const.get_id()] = (const, new_const)
+            consts.append((const, new_const))
+        body = substitute_vars(expr.body(), *[c for c, _ in reversed(consts)])
+        body = self.translate(body)
+        quantifier = ForAll if expr.is_forall() else Exists
+        return quantifier([n for _, n in consts], body)
+
+    def _translate_app(self, expr):
+        decl = expr.decl()
+        args = [self.translate(c) for c in expr.children()]
+        kind = decl.kind()
+        if kind == Z3_OP_UNINTERPRETED:
+            return self.translate_decl(decl)(*args)
+        if all(a.eq(c) for a, c in zip(args, expr.children())):
+            return expr
+        if kind == Z3_OP_EQ:
+            return args[0] == args[1]
+        if kind == Z3_OP_DISTINCT:
+            return Distinct(*args)
+        if kind == Z3_OP_ITE:
+            return If(*args)
+        return _mk_app(decl, args)
 
 
 ######################################################
@@ -921,32 +2504,1002 @@ def de_quantifer_single(expr):
 #
 ########################################################
 
-def cast_object(object_, model):
-    result = {}
-    result['name'] = object_.name
-    result['alive'] = str(model.eval(alive(object_.z3()))) == 'True'
+class ModelDecoder:
+    """
+    Decodes a Z3 model into object and feature values.
 
-    result['type'] = None
-    for class_ in _all_classes.values():
-        if str(model.eval(actual_type(object_.z3()) == class_.z3())) == 'True':
-            result['type'] = str(class_)
-            break
+    Every object constant is evaluated once, and model elements are mapped back to
+    objects through their ids, so a reference is decoded by one evaluation per object
+    instead of comparing it with each object. A feature function is read from its
+    interpretation when the model gives it as an explicit table.
+    The same is done for classes, so the actual type of an object costs a single evaluation.
+    """
 
+    def __init__(self, model, workspace=None):
+        """
+        :param model: a Z3 model
+        :param workspace: the workspace of the objects, by default the one of the module-level functions
+        """
+        self.model = model
+        self.workspace = workspace if workspace is not None else _default_workspace
+        self._objects = {}
+        for object_ in self.workspace.objects.values():
+            self._objects[self.eval(object_.z3()).get_id()] = object_
+        self._classes = {}
+        for class_ in self.workspace.classes.values():
+            self._classes[self.eval(class_.z3()).get_id()] = class_
+        self._interps = {}
+        self._values = {}
+        self._types = {}
+        self._alive = {}
+        self._by_type = None
+
+    def eval(self, expr):
+        """Evaluates an expression in the model, in the encoding of the workspace"""
+        return self.model.eval(self.workspace._encode_expr(expr))
+
+    def object_of(self, value):
+        """The object denoted by a model element, or None for nil"""
+        return self._objects.get(value.get_id())
+
+    def class_of(self, value):
+        """The class denoted by a model element, or None for NilType"""
+        return self._classes.get(value.get_id())
+
+    def type_of(self, object_):
+        """The class of an object in this model, or None if it is not decided"""
+        if object_.name not in self._types:
+            value = self.eval(self.workspace.actual_type(object_.z3()))
+            self._types[object_.name] = self.class_of(value)
+        return self._types[object_.name]
+
+    def is_alive(self, object_):
+        if object_.name not in self._alive:
+            self._alive[object_.name] = is_true(self.eval(self.workspace.alive(object_.z3())))
+        return self._alive[object_.name]
+
+    def alive_objects(self):
+        return [o for o in self.workspace.objects.values() if self.is_alive(o)]
+
+    def objects_by_type(self):
+        """The alive objects indexed by the name of their actual class"""
+        if self._by_type is None:
+            self._by_type = {}
+            for object_ in self.alive_objects():
+                class_ = self.type_of(object_)
+                if class_ is not None:
+                    self._by_type.setdefault(class_.name, []).append(object_)
+        return self._by_type
+
+    def instances_of(self, class_):
+        """The alive objects whose actual class is class_ or one of its subclasses"""
+        result = []
+        for name, objects in self.objects_by_type().items():
+            sub = self.workspace.classes[name]
+            if sub == class_ or class_ in get_ancestors(sub):
+                result.extend(objects)
+        return result
 
-    for feature in object_.type.get_all_feature_names():
-        v = object_.cast(feature, model)
-        result[feature] = v
+    def _interp(self, feature):
+        """
+        The explicit interpretation of a feature function, as a dictionary from argument ids
+        to values plus an else value. None if the model gives it as a symbolic expression.
+        """
+        name = (feature.parent.name, feature.name)  # features of different classes may share a name
+        if name not in self._interps:
+            self._interps[name] = None
+            interp = self.model[self.workspace._encode_decl(feature.z3())]
+            if isinstance(interp, FuncInterp) and not _is_symbolic(interp.else_value()):
+                table = {}
+                for i in range(interp.num_entries()):
+                    entry = interp.entry(i)
+                    args = tuple(entry.arg_value(j).get_id() for j in range(entry.num_args()))
+                    table[args] = entry.value()
+                self._interps[name] = (table, interp.else_value())
+        return self._interps[name]
+
+    def _apply(self, feature, *args):
+        interp = self._interp(feature)
+        if interp is None:
+            return self.eval(feature.z3()(*[a.z3() for a in args]))
+        table, else_value = interp
+        key = tuple(self.eval(a.z3()).get_id() for a in args)
+        return table.get(key, else_value)
+
+    def _candidates(self, type_):
+        """The objects that can be in a multi-valued reference to type_"""
+        return self.workspace.may_be_instances(type_)
+
+    def cast(self, object_, feature):
+        feature = object_.type.get_feature(feature)
+        if not feature:
+            return None
+        key = (object_.name, feature.name)
+        if key not in self._values:
+            self._values[key] = self._decode(object_, feature)
+        return self._values[key]
 
-    return result
+    def _decode(self, object_, feature):
+        if feature.is_attribute() and not feature.multiple:  #TODO integer set
+            result = self._apply(feature, object_)
+            if is_bool(result):
+                return is_true(result)
+            if is_int_value(result):
+                return result.as_long()
+            return str(result) # suppose it is an enum item
+        elif feature.is_reference() and not feature.multiple:
+            target = self.object_of(self._apply(feature, object_))
+            return str(target) if target is not None else None
+        elif feature.bitvector:
+            bits = self._apply(feature, object_)
+            value = bits.as_long() if is_bv_value(bits) else 0
+            return [str(o) for k, o in enumerate(self.workspace.set_members(feature.type)) if value >> k & 1]
+        elif feature.is_reference() and feature.multiple:
+            return [str(o) for o in self._candidates(feature.type) if is_true(self._apply(feature, object_, o))]
+        return None
+
+
+def _is_symbolic(expr):
+    if is_var(expr) or is_quantifier(expr):
+        return True
+    return any(_is_symbolic(c) for c in expr.children())
+
+
+class DecodedObject:
+    """
+    A read-only, dictionary-like view of an object in a model. Features are decoded
+    when they are accessed, and cached by the decoder.
+    """
+
+    def __init__(self, decoder, object_, features=None):
+        self.decoder = decoder
+        self.object_ = object_
+        names = object_.type.get_all_feature_names()
+        if features is not None:
+            names = [f for f in names if f in features]
+        self._keys = ['name', 'alive', 'type'] + names
+
+    def __getitem__(self, key):
+        if key == 'name':
+            return self.object_.name
+        if key == 'alive':
+            return self.decoder.is_alive(self.object_)
+        if key == 'type':
+            class_ = self.decoder.type_of(self.object_)
+            return str(class_) if class_ is not None else None
+        if key not in self._keys:
+            raise KeyError(key)
+        return self.decoder.cast(self.object_, key)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def get(self, key, default=None):
+        return self[key] if key in self._keys else default
+
+    def iteritems(self):
+        for key in self._keys:
+            yield key, self[key]
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class DecodedModel:
+    """
+    A lazy, dictionary-like view of the alive objects in a model, as returned by
+    cast_all_objects, but nothing is decoded before it is accessed.
+
+    >>> result = decode_model(solver.model(), features=['deploy'])
+    >>> result['web1']['deploy']
+    >>> for name, obj in result.iteritems(): # decodes one object at a time
+    ...     yaml.dump({name: obj}, stream)
+    """
+
+    def __init__(self, model, objects=None, features=None):
+        """
+        :param model: a Z3 model or a ModelDecoder
+        :param objects: only decode these objects (names or Objects)
+        :param features: only decode these features (names)
+        """
+        self.decoder = model if isinstance(model, ModelDecoder) else ModelDecoder(model)
+        self._names = None if objects is None else set(str(o) for o in objects)
+        self._features = None if features is None else set(features)
+        self._objects = {}
+
+    def _selected(self, object_):
+        return (self._names is None or object_.name in self._names) and self.decoder.is_alive(object_)
+
+    def __getitem__(self, name):
+        if name not in self._objects:
+            object_ = self.decoder.workspace.objects.get(name)
+            if object_ is None or not self._selected(object_):
+                raise KeyError(name)
+            self._objects[name] = DecodedObject(self.decoder, object_, self._features)
+        return self._objects[name]
+
+    def __contains__(self, name):
+        object_ = self.decoder.workspace.objects.get(name)
+        return object_ is not None and self._selected(object_)
+
+    def __iter__(self):
+        for object_ in self.decoder.workspace.objects.values():
+            if self._selected(object_):
+                yield object_.name
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self[name] for name in self]
+
+    def iteritems(self):
+        """Generates (name, dict) pairs, decoding one object at a time"""
+        for name in self:
+            yield name, self[name].to_dict()
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def resolve(self, expr):
+        """The decoded object that an object expression (e.g. an ObjectConst) points to"""
+        object_ = self.decoder.object_of(self.decoder.eval(expr.z3()))
+        if object_ is None or object_.name not in self:
+            return None
+        return self[object_.name]
+
+
+def decode_model(model, objects=None, features=None):
+    return DecodedModel(model, objects, features)
+
+
+def cast_object(object_, model):
+    if not isinstance(model, ModelDecoder):
+        model = ModelDecoder(model, object_.workspace)
+    return DecodedObject(model, object_).to_dict()
 
 
 def cast_all_objects(model):
-    result = {}
-    for object_ in _all_objects.values():
-        v = cast_object(object_, model)
-        if v['alive']:
-            result[v['name']] = v
-    return result
+    return DecodedModel(model).to_dict()
+
+
+######################################################
+#
+# Enumerating solutions
+#
+######################################################
 
 
+def _projection(workspace, item):
+    """
+    The terms that a projected item stands for, as (guard, terms) pairs: the terms only count
+    in a model where the guard holds, or always if it is None
+    """
+    ws = workspace
+    if isinstance(item, ForceValueSeed):  # e.g. Service.deploy, on every object that may be a Service
+        feature = item.type_.get_feature(item.feature)
+        _consolas_assert(not (feature.is_attribute() and feature.multiple),
+                         'The multi-valued attribute %s cannot be projected' % feature.name)
+        result = []
+        for object_ in ws.may_be_instances(item.type_):
+            guard = And(ws.alive(object_.z3()), ws.is_instance(object_.z3(), item.type_.z3()))
+            if feature.multiple and not feature.bitvector:
+                terms = [feature.z3()(object_.z3(), o.z3()) for o in ws.may_be_instances(feature.type)]
+            else:
+                terms = [feature.z3()(object_.z3())]
+            result.append((guard, terms))
+        return result
+    if isinstance(item, SetExpr):  # e.g. wanted.features
+        _consolas_assert(isinstance(item.type, Class), 'Only sets of objects can be projected')
+        return [(None, [item.contains(o.get_constant()) for o in ws.may_be_instances(item.type)])]
+    if isinstance(item, Object):
+        return [(None, [ws.actual_type(item.z3()), ws.alive(item.z3())])]
+    if isinstance(item, ConsolasElement):
+        return [(None, [item.z3()])]
+    return [(None, [item])]
+
+
+def _default_projection(workspace):
+    """Every feature of every class, and the type of every object"""
+    items = []
+    for class_ in workspace.classes.values():
+        if class_ is not None:
+            items += [ForceValueSeed(class_, f) for f in class_.references]
+            items += [ForceValueSeed(class_, a.name) for a in class_.attributes.values() if not a.multiple]
+    return items + workspace.objects.values()
+
+
+def _model_value(decoder, term):
+    """
+    The value of a term in a model, as an expression that keeps it in the next models: the elements
+    of the uninterpreted Inst and Type sorts are given back as the object or class they stand for
+    """
+    ws = decoder.workspace
+    value = decoder.model.eval(term, model_completion=True)
+    if ws.encoding == 'enum':
+        return value
+    if value.sort() == ws.Inst:
+        object_ = decoder.object_of(value)
+        return object_.z3() if object_ is not None else ws.nil
+    if value.sort() == ws.Type:
+        class_ = decoder.class_of(value)
+        return class_.z3() if class_ is not None else ws.NilType
+    return value
 
+
+_NO_TIMEOUT = 4294967295  # the default timeout of Z3 (in ms), i.e. none
+
+
+def enumerate_models(solver, project=None, limit=None, timeout=None, workspace=None):
+    """
+    Generates the solutions of the solver that differ on the projected items, decoded lazily
+    as DecodedModels. After each solution, a clause blocking its projection is added, so the
+    solver keeps what it learnt. The clauses are removed (solver.pop) when the generator ends.
+
+    >>> for result in enumerate_models(solver, project=[Service.deploy, wanted.features], limit=10):
+    ...     print result['srv_web']['deploy']
+
+    :param project: the items that make two solutions different. A feature of a class (Service.deploy)
+                    stands for its value on every object that can be an instance of the class, and
+                    only when the object is alive and is one. A set (wanted.features) stands for its
+                    items, an object for its type and whether it is alive, and an object expression
+                    (wanted) or a Z3 expression for its value. By default, all the features and objects.
+    :param limit: the largest number of solutions
+    :param timeout: in seconds, for the whole enumeration. It is set on the solver before each check,
+                    and the solver is given back without a timeout when the generator ends
+    """
+    ws = workspace if workspace is not None else _default_workspace
+    items = project if project is not None else _default_projection(ws)
+    groups = []
+    for item in items:
+        for guard, terms in _projection(ws, item):
+            groups.append((None if guard is None else ws._encode_expr(guard), [ws._encode_expr(t) for t in terms]))
+    deadline = None if timeout is None else time.time() + timeout
+    count = 0
+    solver.push()
+    try:
+        while limit is None or count < limit:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                solver.set('timeout', max(int(remaining * 1000), 1))
+            if solver.check() != sat:
+                return
+            decoder = ModelDecoder(solver.model(), ws)
+            count += 1
+            blocking = []
+            for guard, terms in groups:
+                if guard is not None and not is_true(decoder.model.eval(guard, model_completion=True)):
+                    blocking.append(guard)
+                    continue
+                if guard is not None:
+                    blocking.append(Not(guard))
+                blocking.extend(t != _model_value(decoder, t) for t in terms)
+            yield DecodedModel(decoder)
+            if not blocking:  # nothing is projected, all the solutions are the same
+                return
+            solver.add(Or(blocking))
+    finally:
+        solver.pop()
+        if deadline is not None:
+            solver.set('timeout', _NO_TIMEOUT)
+
+
+def _atoms(workspace, item):
+    """
+    A projected item as named Boolean atoms, whose coverage and differences are counted:
+    a reference stands for the pairs of an object and an item it may refer to
+    """
+    ws = workspace
+    if isinstance(item, tuple):  # (name, Boolean expression)
+        name, expr = item
+        return [(name, expr.z3() if isinstance(expr, ConsolasElement) else expr)]
+    if isinstance(item, ForceValueSeed):
+        feature = item.type_.get_feature(item.feature)
+        _consolas_assert(feature.is_reference() or feature.type == BoolSort(ws.ctx),
+                         'Only references and Boolean attributes make atoms, not %s' % feature.name)
+        result = []
+        for object_ in ws.may_be_instances(item.type_):
+            guard = And(ws.alive(object_.z3()), ws.is_instance(object_.z3(), item.type_.z3()))
+            if feature.is_attribute():
+                result.append(('%s.%s' % (object_, feature.name), And(guard, feature.z3()(object_.z3()))))
+                continue
+            for target in ws.may_be_instances(feature.type):
+                if feature.bitvector:
+                    atom = SetExpr.of_bits(feature.z3()(object_.z3()), feature.type).contains(target.get_constant())
+                elif feature.multiple:
+                    atom = feature.z3()(object_.z3(), target.z3())
+                else:
+                    atom = feature.z3()(object_.z3()) == target.z3()
+                result.append(('%s.%s:%s' % (object_, feature.name, target), And(guard, atom)))
+        return result
+    if isinstance(item, SetExpr):
+        _consolas_assert(isinstance(item.type, Class), 'Only sets of objects make atoms')
+        return [(o.name, item.contains(o.get_constant())) for o in ws.may_be_instances(item.type)]
+    if isinstance(item, Object):
+        return [('%s:%s' % (item, c), item.isinstance(c)) for c in ws._subclasses_of()[item.type.name]] + \
+               [('%s.alive' % item, item.alive())]
+    expr = item.z3() if isinstance(item, ConsolasElement) else item
+    _consolas_assert(is_bool(expr), 'Only Boolean expressions make atoms, not %s' % expr)
+    return [(str(expr), expr)]
+
+
+class DiverseSolution:
+    """One of the solutions of diverse_models, with the projected atoms it covers"""
+
+    def __init__(self, model, workspace, names, values, covered, seconds):
+        self.model = model
+        self.result = DecodedModel(ModelDecoder(model, workspace))
+        self.values = values
+        self.covered = [n for n, v in zip(names, values) if v]
+        self.new = [n for n in self.covered if n not in covered]
+        self.seconds = seconds
+
+
+def diverse_models(solver, project, k=None, objective='coverage', joint=False, optimize_first=True, workspace=None):
+    """
+    Finds k solutions of an Optimize that together cover as many projected atoms as possible,
+    or that differ on as many of them as possible.
+
+    >>> for solution in diverse_models(solver, [wanted.features], 10):
+    ...     print solution.new, solution.result.resolve(wanted)['features']
+
+    By default the solutions are found one after the other, each maximizing what the previous
+    ones did not cover. Its objective is removed (solver.pop) before the next one, so every
+    check has one objective. With joint=True, project is a list of k projections of the same shape,
+    on copies of the solution already constrained in the solver (e.g. wanted0.features,
+    wanted1.features, ...), and the k solutions are found by a single check.
+
+    :param project: the items of which the atoms are counted. A set (wanted.features) gives the
+                    membership of each object, a reference of a class (Service.image) each pair
+                    of objects, a Boolean attribute its value, an object its types and whether it is
+                    alive, and a (name, Boolean expression) pair the expression.
+    :param k: the number of solutions. By default, for the coverage, as many as there are solutions
+              that cover atoms not covered before
+    :param objective: 'coverage', the number of atoms true in some solution, or 'hamming', the
+                      number of atoms that differ between two solutions, summed over all pairs
+    :param optimize_first: with False, the first solution is found by a plain check, without objective,
+                           e.g. when the constraints are quantified and Z3 does not optimize them well
+    :return: a list of DiverseSolutions, with fewer than k if the solutions run out
+    """
+    _consolas_assert(isinstance(solver, Optimize), 'Diverse solutions are found with an Optimize')
+    _consolas_assert(objective in ('coverage', 'hamming'), 'Unknown diversity objective %s' % objective)
+    _consolas_assert(k is not None or joint or objective == 'coverage',
+                     'The number of solutions is required for the hamming objective')
+    ws = workspace if workspace is not None else _default_workspace
+    count = lambda atoms: Sum([If(a, 1, 0) for a in atoms]) if atoms else IntVal(0, ws.ctx)
+    copies = project if joint else [project]
+    named = [[(n, ws._encode_expr(a)) for item in items for n, a in _atoms(ws, item)] for items in copies]
+    names = [n for n, a in named[0]]
+    atoms = [[a for n, a in copy] for copy in named]
+    _consolas_assert(all(len(c) == len(names) for c in atoms), 'The joint projections must have the same shape')
+    solutions = []
+    covered = set()
+    solver.push()
+    try:
+        if joint:
+            for left, right in itertools.combinations(atoms, 2):
+                solver.add(Or([a != b for a, b in zip(left, right)]))
+            if objective == 'coverage':
+                solver.maximize(count([Or(list(c)) for c in zip(*atoms)]))
+            else:
+                solver.maximize(count([a != b for left, right in itertools.combinations(atoms, 2)
+                                       for a, b in zip(left, right)]))
+            start = time.time()
+            if solver.check() == sat:
+                model = solver.model()
+                seconds = time.time() - start
+                for copy in atoms:
+                    values = [is_true(model.eval(a, model_completion=True)) for a in copy]
+                    solutions.append(DiverseSolution(model, ws, names, values, covered, seconds))
+                    covered.update(solutions[-1].covered)
+            return solutions
+        atoms = atoms[0]
+        for i in (range(k) if k is not None else itertools.count()):
+            solver.push()
+            if solutions or optimize_first:
+                if objective == 'coverage':
+                    solver.maximize(count([a for n, a in zip(names, atoms) if n not in covered]))
+                else:
+                    solver.maximize(count([a != BoolVal(v, ws.ctx) for s in solutions for a, v in zip(atoms, s.values)]))
+            start = time.time()
+            status = solver.check()
+            seconds = time.time() - start
+            model = solver.model() if status == sat else None
+            solver.pop()
+            if model is None:
+                break
+            values = [is_true(model.eval(a, model_completion=True)) for a in atoms]
+            solution = DiverseSolution(model, ws, names, values, covered, seconds)
+            if k is None and not solution.new:  # the coverage does not improve any more
+                break
+            solutions.append(solution)
+            covered.update(solution.covered)
+            # the next solutions differ from this one on the atoms
+            solver.add(Or([Not(a) if v else a for a, v in zip(atoms, values)] + [BoolVal(False, ws.ctx)]))
+        return solutions
+    finally:
+        solver.pop()
+
+
+######################################################
+#
+# Writing constraints to SMT-LIB2 files
+#
+######################################################
+
+
+def _toplevel_forms(text):
+    """Splits SMT-LIB2 text into its top-level s-expressions"""
+    forms, depth, start, quoted = [], 0, None, None
+    for i, c in enumerate(text):
+        if quoted:
+            if c == quoted:
+                quoted = None
+        elif c in '|"':
+            quoted = c
+        elif c == '(':
+            if depth == 0:
+                start = i
+            depth += 1
+        elif c == ')':
+            depth -= 1
+            if depth == 0:
+                forms.append(text[start:i + 1])
+    return forms
+
+
+class SmtLibWriter:
+    """
+    A sink for Workspace.stream_to, writing the constraints to an SMT-LIB2 file as they
+    are added. Sorts and functions are declared once, before their first use.
+
+    >>> with open('model.smt2', 'w') as stream:
+    ...     ws.stream_to(SmtLibWriter(stream, ws.ctx))
+    ...     ws.generate_meta_constraints()
+    """
+
+    def __init__(self, stream, ctx=None):
+        self.stream = stream
+        self.ctx = ctx if ctx is not None else main_ctx()
+        self._declared = set()
+
+    def add(self, *constraints):
+        solver = Solver(ctx=self.ctx)
+        solver.add(*constraints)
+        for form in _toplevel_forms(solver.sexpr()):
+            if form.startswith('(assert'):
+                self.stream.write(form + '\n')
+            elif form not in self._declared:
+                self._declared.add(form)
+                self.stream.write(form + '\n')
+
+
+######################################################
+#
+# Caching the generated constraints on disk
+#
+######################################################
+
+
+class ConstraintCache:
+    """
+    The meta and config constraints of a workspace, saved in SMT-LIB2 under a key,
+    usually the fingerprint of the workspace. Loading them back is one parse per file
+    instead of building every term again through the Python API.
+
+    >>> cache = ConstraintCache('.cache')
+    >>> key = get_default_workspace().fingerprint(open(__file__).read())
+    >>> if not cache.load(key):
+    >>>     generate_config_constraints()
+    >>>     meta_facts(...)
+    >>>     cache.save(key)
+    """
+
+    PARTS = ('meta', 'config')
+
+    def __init__(self, directory, workspace=None):
+        self.directory = directory
+        self.workspace = workspace if workspace is not None else _default_workspace
+
+    def _path(self, key, part):
+        return os.path.join(self.directory, '%s.%s.smt2' % (key, part))
+
+    def load(self, key):
+        """Restores the constraints saved under key into the workspace. Returns False on a miss"""
+        paths = [self._path(key, part) for part in ConstraintCache.PARTS]
+        if not all(os.path.exists(path) for path in paths):
+            return False
+        meta, config = [self._parse(path) for path in paths]
+        self.workspace.restore_facts(meta, config)
+        return True
+
+    def save(self, key):
+        ws = self.workspace
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        for part, constraints in zip(ConstraintCache.PARTS, (ws.meta_constraints, ws.config_constraints)):
+            solver = Solver(ctx=ws.ctx)
+            solver.add(*constraints)
+            path = self._path(key, part)
+            with open(path + '.tmp', 'w') as stream:
+                stream.write(solver.sexpr())
+            os.rename(path + '.tmp', path)  # never leave a partial file under the key
+
+    def _parse(self, path):
+        with open(path, 'r') as stream:
+            return [e for e in parse_smt2_string(stream.read(), ctx=self.workspace.ctx)]
+
+
+######################################################
+#
+# Caching solve results
+#
+######################################################
+
+
+class SolveResult:
+    """
+    The outcome of a check, the same whether it was solved or found in a ResultCache.
+
+    status: 'sat', 'unsat' or 'unknown'
+    objects: the decoded objects of a sat result, as returned by cast_all_objects
+    core: the unsat core of an unsat result, as strings
+    objectives: the values of the objectives of an Optimize, as listed by its objectives()
+    """
+
+    def __init__(self, status, objects=None, core=None, objectives=None):
+        self.status = status
+        self.objects = objects
+        self.core = core
+        self.objectives = objectives
+
+    def to_dict(self):
+        return {'status': self.status, 'objects': self.objects, 'core': self.core, 'objectives': self.objectives}
+
+    def __eq__(self, other):
+        return isinstance(other, SolveResult) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'SolveResult(%s)' % self.to_dict()
+
+
+def _from_json(value):
+    """json gives unicode strings, but a fresh result has str"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_from_json(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_from_json(k), _from_json(v)) for k, v in value.items())
+    return value
+
+
+class ResultCache:
+    """
+    Results of checks, keyed by a hash of the assertions (in any order), the assumptions
+    and the objectives of the solver. A hit does not call Z3 at all. The results are kept
+    in memory, and in a directory if one is given, each up to capacity entries with the
+    least recently used ones evicted first. Unknown results are never cached.
+
+    >>> cache = ResultCache('.results')
+    >>> result = cache.check(solver, *assumptions)
+    >>> if result.status == 'sat':
+    ...     print result.objects['vm1']['host']
+    """
+
+    def __init__(self, directory=None, capacity=128, workspace=None):
+        self.directory = directory
+        self.capacity = capacity
+        self.workspace = workspace if workspace is not None else _default_workspace
+        self._entries = _Lru(capacity)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, solver, *assumptions):
+        objectives = solver.objectives() if isinstance(solver, Optimize) else []
+        content = [
+            self.workspace.fingerprint(),
+            solver.__class__.__name__,
+            sorted(a.sexpr() for a in solver.assertions()),
+            sorted(a.sexpr() for a in assumptions),
+            [o.sexpr() for o in objectives]
+        ]
+        return hashlib.sha1(repr(content)).hexdigest()
+
+    def check(self, solver, *assumptions):
+        """solver.check(*assumptions) as a SolveResult, unless the same check is cached"""
+        key = self.key(solver, *assumptions)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return result
+        self.misses += 1
+        result = self._solve(solver, assumptions)
+        if result.status != 'unknown':
+            self.put(key, result)
+        return result
+
+    def _solve(self, solver, assumptions):
+        status = solver.check(*assumptions)
+        if status == sat:
+            model = solver.model()
+            objectives = solver.objectives() if isinstance(solver, Optimize) else []
+            values = [model.eval(o, model_completion=True) for o in objectives]
+            return SolveResult('sat', DecodedModel(ModelDecoder(model, self.workspace)).to_dict(),
+                               objectives=[v.as_long() if is_int_value(v) else str(v) for v in values])
+        if status == unsat:
+            return SolveResult('unsat', core=sorted(str(c) for c in solver.unsat_core()))
+        return SolveResult('unknown')
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        result = self._entries.get(key)
+        if result is not None:
+            return result
+        if self.directory is None or not os.path.exists(self._path(key)):
+            return None
+        with open(self._path(key), 'r') as stream:
+            result = SolveResult(**_from_json(json.load(stream)))
+        os.utime(self._path(key), None)
+        self._entries.put(key, result)
+        return result
+
+    def put(self, key, result):
+        self._entries.put(key, result)
+        if self.directory is None:
+            return
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        with open(self._path(key) + '.tmp', 'w') as stream:
+            json.dump(result.to_dict(), stream)
+        os.rename(self._path(key) + '.tmp', self._path(key))
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.json')]
+        for path in sorted(files, key=os.path.getmtime)[:max(len(files) - self.capacity, 0)]:
+            os.remove(path)
+
+
+######################################################
+#
+# Searching the number of objects
+#
+######################################################
+
+
+class ScopeSearch:
+    """
+    Finds the smallest number of suspended objects of a class that makes the constraints
+    satisfiable, instead of guessing it. It starts with a few objects and adds one after each
+    unsat answer, keeping the solver and its facts: only the closure axiom on the objects depends
+    on their number, and each version of it is guarded by a literal, assumed while it is the
+    current one.
+
+    >>> search = ScopeSearch(Node, 'sn', start=1, limit=20)
+    >>> solver.add(generate_meta_constraints())
+    >>> solver.add(search.generate_config_constraints())
+    >>> solver.add(...)
+    >>> size, status = search.check(solver)
+
+    The other constraints must hold for any number of objects, i.e. they cannot use count(),
+    sum() or ground_facts(), which expand over the objects defined at the time.
+    """
+
+    def __init__(self, type_, prefix, start=1, limit=None, symmetric=True):
+        """
+        :param type_: the class of the objects to add, e.g. a Node or a BuildImage
+        :param prefix: the objects are named prefix0, prefix1, ...
+        :param start: the number of objects of the first check
+        :param limit: the largest number of objects to try, no limit by default
+        :param symmetric: the objects are interchangeable, see Workspace.DefineObjects
+        """
+        ws = type_.workspace
+        _consolas_assert(ws.encoding != 'enum', 'The number of objects cannot change in the enum encoding')
+        _consolas_assert(not ws.config_generated(), 'A scope search defines its objects before the object constraints')
+        _consolas_assert(limit is None or start <= limit, 'The scope search starts above its limit')
+        kinds = ws._subclasses_of()[type_.name] + get_ancestors(type_)
+        _consolas_assert(not [r for c in kinds for r in c.references.values() if r.closure or r.root],
+                         'The closure or root of a reference cannot follow the new objects')
+        self.workspace = ws
+        self.type = type_
+        self.prefix = prefix
+        self.limit = limit
+        self.objects = []
+        for i in range(start):
+            self._define()
+        if symmetric:
+            ws._pools.append(self.objects)
+        self.symmetric = symmetric
+
+    def _define(self):
+        object_ = self.workspace.DefineObject('%s%d' % (self.prefix, len(self.objects)), self.type, suspended=True)
+        self.objects.append(object_)
+        return object_
+
+    def _literal(self):
+        return Bool('%s!scope%d' % (self.prefix, len(self.objects)), self.workspace.ctx)
+
+    def generate_config_constraints(self, backend='z3'):
+        """The object constraints, with the closure axiom of the first check"""
+        self.workspace._scope_literal = self._literal()
+        try:
+            return self.workspace.generate_config_constraints(backend)
+        finally:
+            self.workspace._scope_literal = None
+
+    def check(self, solver, *assumptions):
+        """
+        :return: the number of objects, and the status of the first check that was not unsat,
+                 or unsat at the limit
+        """
+        while True:
+            status = solver.check(self._literal(), *assumptions)
+            if status != unsat or (self.limit is not None and len(self.objects) >= self.limit):
+                return len(self.objects), status
+            solver.add(*self._grow())
+
+    def _grow(self):
+        """The facts of a new object, and the closure axiom with it, for the solver only"""
+        ws = self.workspace
+        previous = ws.objects.values()
+        object_ = self._define()
+        o1 = Const('o1', ws.Inst)
+        everything = [o.z3() for o in ws.objects.values()] + [ws.nil]
+        facts = [And([object_.z3() != o.z3() for o in previous] + [object_.z3() != ws.nil]),
+                 object_.get_constant().isinstance(self.type),
+                 ws._instance_facts(object_, ws._subclasses_of()),
+                 Implies(self._literal(), ForAll(o1, Or([o1 == i for i in everything])))]
+        if self.symmetric and len(self.objects) > 1:
+            members = set(o.name for o in self.objects)
+            facts.append(_lex_leq(ws._symmetry_keys(self.objects[-2], self.type, members),
+                                  ws._symmetry_keys(object_, self.type, members)))
+        return facts
+
+
+######################################################
+#
+# Optimization sessions
+#
+######################################################
+
+
+class _Scope:
+
+    def __init__(self, literal):
+        self.literal = literal
+        self.objectives = []
+        self.soft = []
+
+
+class OptimizeSession:
+    """
+    An Optimize that keeps the meta and object constraints, asserted once, and gets the objectives
+    and soft facts of the scopes enabled for each check only. They are removed (pop) after the check,
+    so objectives no longer pile up from one query to the next. The hard constraints of a scope stay
+    in the solver, guarded by a literal that is assumed when the scope is enabled.
+
+    >>> session = OptimizeSession()
+    >>> session.add(wanted.alive())
+    >>> session.maximize(wanted.features.count(), scope='rich', name='features')
+    >>> session.minimize(wanted['price'], scope='cheap', name='price')
+    >>> session.check('rich')
+    >>> session.check('cheap', 'rich')  # lexicographic: first the price, then the features
+    >>> session.values['price'], session.times['price']
+
+    times gives the total time spent on each objective, and on the checks without objectives (None).
+    """
+
+    def __init__(self, facts=None, workspace=None):
+        """
+        :param facts: the base constraints, by default all the meta and object constraints
+        :param workspace: the workspace of the constraints, by default the one of the module-level functions
+        """
+        self.workspace = workspace if workspace is not None else _default_workspace
+        ws = self.workspace
+        self.solver = Optimize(ctx=ws.ctx)
+        self.solver.add(*(facts if facts is not None else ws.get_all_meta_facts() + ws.get_all_config_facts()))
+        self._scopes = {None: _Scope(None)}
+        self._literals = 0
+        self.values = {}
+        self.times = {}
+        self.status = None
+        self._model = None
+
+    def _scope(self, name):
+        if name not in self._scopes:
+            self._literals += 1
+            self._scopes[name] = _Scope(Bool('scope!%s!%d' % (name, self._literals), self.workspace.ctx))
+        return self._scopes[name]
+
+    def add(self, *constraints, **kwargs):
+        """Hard constraints, in the base or in a scope (scope=name)"""
+        literal = self._scope(kwargs.get('scope')).literal
+        for constraint in self.workspace.encode(*constraints):
+            self.solver.add(constraint if literal is None else Implies(literal, constraint))
+
+    def maximize(self, expr, scope=None, name=None):
+        self._objective('max', expr, scope, name)
+
+    def minimize(self, expr, scope=None, name=None):
+        self._objective('min', expr, scope, name)
+
+    def _objective(self, kind, expr, scope, name):
+        expr, = self.workspace.encode(expr)
+        self._scope(scope).objectives.append((name if name is not None else str(expr), kind, expr))
+
+    def add_soft(self, fact, weight=1, scope=None):
+        """A soft fact, violated at the cost of its weight. The soft facts of a scope are one objective"""
+        fact, = self.workspace.encode(fact)
+        self._scope(scope).soft.append((fact, weight))
+
+    def retract(self, scope):
+        """Removes the objectives and soft facts of a scope, and disables its hard constraints"""
+        _consolas_assert(scope in self._scopes, 'Unknown scope %s' % scope)
+        if scope is None:
+            self._scopes[None] = _Scope(None)
+            return
+        self.solver.add(Not(self._scopes.pop(scope).literal))
+
+    def check(self, *scopes):
+        """
+        Checks with the base and the given scopes enabled, and their objectives in this order of priority.
+        The objectives are optimized one after the other, each by its own check, with the optimum of
+        the ones before fixed, so times gives the time spent on each objective.
+        """
+        for scope in scopes:
+            _consolas_assert(scope in self._scopes, 'Unknown scope %s' % scope)
+        enabled = [self._scopes[s] for s in (None,) + scopes]
+        literals = [s.literal for s in enabled[1:]]
+        objectives = []
+        for scope, name in zip(enabled, (None,) + scopes):
+            objectives += scope.objectives
+            if scope.soft:  # the weight of the violated soft facts
+                penalty = Sum([If(fact, 0, weight) for fact, weight in scope.soft])
+                objectives.append(('soft' if name is None else 'soft %s' % name, 'min', penalty))
+        self.values = {}
+        self._model = None
+        self.solver.push()
+        try:
+            for objective, kind, expr in objectives or [(None, None, None)]:
+                start = time.time()
+                self.solver.push()
+                if kind is not None:
+                    handle = self.solver.maximize(expr) if kind == 'max' else self.solver.minimize(expr)
+                self.status = self.solver.check(*literals)
+                self._model = self.solver.model() if self.status == sat else None
+                value = handle.value() if self._model is not None and kind is not None else None
+                self.solver.pop()
+                self.times[objective] = self.times.get(objective, 0) + time.time() - start
+                if value is None:
+                    break
+                self.values[objective] = value.as_long() if is_int_value(value) else str(value)
+                if is_int_value(value) or is_rational_value(value):  # kept for the next objectives
+                    self.solver.add(expr >= value if kind == 'max' else expr <= value)
+            return self.status
+        finally:
+            self.solver.pop()
+
+    def model(self):
+        """The model of the last check, if it was sat"""
+        return self._model
+
+    def decode(self):
+        """The model of the last check, decoded lazily"""
+        return DecodedModel(ModelDecoder(self._model, self.workspace))
@@ -3,6 +3,22 @@ from model import *
 import re
 import pprint
 import yaml
+import tempfile
+import shutil
+import StringIO
+import itertools
+import model
+
+
+class _Tee:
+    """A sink adding the constraints to several sinks"""
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def add(self, *constraints):
+        for sink in self.sinks:
+            sink.add(*constraints)
 
 
 class TestModelCreation(unittest.TestCase):
@@ -283,15 +299,720 @@ class TestModelCreation(unittest.TestCase):
         d1, d2 = DefineObjects(['d1', 'd2'], self.DockerImage)
         self._assert_expr_in_string(
             self.Vm.forcevalue('host', [d1, d2]),
-            '''ForAll(varVm1,
-                       Implies(And(alive(varVm1), is_instance(varVm1, Vm)),
-                               And(And(host(varVm1, d1), host(varVm1, d2)),
-                                   ForAll(varDockerImage3,
-                                          Implies(host(varVm1,
-                                                       varDockerImage3),
-                                                  Or(varDockerImage3 == d1,
-                                                     varDockerImage3 == d2))))))'''
+            '''ForAll(varVm_1,
+                       Implies(And(alive(varVm_1), is_instance(varVm_1, Vm)),
+                               And(And(host(varVm_1, d1), host(varVm_1, d2)),
+                                   ForAll(varDockerImage_1,
+                                          Implies(host(varVm_1,
+                                                       varDockerImage_1),
+                                                  Or(varDockerImage_1 == d1,
+                                                     varDockerImage_1 == d2))))))'''
+        )
+
+    def test_ground_facts(self):
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu)
+        vm1 = DefineObject('vm1', self.Vm, suspended=True)
+        ubuntu1.force_value('mem', 10)
+
+        generate_meta_constraints()
+        x = ObjectVar(self.DockerImage, 'x')
+        y = ObjectVar(self.Vm, 'y')
+        meta_fact(self.DockerImage.forall(x, x['mem'] <= x['deploy']['vmem']))
+        generate_config_constraints()
+
+        self._assert_expr_in_string(
+            de_quantifer_single(self.DockerImage.forall(x, x['mem'] > 0)),
+            'mem(ubuntu1) > 0'
         )
+        self._assert_expr_in_string(
+            de_quantifer_single(self.Vm.exists(y, y['vmem'] > 0)),
+            'And(alive(vm1), vmem(vm1) > 0)'
+        )
+
+        facts = ground_facts()
+        self.assertFalse([f for f in facts if is_quantifier(f)])
+        solver = Solver()
+        solver.add(*facts)
+        self.assertEqual(sat, solver.check())
+        result = cast_all_objects(solver.model())
+        self.assertEqual('vm1', result['ubuntu1']['deploy'])
+        self.assertEqual(10, result['vm1']['vmem'])
+
+    def test_ground_propagate(self):
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu)
+        vm1 = DefineObject('vm1', self.Vm)
+        vm2 = DefineObject('vm2', self.Vm, suspended=True)
+        ubuntu1.force_value('mem', 10).force_value('deploy', vm1)
+        vm1.force_value('host', [ubuntu1]).force_value('vmem', 12)
+
+        generate_meta_constraints()
+        generate_config_constraints()
+        x = ObjectVar(self.DockerImage, 'x')
+        y = ObjectVar(self.Vm, 'y')
+        check = self.DockerImage.forall(x, x['mem'] <= x['deploy']['vmem'])
+        self.assertIn('mem(ubuntu1) <= vmem(deploy(ubuntu1))', [str(f) for f in ground_facts(check)])
+        facts = [str(f) for f in ground_facts(check, propagate=True)]
+        self.assertFalse([f for f in facts if '<=' in f])
+        self.assertIn('mem(ubuntu1) == 10', facts)
+
+        facts = ground_facts(propagate=True)
+        self.assertLess(sum(len(str(f)) for f in facts), sum(len(str(f)) for f in ground_facts()))
+        solver = Solver()
+        solver.add(*facts)
+        solver.add(*ground_facts(self.Vm.forall(y, y['host'].count() <= 1), vm2.alive(), propagate=True))
+        self.assertEqual(sat, solver.check())
+        result = cast_all_objects(solver.model())
+        self.assertEqual(10, result['ubuntu1']['mem'])
+        self.assertEqual(['ubuntu1'], result['vm1']['host'])
+        self.assertEqual([], result['vm2']['host'])
+        self.assertEqual(unsat, solver.check(*ground_facts(vm1['vmem'] < 10, propagate=True)))
+
+    def test_symmetric_pool(self):
+        vms = DefineObjects(['vm0', 'vm1', 'vm2'], self.Vm, suspended=True, symmetric=True)
+        ubuntu1, ubuntu2 = DefineObjects(['ubuntu1', 'ubuntu2'], self.Ubuntu)
+        solver = Solver()
+        solver.add(generate_meta_constraints())
+        solver.add(generate_config_constraints())
+        solver.add(ubuntu1['deploy'] != ubuntu2['deploy'])
+
+        self.assertEqual(sat, solver.check())
+        alive = [is_true(solver.model().eval(vm.alive())) for vm in vms]
+        self.assertEqual(sorted(alive, reverse=True), alive)
+        self.assertEqual(unsat, solver.check(vms[2].alive(), Not(vms[1].alive())))
+        same = [vms[0]['price'] == vms[1]['price'], vms[0].sametype(vms[1])]
+        self.assertEqual(sat, solver.check(vms[0]['vmem'] < vms[1]['vmem'], *same))
+        self.assertEqual(unsat, solver.check(vms[0]['vmem'] > vms[1]['vmem'], *same))
+
+        vms[0].force_value('vmem', 3)
+        self.assertRaises(ConsolasException, generate_config_constraints)
+
+    def test_scope_search(self):
+        ubuntus = DefineObjects(['ubuntu1', 'ubuntu2', 'ubuntu3'], self.Ubuntu)
+        search = ScopeSearch(self.Vm, 'vm', start=1, limit=4)
+        solver = Solver()
+        solver.add(generate_meta_constraints())
+        solver.add(search.generate_config_constraints())
+        solver.add(And([a['deploy'] != b['deploy'] for a, b in itertools.combinations(ubuntus, 2)]))
+        size = len(get_all_config_facts())
+
+        self.assertEqual((3, sat), search.check(solver))
+        result = cast_all_objects(solver.model())
+        self.assertEqual(['vm0', 'vm1', 'vm2'], sorted(result[u.name]['deploy'] for u in ubuntus))
+        # the facts asserted so far are kept as the scope grows
+        many = lambda n: And([And(v.isinstance(self.Vm), v.alive()) for v in ObjectConsts(self.Vm, *'vwxyz'[:n])] +
+                             [Distinct([v.z3() for v in ObjectConsts(self.Vm, *'vwxyz'[:n])])])
+        self.assertEqual((3, sat), search.check(solver, many(3)))
+        self.assertEqual((4, sat), search.check(solver, many(4)))
+        self.assertEqual((4, unsat), search.check(solver, many(5)))
+        self.assertEqual(4, len(search.objects))
+        # the facts of the new objects went to the solver only
+        self.assertEqual(size, len(get_all_config_facts()))
+        self.assertRaises(ConsolasException, ScopeSearch, self.Vm, 'more')
+
+        # an unsat problem stops at the limit
+        start_over()
+        Node = DefineClass('Node')
+        search = ScopeSearch(Node, 'n', start=1, limit=3)
+        self.assertRaises(ConsolasException, ScopeSearch, Node, 'm', start=3, limit=2)
+        solver = Solver()
+        solver.add(generate_meta_constraints())
+        solver.add(search.generate_config_constraints())
+        solver.add(BoolVal(False))
+        self.assertEqual((3, unsat), search.check(solver))
+
+    def test_enumerate_models(self):
+        vm1, vm2 = DefineObjects(['vm1', 'vm2'], self.Vm)
+        ubuntu1, ubuntu2 = DefineObjects(['ubuntu1', 'ubuntu2'], self.Ubuntu)
+        solver = Solver()
+        solver.add(generate_meta_constraints())
+        solver.add(generate_config_constraints())
+        size = len(solver.assertions())
+
+        # the memory and the types of the vms are free, but only the placements count
+        results = list(enumerate_models(solver, project=[self.DockerImage.deploy]))
+        self.assertEqual(set([('vm1', 'vm1'), ('vm1', 'vm2'), ('vm2', 'vm1'), ('vm2', 'vm2')]),
+                         set((r['ubuntu1']['deploy'], r['ubuntu2']['deploy']) for r in results))
+        self.assertEqual(size, len(solver.assertions()))
+        self.assertEqual(2, len(list(enumerate_models(solver, project=[vm1['host']], limit=2))))
+        self.assertEqual(3, len(list(enumerate_models(solver, project=[vm1['host'].count()]))))
+        # with a timeout, the solver is left as it was, without a timeout
+        self.assertEqual(4, len(list(enumerate_models(solver, project=[self.DockerImage.deploy], timeout=60))))
+        self.assertEqual(size, len(solver.assertions()))
+        self.assertEqual(4, len(list(enumerate_models(solver, project=[self.DockerImage.deploy]))))
+
+    def test_diverse_models(self):
+        vms = DefineObjects(['vm1', 'vm2', 'vm3'], self.Vm)
+        ubuntu1, ubuntu2 = DefineObjects(['ubuntu1', 'ubuntu2'], self.Ubuntu)
+        solver = Optimize()
+        solver.add(generate_meta_constraints())
+        solver.add(generate_config_constraints())
+        solver.add(ubuntu1['deploy'] != ubuntu2['deploy'])
+
+        # the second placement uses the vms and pairs that the first did not
+        first, second = diverse_models(solver, [self.DockerImage.deploy], 2)
+        self.assertEqual(2, len(first.new))
+        self.assertEqual(2, len(second.new))
+        self.assertNotEqual(first.result['ubuntu1']['deploy'], second.result['ubuntu1']['deploy'])
+        self.assertEqual(0, len(solver.objectives()))
+        self.assertEqual(6, len(diverse_models(solver, [self.DockerImage.deploy], 10, objective='hamming')))
+        # by default, until the six pairs are covered
+        self.assertEqual(6, len(set(n for s in diverse_models(solver, [self.DockerImage.deploy]) for n in s.new)))
+        # the first by a plain check
+        solutions = diverse_models(solver, [self.DockerImage.deploy], optimize_first=False)
+        self.assertEqual(6, len(set(n for s in solutions for n in s.new)))
+        self.assertRaises(ConsolasException, diverse_models, solver, [self.DockerImage.deploy], objective='hamming')
+
+        wanted = ObjectConsts(self.Vm, 'w1', 'w2', 'w3')
+        solver.add(And([w.alive() for w in wanted]))
+        solutions = diverse_models(solver, [[(v.name, w == v) for v in vms] for w in wanted], joint=True)
+        self.assertEqual(['vm1', 'vm2', 'vm3'], sorted(n for s in solutions for n in s.new))
+
+    def test_optimize_session(self):
+        vm1, = DefineObjects(['vm1'], self.Vm)
+        generate_meta_constraints()
+        generate_config_constraints()
+        session = OptimizeSession()
+        session.add(vm1['vmem'] >= 0)
+        session.add(vm1['vmem'] <= 10, scope='bounded')
+        session.maximize(vm1['vmem'], scope='bounded', name='vmem')
+        session.minimize(vm1['vmem'], scope='small', name='small')
+        session.add_soft(vm1['vmem'] == 5, scope='five')
+
+        self.assertEqual(sat, session.check('bounded'))
+        self.assertEqual({'vmem': 10}, session.values)
+        self.assertEqual(sat, session.check('small'))
+        self.assertEqual({'small': 0}, session.values)
+        self.assertEqual(sat, session.check('five'))
+        self.assertEqual(5, vm1.cast('vmem', session.model()))
+        self.assertEqual(0, len(session.solver.objectives()))
+        self.assertEqual(set(['vmem', 'small', 'soft five']), set(session.times))
+        # one check per objective, the first one has priority
+        self.assertEqual(sat, session.check('bounded', 'small'))
+        self.assertEqual({'vmem': 10, 'small': 10}, session.values)
+        self.assertEqual(sat, session.check('five', 'small'))
+        self.assertEqual({'soft five': 0, 'small': 5}, session.values)
+
+        session.retract('bounded')
+        self.assertRaises(ConsolasException, session.check, 'bounded')
+        session.add(vm1['vmem'] > 10)
+        self.assertEqual(sat, session.check('small'))
+        self.assertEqual({'small': 11}, session.values)
+
+    def test_model_decoder(self):
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu)
+        ubuntu2 = DefineObject('ubuntu2', self.Ubuntu)
+        vm1 = DefineObject('vm1', self.Vm)
+        ubuntu1.force_value('deploy', vm1)
+        ubuntu2.force_value('deploy', vm1)
+
+        solver = Solver()
+        solver.add(generate_meta_constraints())
+        solver.add(generate_config_constraints())
+        self.assertEqual(sat, solver.check())
+
+        decoder = ModelDecoder(solver.model())
+        self.assertEqual(vm1, decoder.object_of(solver.model().eval(ubuntu1['deploy'].z3())))
+        self.assertEqual('vm1', ubuntu1.cast('deploy', decoder))
+        self.assertEqual(['ubuntu1', 'ubuntu2'], sorted(vm1.cast('host', decoder)))
+        self.assertEqual(vm1.cast('host', decoder), vm1.cast('host', solver.model()))
+        self.assertEqual(['ubuntu1', 'ubuntu2'], sorted(cast_all_objects(decoder)['vm1']['host']))
+
+    def test_decoder_same_feature_names(self):
+        self.DockerImage.define_attribute('size', IntSort())
+        self.Vm.define_attribute('size', BoolSort())
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu)
+        vm1 = DefineObject('vm1', self.Vm)
+        ubuntu1.force_value('deploy', vm1)
+        ubuntu1.force_value('size', 7)
+        vm1.force_value('size', True)
+
+        solver = Solver()
+        solver.add(generate_meta_constraints())
+        solver.add(generate_config_constraints())
+        self.assertEqual(sat, solver.check())
+
+        decoder = ModelDecoder(solver.model())
+        self.assertEqual(7, ubuntu1.cast('size', decoder))
+        self.assertEqual(True, vm1.cast('size', decoder))
+
+    def test_model_type_index(self):
+        nimbus1 = DefineObject('nimbus1', self.Nimbus)
+        vm1 = DefineObject('vm1', self.Vm, suspended=True)
+        vm2 = DefineObject('vm2', self.Vm, suspended=True)
+
+        solver = Solver()
+        solver.add(generate_meta_constraints())
+        solver.add(generate_config_constraints())
+        solver.add(Not(vm2.alive()))
+        self.assertEqual(sat, solver.check())
+
+        decoder = ModelDecoder(solver.model())
+        self.assertEqual(self.Nimbus, decoder.type_of(nimbus1))
+        self.assertTrue(decoder.type_of(vm1) in [self.SmallVm, self.LargeVm])
+        self.assertEqual([nimbus1, vm1], sorted(decoder.alive_objects(), key=str))
+        self.assertEqual([nimbus1], decoder.objects_by_type()['Nimbus'])
+        self.assertEqual([vm1], decoder.instances_of(self.Vm))
+        self.assertEqual([nimbus1], decoder.instances_of(self.DockerImage))
+
+    def test_type_tables(self):
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu)
+        vm1 = DefineObject('vm1', self.Vm)
+        generate_meta_constraints()
+        generate_config_constraints()
+        facts = get_all_meta_facts() + get_all_config_facts()
+        self.assertFalse([f for f in facts if 'is_subtype' in str(f) and is_quantifier(f)])
+        self.assertFalse([f for f in facts if 'is_instance(i1, t1)' in str(f)])
+
+        solver = Solver()
+        solver.add(*facts)
+        self.assertEqual(unsat, solver.check(Not(is_subtype(self.Nimbus.z3(), self.DockerImage.z3()))))
+        self.assertEqual(unsat, solver.check(is_subtype(self.Vm.z3(), self.LargeVm.z3())))
+        self.assertEqual(unsat, solver.check(Not(ubuntu1.isinstance(self.DockerImage))))
+        self.assertEqual(unsat, solver.check(ubuntu1.isinstance(self.Vm)))
+        self.assertEqual(unsat, solver.check(vm1.isinstance(self.SmallVm), vm1.isinstance(self.LargeVm)))
+        self.assertEqual(sat, solver.check(ubuntu1.isinstance(self.Nimbus)))
+        self.assertEqual(self.Nimbus, ModelDecoder(solver.model()).type_of(ubuntu1))
+        self.assertEqual(sat, solver.check(Not(ubuntu1.isinstance(self.Nimbus))))
+        self.assertEqual(self.Ubuntu, ModelDecoder(solver.model()).type_of(ubuntu1))
+
+    def test_decode_model(self):
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu)
+        vm1 = DefineObject('vm1', self.Vm, suspended=True)
+        vm2 = DefineObject('vm2', self.Vm, suspended=True)
+        ubuntu1.force_value('mem', 10)
+
+        solver = Solver()
+        solver.add(generate_meta_constraints())
+        solver.add(generate_config_constraints())
+        solver.add(ubuntu1['deploy'] == vm1.get_constant(), Not(vm2.alive()))
+        self.assertEqual(sat, solver.check())
+
+        result = decode_model(solver.model(), features=['deploy', 'host'])
+        self.assertEqual(['ubuntu1', 'vm1'], sorted(result))
+        self.assertFalse('vm2' in result)
+        self.assertTrue('deploy' in result['ubuntu1'])
+        self.assertFalse('mem' in result['ubuntu1'])
+        self.assertEqual('vm1', result['ubuntu1']['deploy'])
+        self.assertEqual('vm1', result.resolve(ubuntu1['deploy'])['name'])
+        self.assertEqual(['ubuntu1'], result['vm1']['host'])
+
+        projected = decode_model(solver.model(), objects=[ubuntu1])
+        self.assertEqual(['ubuntu1'], [name for name, obj in projected.iteritems()])
+        self.assertEqual(cast_all_objects(solver.model())['ubuntu1'], projected['ubuntu1'].to_dict())
+
+    def test_workspaces(self):
+        import threading
+
+        def build_and_solve(nvms, results):
+            ws = Workspace()
+            Vm, App = ws.load_all_classes([
+                {'name': 'Vm', 'attribute': [{'name': 'mem', 'type': 'Integer'}],
+                 'reference': [{'name': 'host', 'type': 'App', 'multiple': True, 'opposite': 'deploy'}]},
+                {'name': 'App', 'reference': [{'name': 'deploy', 'type': 'Vm', 'mandatory': True}]}
+            ])
+            vms = ws.DefineObjects(['vm%d' % i for i in range(nvms)], Vm, suspended=True)
+            ws.DefineObjects(['app1', 'app2', 'app3'], App)
+            ws.generate_meta_constraints()
+            ws.generate_config_constraints()
+            v1 = ws.ObjectVar(Vm, 'v1')
+            solver = Solver(ctx=ws.ctx)
+            solver.add(*ws.once_for_all())
+            solver.add(Vm.forall(v1, v1['host'].count() <= 1))
+            if solver.check() == sat:
+                results[nvms] = sorted(ws.decode_model(solver.model(), features=['deploy']).keys())
+            else:
+                results[nvms] = None
+
+        results = {}
+        threads = [threading.Thread(target=build_and_solve, args=(n, results)) for n in (2, 3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(None, results[2])
+        self.assertEqual(['app1', 'app2', 'app3', 'vm0', 'vm1', 'vm2'], results[3])
+        # the default workspace is left untouched
+        self.assertEqual([], get_all_objects())
+        self.assertFalse('App' in get_default_workspace().classes)
+
+    def test_enum_encoding(self):
+        ws = Workspace(encoding='enum')
+        Vm, LargeVm, App = ws.load_all_classes([
+            {'name': 'Vm', 'attribute': [{'name': 'mem', 'type': 'Integer'}],
+             'reference': [{'name': 'host', 'type': 'App', 'multiple': True, 'opposite': 'deploy'}]},
+            {'name': 'LargeVm', 'supertype': 'Vm'},
+            {'name': 'App', 'reference': [{'name': 'deploy', 'type': 'Vm', 'mandatory': True}]}
+        ])
+        ws.generate_meta_constraints()
+        vm1, vm2 = ws.DefineObjects(['vm1', 'vm2'], Vm, suspended=True)
+        app1 = ws.DefineObject('app1', App)
+        app1.force_value('deploy', vm2)
+        ws.generate_config_constraints()
+
+        facts = ws.once_for_all()
+        self.assertEqual('InstEnum', str(facts[-1].arg(0).sort()))
+        solver = Solver(ctx=ws.ctx)
+        solver.add(*facts)
+        solver.add(*ws.encode(Not(vm1.alive()), vm2.isinstance(LargeVm), vm2['mem'] == 4))
+        self.assertEqual(sat, solver.check())
+        result = ws.decode_model(solver.model())
+        self.assertEqual(['app1', 'vm2'], sorted(result))
+        self.assertEqual('LargeVm', result['vm2']['type'])
+        self.assertEqual(4, result['vm2']['mem'])
+        self.assertEqual(['app1'], result['vm2']['host'])
+
+        solver = Solver(ctx=ws.ctx)
+        solver.add(*ws.ground_facts(*(ws.meta_constraints + ws.config_constraints + [vm2['mem'] == 4])))
+        self.assertEqual(sat, solver.check())
+        self.assertEqual(4, ws.decode_model(solver.model())['vm2']['mem'])
+
+    def test_enum_encoding_api(self):
+        ws = Workspace(encoding='enum')
+        Vm, App = ws.load_all_classes([
+            {'name': 'Vm', 'attribute': [{'name': 'mem', 'type': 'Integer'}],
+             'reference': [{'name': 'host', 'type': 'App', 'multiple': True, 'opposite': 'deploy'}]},
+            {'name': 'App', 'reference': [{'name': 'deploy', 'type': 'Vm', 'mandatory': True}]}
+        ])
+        ws.generate_meta_constraints()
+        vm1, vm2 = ws.DefineObjects(['vm1', 'vm2'], Vm)
+        app1 = ws.DefineObject('app1', App)
+        vm1.force_value('mem', 3)
+        hosts = vm2['host']  # built before the enumeration sorts
+        ws.generate_config_constraints()
+
+        # the constraints built through the API are already encoded, without encode()
+        self.assertEqual('InstEnum', str(vm1.z3().sort()))
+        self.assertEqual('InstEnum', str(ws.nil.sort()))
+        solver = Solver(ctx=ws.ctx)
+        solver.add(*ws.once_for_all())
+        self.assertEqual(unsat, solver.check(vm1['mem'] == 4))
+        self.assertEqual(unsat, solver.check(ObjectConst(Vm, 'vm1')['mem'] == 4))
+        self.assertEqual(sat, solver.check(hosts.contains(app1)))
+        self.assertEqual(unsat, solver.check(hosts.count() == 1, app1['deploy'] == vm1))
+        v = ws.ObjectVar(Vm, 'v')
+        self.assertEqual(unsat, solver.check(Vm.forall(v, v['mem'] > 3)))
+
+        ws.start_over()
+        self.assertEqual('Inst', str(ws.nil.sort()))
+
+    def test_bitvector_reference(self):
+        ws = Workspace()
+        Feature, Image = ws.load_all_classes([
+            {'name': 'Feature'},
+            {'name': 'Image', 'reference': [
+                {'name': 'features', 'type': 'Feature', 'multiple': True, 'bitvector': True},
+                {'name': 'adds', 'type': 'Feature', 'multiple': True, 'bitvector': True},
+                {'name': 'base', 'type': 'Image'}]}
+        ])
+        ws.generate_meta_constraints()
+        java, tomcat, xwiki = ws.DefineObjects(['java', 'tomcat', 'xwiki'], Feature)
+        base, image = ws.DefineObjects(['base', 'image'], Image)
+        base.force_value('features', [java])
+        image.force_value('base', base)
+        image.force_value('adds', [tomcat, xwiki])
+        ws.generate_config_constraints()
+
+        i1 = ws.ObjectVar(Image, 'i1')
+        f1 = ws.ObjectVar(Feature, 'f1')
+        self.assertEqual([java, tomcat, xwiki], ws.set_members(Feature))
+        self.assertTrue(is_bv(image['features'].bits))
+        solver = Solver(ctx=ws.ctx)
+        solver.add(*ws.once_for_all())
+        solver.add(image['features'].isunion(image['base']['features'], image['adds']))
+        solver.add(image['features'].issuperset(image['adds']))
+        solver.add(Image.forall(i1, i1['features'].count() <= 3))
+        self.assertEqual(sat, solver.check())
+        self.assertEqual(['java', 'tomcat', 'xwiki'], sorted(ws.decode_model(solver.model())['image']['features']))
+        self.assertEqual(unsat, solver.check(image['features'].issubset(base['features'])))
+        self.assertEqual(unsat, solver.check(image['features'].exists(f1, f1 == java) == False))
+        self.assertRaises(ConsolasException, ws.DefineObject, 'jetty', Feature)
+
+    def test_count_cardinality(self):
+        ubuntus = DefineObjects(['ubuntu1', 'ubuntu2', 'ubuntu3'], self.Ubuntu)
+        vm1, vm2 = DefineObjects(['vm1', 'vm2'], self.Vm, suspended=True)
+        generate_meta_constraints()
+        generate_config_constraints()
+        y = ObjectVar(self.Vm, 'y')
+        x = ObjectVar(self.DockerImage, 'x')
+
+        kind = lambda e: e.decl().kind()
+        self.assertEqual(Z3_OP_PB_AT_MOST, kind(vm1['host'].count() <= 2))
+        self.assertEqual(Z3_OP_PB_AT_LEAST, kind(2 < vm1['host'].count()))
+        self.assertEqual(Z3_OP_PB_EQ, kind(self.DockerImage.existsOne(x, x['deploy'] == vm1)))
+        self.assertEqual(Z3_OP_LE, kind(vm1['host'].count() <= vm1['vmem']))
+
+        solver = Solver()
+        solver.add(*get_all_meta_facts() + get_all_config_facts())
+        solver.add(self.Vm.forall(y, y['host'].count() <= 2))
+        self.assertEqual(sat, solver.check())
+        self.assertEqual(unsat, solver.check(Not(vm1.alive())))
+        self.assertEqual(sat, solver.check(self.DockerImage.existsOne(x, x['deploy'] == vm1)))
+        self.assertEqual(unsat, solver.check(self.DockerImage.existsOne(x, x['deploy'] == vm1),
+                                             Not(vm2.alive())))
+        self.assertEqual(sat, solver.check(vm1['host'].count() - vm2['host'].count() == 1))
+
+    def test_exists_one_candidates(self):
+        small1 = DefineObject('small1', self.SmallVm)
+        large1 = DefineObject('large1', self.LargeVm)
+        small1.force_value('price', 3)
+        large1.force_value('price', 5)
+        generate_meta_constraints()
+        generate_config_constraints()
+        x = ObjectVar(self.SmallVm, 'x')  # a variable of another type than the set
+
+        solver = Solver()
+        solver.add(*get_all_meta_facts() + get_all_config_facts())
+        self.assertEqual(sat, solver.check(self.Vm.existsOne(x, x['price'] == 5)))
+        self.assertEqual(unsat, solver.check(self.Vm.existsOne(x, x['price'] == 4)))
+
+    def test_instances_by_decl(self):
+        ws = get_default_workspace()
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu)
+        di1 = DefineObject('di1', self.DockerImage, suspended=True)
+        names = lambda objects: sorted(o.name for o in objects)
+        self.assertEqual(['ubuntu1'], names(ws.instances_by_decl(self.Ubuntu)))
+        self.assertEqual(['di1', 'ubuntu1'], names(ws.may_be_instances(self.Ubuntu)))
+        DefineObject('nimbus1', self.Nimbus)
+        self.assertEqual(['nimbus1', 'ubuntu1'], names(ws.instances_by_decl(self.Ubuntu)))
+        self.assertEqual([], ws.instances_by_decl(self.Vm))
+
+        y = ObjectVar(self.Vm, 'y')
+        vm1 = DefineObject('vm1', self.Vm, suspended=True)
+        generate_config_constraints()
+        self.assertEqual(3, len(vm1['host'].count().literals))
+        self.assertEqual(Z3_OP_ITE, self.Vm.all_instances().map(y, y['vmem']).sum().decl().kind())
+
+    def test_feature_table(self):
+        self.assertIs(self.DockerImage.attributes['mem'], self.Nimbus.get_feature('mem'))
+        self.assertIsNone(self.Nimbus.get_feature('tag'))
+        self.DockerImage.define_attribute('tag', IntSort())
+        self.assertIs(self.DockerImage.attributes['tag'], self.Nimbus.get_feature('tag'))
+        self.assertIn('tag', self.Ubuntu.get_all_feature_names())
+        self.Ubuntu.define_attribute('mem', BoolSort())
+        self.assertEqual(BoolSort(), self.Nimbus.get_feature('mem').type)
+        self.assertEqual(IntSort(), self.DockerImage.get_feature('mem').type)
+
+    def test_load_checks_first(self):
+        ws = Workspace()
+        descs = [{'Color': ['red', 'blue']},
+                 {'name': 'Image', 'attribute': [{'name': 'color', 'type': 'Color'}]},
+                 {'name': 'Vm', 'reference': [{'name': 'host', 'type': 'Host'}]}]
+        self.assertRaises(ConsolasException, ws.load_all_classes, descs)
+        self.assertEqual({}, ws.classes)
+        self.assertEqual({}, ws.enums)
+
+        descs[2]['reference'][0]['type'] = 'Image'
+        Color, Image, Vm = ws.load_all_classes(descs)
+        self.assertIs(Image, Vm.get_feature('host').type)
+        self.assertEqual(Color, Image.get_feature('color').type)
+        self.assertEqual(Color, ws.get_enum('Color')[0])
+        self.assertRaises(ConsolasException, ws.DefineClass, 'Color')
+
+    def test_constraint_cache(self):
+        def build(ws, forced):
+            Image = ws.DefineClass('Image')
+            Vm = ws.DefineClass('Vm')
+            Image.define_reference('deploy', Vm, mandatory=True)
+            Vm.define_reference('host', Image, multiple=True, opposite='deploy')
+            ws.generate_meta_constraints()
+            ws.DefineObjects(['i1', 'i2'], Image)
+            vm1, vm2 = ws.DefineObjects(['vm1', 'vm2'], Vm, suspended=True)
+            vm1.force_value('host', forced)
+            return ws.fingerprint('source of the constraints')
+
+        directory = tempfile.mkdtemp()
+        try:
+            ws = Workspace()
+            key = build(ws, [])
+            cache = ConstraintCache(directory, ws)
+            self.assertFalse(cache.load(key))
+            ws.generate_config_constraints()
+            x = ws.ObjectVar(ws.classes['Vm'], 'x')
+            ws.meta_facts(ws.classes['Vm'].forall(x, x['host'].count() <= 1))
+            cache.save(key)
+
+            ws2 = Workspace()
+            self.assertEqual(key, build(ws2, []))
+            self.assertNotEqual(key, build(Workspace(), [ws2.objects['i1']]))
+            self.assertTrue(ConstraintCache(directory, ws2).load(key))
+            self.assertEqual(len(ws.meta_constraints), len(ws2.meta_constraints))
+            solver = Solver(ctx=ws2.ctx)
+            solver.add(*ws2.once_for_all())
+            self.assertEqual(unsat, solver.check())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_result_cache(self):
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu)
+        vm1 = DefineObject('vm1', self.Vm, suspended=True)
+        generate_meta_constraints()
+        generate_config_constraints()
+        p = Bool('p')
+        facts = get_all_meta_facts() + get_all_config_facts() + [Implies(p, Not(vm1.alive()))]
+
+        directory = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(directory, capacity=1)
+            solver = Solver()
+            solver.add(*facts)
+            result = cache.check(solver)
+            self.assertEqual('sat', result.status)
+            self.assertEqual(['ubuntu1'], result.objects['vm1']['host'])
+
+            reordered = Solver()
+            reordered.add(*reversed(facts))
+            self.assertEqual(result, cache.check(reordered))
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+            self.assertEqual(SolveResult('unsat', core=['p']), cache.check(solver, p))
+            self.assertEqual(1, len(cache._entries))
+            self.assertEqual(1, len(os.listdir(directory)))
+
+            fresh = ResultCache(directory)
+            self.assertEqual(SolveResult('unsat', core=['p']), fresh.check(solver, p))
+            self.assertEqual(str, type(fresh.check(solver, p).core[0]))
+            self.assertEqual((2, 0), (fresh.hits, fresh.misses))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stream_to(self):
+        for encoding in Workspace.ENCODINGS:
+            ws = Workspace(encoding=encoding)
+            solver = Solver(ctx=ws.ctx)
+            text = StringIO.StringIO()
+            writer = SmtLibWriter(text, ws.ctx)
+            ws.stream_to(_Tee([solver, writer]))
+            Image = ws.DefineClass('Image')
+            Vm = ws.DefineClass('Vm')
+            Vm.define_reference('host', Image, multiple=True)
+            ws.generate_meta_constraints()
+            ws.DefineObjects(['i1', 'i2'], Image)
+            vm1, = ws.DefineObjects(['vm1'], Vm)
+            ws.generate_config_constraints()
+            x = ws.ObjectVar(Vm, 'x')
+            ws.meta_facts(Vm.forall(x, x['host'].count() == 2))
+            self.assertEqual([], ws.meta_constraints + ws.config_constraints)
+
+            self.assertEqual(sat, solver.check())
+            self.assertEqual(['i1', 'i2'], sorted(ws.decode_model(solver.model())['vm1']['host']))
+            parsed = Solver(ctx=ws.ctx)
+            parsed.add(parse_smt2_string(text.getvalue(), ctx=ws.ctx))
+            self.assertEqual(unsat, parsed.check(Not(ws.encode(vm1['host'].contains(ws.objects['i1']))[0])))
+
+    def test_smtlib_backend(self):
+        self.Vm.define_attribute('public', BoolSort())
+        self.DockerImage.define_reference('tags', self.Vm, multiple=True, bitvector=True)
+        ubuntu1 = DefineObject('ubuntu1', self.Ubuntu).force_value('mem', -2)
+        nimbus1 = DefineObject('nimbus1', self.Nimbus)
+        vm1 = DefineObject('vm1', self.LargeVm).force_value('host', [ubuntu1, nimbus1]).force_value('public', True)
+        vm2 = DefineObject('vm 2', self.SmallVm, suspended=True).force_value('host', nimbus1)
+        nimbus1.force_value('deploy', vm1).force_value('tags', [vm1])
+
+        ws = get_default_workspace()
+        built = list(generate_config_constraints())
+        parsed = list(generate_config_constraints(backend='smtlib'))
+        self.assertEqual(len(built), len(parsed))
+        solver = Solver()
+        solver.add(Not(And(built) == And(parsed)))
+        self.assertEqual(unsat, solver.check())
+        replay = Solver(ctx=Context())
+        replay.from_string(ws.config_smtlib(declare=True))
+        self.assertEqual(sat, replay.check())
+
+        # features of the same name on different classes are told apart by their class
+        self.Vm.define_attribute('size', IntSort())
+        self.DockerImage.define_attribute('size', BoolSort())
+        vm1.force_value('size', 3)
+        ubuntu1.force_value('size', True)
+        built = list(generate_config_constraints())
+        parsed = list(generate_config_constraints(backend='smtlib'))
+        solver = Solver()
+        solver.add(Not(And(built) == And(parsed)))
+        self.assertEqual(unsat, solver.check())
+        self.assertRaises(ConsolasException, ws.config_smtlib, True)
+
+    def test_navigation_memo(self):
+        x = ObjectVar(self.DockerImage, 'x')
+        y = ObjectVar(self.DockerImage, 'y')
+        hosts = x['deploy']['host']
+        nvars = len(get_default_workspace().vars)
+        self.assertIs(hosts, x['deploy']['host'])
+        self.assertIs(hosts, ObjectConst(self.DockerImage, 'x')['deploy']['host'])
+        self.assertIsNot(hosts, y['deploy']['host'])
+        self.assertEqual(nvars, len(get_default_workspace().vars))
+
+        self.assertIs(hosts.contains(y), hosts.contains(y))
+        self._assert_expr_in_string(hosts.contains(x), 'host(deploy(x), x)')
+        self._assert_expr_in_string(hosts.contains(y), 'host(deploy(x), y)')
+
+        # the memos do not grow from one generation to the next, and stay within their bounds
+        DefineObjects(['vm1', 'vm2'], self.Vm)
+        DefineObjects(['ubuntu1', 'ubuntu2'], self.Ubuntu)
+        sizes = []
+        for i in range(3):
+            generate_meta_constraints()
+            generate_config_constraints()
+            self.DockerImage.forall(x, x['deploy']['host'].contains(x))
+            sizes.append((len(get_default_workspace()._navigations), len(hosts.guard._completed)))
+        self.assertEqual([sizes[0]] * 3, sizes)
+        get_default_workspace()._navigations.capacity = 2
+        ObjectVar(self.DockerImage, 'z')['deploy']['host']
+        self.assertEqual(2, len(get_default_workspace()._navigations))
+        get_default_workspace()._navigations.capacity = model._NAVIGATION_MEMO_SIZE
+
+    def test_var_scope(self):
+        ws = get_default_workspace()
+        d1, d2 = DefineObjects(['d1', 'd2'], self.DockerImage)
+        x = ObjectVar(self.DockerImage, 'x')
+        self.assertEqual(['x'], ws.vars.keys())
+
+        with var_scope():
+            v1 = ObjectVar(self.Vm)
+            with var_scope():
+                v2 = ObjectVar(self.Vm)
+            self.assertIsNot(v1, v2)
+            self.assertIs(v2, ObjectVar(self.Vm))
+        self.assertIs(v1, ObjectVar(self.Vm))
+
+        # the temporaries of every constraint are given back, so the pool stays the same
+        forced = self.Vm.forcevalue('host', [d1, d2])
+        self.DockerImage.all_instances().existsOne(x, x['deploy']['host'].issubset(x['deploy']['host']))
+        size = sum(len(pool) for pool in ws._temporaries.values())
+        for i in range(10):
+            self.assertTrue(self.Vm.forcevalue('host', [d1, d2]).eq(forced))
+            self.DockerImage.all_instances().existsOne(x, x['deploy']['host'].issubset(x['deploy']['host']))
+        self.assertEqual(size, sum(len(pool) for pool in ws._temporaries.values()))
+        self.assertEqual(['x'], ws.vars.keys())
+
+    def test_closure(self):
+        start_over()
+        Node, = load_all_classes([{'name': 'Node', 'reference': [
+            {'name': 'parent', 'type': 'Node'},
+            {'name': 'allsup', 'type': 'Node', 'multiple': True, 'closure': 'parent'},
+            {'name': 'root', 'type': 'Node', 'root': 'parent'}]}])
+        a, b, c, d = DefineObjects(['a', 'b', 'c', 'd'], Node)
+        a.force_value('parent', b)
+        b.force_value('parent', c)
+        c.force_value('parent', None)
+        d.force_value('parent', None)
+        self.assertEqual({'a': set('abc'), 'b': set('abc'), 'c': set('abc'), 'd': set('abce'), 'e': set()},
+                         model._transitive_closure('edcba', {'a': 'b', 'b': 'c', 'c': 'a', 'd': 'ae', 'e': ''}.get))
+
+        for fixed in [True, False]:
+            if not fixed:
+                for o in [a, b, c]:
+                    del o.forced_values['parent']
+            solver = Solver()
+            solver.add(generate_meta_constraints())
+            solver.add(generate_config_constraints())
+            solver.add(a['parent'] == b, b['parent'] == c, c['parent'].undefined())
+            self.assertEqual(fixed, not any('allsup_rank' in str(f) for f in get_all_config_facts()))
+            self.assertEqual(sat, solver.check())
+            result = cast_all_objects(solver.model())
+            self.assertEqual(['b', 'c'], sorted(result['a']['allsup']))
+            self.assertEqual([], result['c']['allsup'])
+            self.assertEqual(['c', 'c', 'c', 'd'], [result[o]['root'] for o in 'abcd'])
+            self.assertEqual(unsat, solver.check(a['allsup'].contains(a)))
 
     def test_supertypes(self):
         # self.assertEqual(True, get_ancestors(self.Nimbus))
@@ -15,7 +15,7 @@ classes_yaml = """
 -
   name: Image
   abstract: True
-  reference: [{name: features, type: Feature, multiple: true}]
+  reference: [{name: features, type: Feature, multiple: true, bitvector: true}]
 - 
   name: BuildImage
   supertype: Image
@@ -29,15 +29,15 @@ classes_yaml = """
 -
   name: BuildRule
   reference: [
-    {name: requires, type: Feature, multiple: true},
-    {name: adds, type: Feature, multiple: true}
+    {name: requires, type: Feature, multiple: true, bitvector: true},
+    {name: adds, type: Feature, multiple: true, bitvector: true}
   ]
 -
   name: Feature
   reference: [
     {name: sup, type: Feature},
-    {name: allsup, type: Feature, multiple: true},
-    {name: root, type: Feature}
+    {name: allsup, type: Feature, multiple: true, bitvector: true, closure: sup},
+    {name: root, type: Feature, root: sup}
   ]
 """
 
@@ -45,48 +45,18 @@ features = dict()
 dimages = dict()
 rules = dict()
 
-def prepare_all_sup():
-    features = [fea for fea in get_all_objects() if fea.type.name == 'Feature']
-    for fea in features:
-        sup = fea.forced_values.get('sup', None)
-        if sup is None:
-            fea.forced_values['allsup'] = []
-        else:
-            fea.forced_values['allsup'] = [sup]
-    # print features
-    for f1 in features:
-        for f2 in features:
-            for f3 in features:
-                if (f2 in f1.forced_values['allsup']) and (f3 in f2.forced_values['allsup']):
-                    f1.forced_values['allsup'].append(f3)
-    #======== See later if we need a root reference or not=========#
-    for fea in features:
-        roots = [f for f in fea.forced_values['allsup'] if not ('sup' in f.forced_values) ]
-        if roots:
-            fea.forced_values['root'] = roots[0]
-        else:
-            fea.forced_values['root'] = fea
-
-    # for fea in features:
-    #     print '%s: (%s)' % (fea.name, fea.forced_values['root'])
-
 def afeature(name, sup=None):
     fea = DefineObject(name, Feature)
-    if not sup is None:
-        fea.force_value('sup', sup)
+    fea.force_value('sup', sup)  # None too: a top feature has no sup, and the closures are computed
     features[name] = fea
     return fea
 
 def supersetf(set1, set2):
-    return set2.forall(f1, set1.contains(f1))
+    return set1.issuperset(set2)
 def subsetf(set1, set2):
-    return set1.forall(f1, set2.contains(f1))
+    return set1.issubset(set2)
 def isunionf(res, set1, set2):
-    return And(
-        res.forall(f1, Or(set1.contains(f1), set2.contains(f1))),
-        set1.forall(f1, res.contains(f1)),
-        set2.forall(f1, res.contains(f1))
-    )
+    return res.isunion(set1, set2)
 
 def require_feature(w, f):
     return w.features.exists(f1, Or(f1 == f, f1.allsup.contains(f)))
@@ -110,17 +80,10 @@ buildchains = []
 image_spec = None
 resultbuildimages = []
 
-def get_wanted(model):
-    result = cast_all_objects(model)
-    for i in get_all_objects():
-        if str(model.eval(wanted == i)) == 'True':
-            return result[str(i)]
-
 ampimages = dict()
 
-def print_model_deploy(model):
-    result = cast_all_objects(model)
-    v = get_wanted(model)
+def print_model_deploy(result):
+    v = result.resolve(wanted)
     toprint = '\# %s: ' % v['features']
 
     chain = []
@@ -166,14 +129,6 @@ def print_model_deploy(model):
 
 covered = []
 
-def find_covered_features(model):
-    v = get_wanted(model)
-    for f in v['features']:
-        for i in get_all_objects():
-            if i.name == f and not (i in covered):
-                covered.append(i)
-    print 'features covered: %s' % covered
-
 
 def declare_feature(spec, parent):
     if type(spec) is list:
@@ -187,14 +142,12 @@ def declare_feature(spec, parent):
 def resolve_features(featurenames):
     return [features[n] for n in featurenames]
 
-def generate(workingdir):
+def generate(workingdir, cachedir=None, ground=False, count=4):
     global image_spec
 
     with open(workingdir+'/features.yml', 'r') as stream:
         feature_spec = yaml.load(stream)
     declare_feature(feature_spec, None)
-    # print features
-    prepare_all_sup()
 
     print "Start search for images"
 
@@ -212,50 +165,61 @@ def generate(workingdir):
         img.force_value('adds', resolve_features(value['adds']))
 
 
-    images = [DefineObject('image%d'%i, BuildImage, suspended=True) for i in range(0, NSPAR)]
+    images = DefineObjects(['image%d'%i for i in range(0, NSPAR)], BuildImage, suspended=True, symmetric=True)
 
     # wanted = ObjectConst(Image, 'wanted')
 
-    generate_config_constraints()
-
     bi1 = ObjectVar(BuildImage, 'bi1')
     bi2 = ObjectVar(BuildImage, 'bi2')
-    meta_facts(
-        BuildImage.forall(bi1, And(
-            bi1.using.requires.forall(
-                f1, bi1['from'].features.exists(
-                    f2, Or(f2==f1, f2.allsup.contains(f1))
-                )
-            ),
-            isunionf(bi1.features, bi1['from'].features, bi1.using.adds)
-        )),
-        BuildImage.forall(bi1, Not(bi1['from'] == bi1)),
-        BuildImage.forall(bi1, bi1.features.exists(f1, Not(bi1['from'].features.contains(f1)))),
-        # Image.forall(e1, (e1.features * e1.features).forall(
-        #     [f1, f2], Or(f1==f2, Not(Feature.exists(f3, And(f1.allsup.contains(f3), f2.allsup.contains(f3)))))
-        # )),
-        Image.forall(e1, (e1.features * e1.features).forall(
-            [f1, f2], Or(f1 == f2, Not(f1.root == f2.root))
-        ))
-    )
-
-    solver = Optimize()
-    solver.add(*get_all_meta_facts())
-    solver.add(*get_all_config_facts())
 
-    solver.add(wanted.isinstance(Image))
-    solver.add(wanted.alive())
+    cache = ConstraintCache(cachedir) if cachedir else None
+    # the whole script and the model library are hashed, helpers such as afeature included
+    sources = [inspect.getsource(sys.modules[m]) for m in (__name__, Workspace.__module__)]
+    key = get_default_workspace().fingerprint(*sources) if cache else None
+    if cache and cache.load(key):
+        print "Constraints loaded from the cache"
+    else:
+        generate_config_constraints()
+        meta_facts(
+            BuildImage.forall(bi1, And(
+                bi1.using.requires.forall(
+                    f1, bi1['from'].features.exists(
+                        f2, Or(f2==f1, f2.allsup.contains(f1))
+                    )
+                ),
+                isunionf(bi1.features, bi1['from'].features, bi1.using.adds)
+            )),
+            BuildImage.forall(bi1, Not(bi1['from'] == bi1)),
+            BuildImage.forall(bi1, bi1.features.exists(f1, Not(bi1['from'].features.contains(f1)))),
+            # Image.forall(e1, (e1.features * e1.features).forall(
+            #     [f1, f2], Or(f1==f2, Not(Feature.exists(f3, And(f1.allsup.contains(f3), f2.allsup.contains(f3)))))
+            # )),
+            Image.forall(e1, (e1.features * e1.features).forall(
+                [f1, f2], Or(f1 == f2, Not(f1.root == f2.root))
+            ))
+        )
+        if cache:
+            cache.save(key)
+
+    constraints = [wanted.isinstance(Image), wanted.alive(),
+                   require_feature_all(wanted, [features[x] for x in image_spec['mandatoryfeature']])]
+    constraints.extend([eval(cst) for cst in image_spec['constraints']])
 
-    solver.add(require_feature_all(wanted, [features[x] for x in image_spec['mandatoryfeature']]))
-
-    for cst in image_spec['constraints']:
-        solver.add(eval(cst))
-
-    for i in range(0, 4):
-        print 'Image number %d in %.2f seconds.>>' % (i, timeit.timeit(solver.check, number=1))
-        print_model_deploy(solver.model())
-        find_covered_features(solver.model())
-        solver.maximize(wanted.features.filter(f1, And([Not(f1 == fea) for fea in covered])).count())
+    solver = Optimize()
+    if ground:
+        # the forced features, rules and taxonomy are evaluated away, only the build slots are left open
+        solver.add(*ground_facts(*(get_all_meta_facts() + get_all_config_facts() + constraints), propagate=True))
+    else:
+        solver.add(*get_all_meta_facts())
+        solver.add(*get_all_config_facts())
+        solver.add(*constraints)
+
+    # each image maximizes the features that the previous ones did not cover
+    for i, solution in enumerate(diverse_models(solver, [wanted.features], count)):
+        print 'Image number %d in %.2f seconds.>>' % (i, solution.seconds)
+        print_model_deploy(solution.result)
+        covered.extend(solution.new)
+        print 'features covered: %s' % covered
         print ''
     with open(workingdir + '/out/genimages.yml', 'w') as stream:
         yaml.dump({'buildchains': buildchains}, stream)
@@ -265,11 +229,14 @@ def generate(workingdir):
         yaml.dump({'images': ampimages}, stream)
         stream.close()
 
-HELPTEXT = 'dockerbuild.py -d <working dir>'
+HELPTEXT = 'dockerbuild.py -d <working dir> [-c <constraint cache dir>] [-g] [-k <number of images>]'
 def main(argv):
     workingdir = ''
+    cachedir = None
+    ground = False
+    count = 4
     try:
-        opts, args = getopt.getopt(argv,"hd:",["dir="])
+        opts, args = getopt.getopt(argv,"hd:c:gk:",["dir=", "cache=", "ground", "count="])
     except getopt.GetoptError:
         print HELPTEXT
         sys.exit(2)
@@ -279,6 +246,12 @@ def main(argv):
             sys.exit()
         elif opt in ("-d", "--dir"):
             workingdir = arg
+        elif opt in ("-c", "--cache"):
+            cachedir = arg
+        elif opt in ("-g", "--ground"):
+            ground = True
+        elif opt in ("-k", "--count"):
+            count = int(arg)
 
     print 'Working directory is ', workingdir
 
@@ -286,7 +259,7 @@ def main(argv):
         print 'working directory required: ' + HELPTEXT
         exit()
 
-    generate(workingdir)
+    generate(workingdir, cachedir, ground, count)
 
 
 if __name__ == "__main__":
@@ -26,8 +26,8 @@ classes_yaml = """
   name: Feature
   reference: [
     {name: sup, type: Feature},
-    {name: allsup, type: Feature, multiple: true},
-    {name: root, type: Feature}
+    {name: allsup, type: Feature, multiple: true, closure: sup},
+    {name: root, type: Feature, root: sup}
   ]
 -
   name: Service
@@ -42,29 +42,6 @@ backupmeta = """attribute: [
     {name: mandatory, type: Boolean}
 ]"""
 
-def prepare_all_sup():
-    features = [fea for fea in get_all_objects() if fea.type.name == 'Feature']
-    for fea in features:
-        sup = fea.forced_values.get('sup', None)
-        if sup is None:
-            fea.forced_values['allsup'] = []
-        else:
-            fea.forced_values['allsup'] = [sup]
-    # print features
-    for f1 in features:
-        for f2 in features:
-            for f3 in features:
-                if (f2 in f1.forced_values['allsup']) and (f3 in f2.forced_values['allsup']):
-                    f1.forced_values['allsup'].append(f3)
-    #======== See later if we need a root reference or not=========#
-    for fea in features:
-        roots = [f for f in fea.forced_values['allsup'] if not ('sup' in f.forced_values) ]
-        if roots:
-            fea.forced_values['root'] = roots[0]
-        else:
-            fea.forced_values['root'] = fea
-
-
 specification = None
 images = dict()
 services = dict()
@@ -73,8 +50,7 @@ features = dict()
 def afeature(name, sup=None):
     fea = DefineObject(name, Feature)
     features[name] = fea
-    if not sup is None:
-        fea.force_value('sup', sup)
+    fea.force_value('sup', sup)  # None too: a top feature has no sup, and the closures are computed
     return fea
 
 classes = yaml.load(classes_yaml)
@@ -110,10 +86,7 @@ def print_result(model, index):
         if result[x]['type'] == 'Service' and result[x]['alive']:
             img = result[result[x]['image']]
             for fea in img['features']:
-                feaobj = get_object_by_name(fea)
-                current_features.append(str(feaobj))
-                if feaobj not in covered:
-                    covered.append(feaobj)
+                current_features.append(fea)
 
     resultsrvs = dict()
     composite = {'features': current_features, 'services': resultsrvs}
@@ -133,14 +106,12 @@ def print_result(model, index):
 
 
 
-def generate(workingdir):
+def generate(workingdir, cachedir=None):
     global specification
 
     with open(workingdir+'/features.yml', 'r') as stream:
         feature_spec = yaml.load(stream)
     declare_feature(feature_spec, None)
-    # print features
-    prepare_all_sup()
 
     with open(workingdir + '/composite.yml', 'r') as stream:
         specification = yaml.load(stream)
@@ -165,8 +136,6 @@ def generate(workingdir):
     print "Start searching for compositions"
     # wanted = ObjectConst(Image, 'wanted')
 
-    generate_config_constraints()
-
     def supersetf(set1, set2):
         return set2.forall(f1, set1.contains(f1))
     def subsetf(set1, set2):
@@ -181,16 +150,26 @@ def generate(workingdir):
     def eq_or_child(sub, sup):
         return Or(sub == sup, sub.allsup.contains(sup))
 
-    meta_facts(
-        Service.forall(s1, s1.image.dep.forall(
-            f1, s1.dependson.exists(s2, s2.image.features.exists(f2, eq_or_child(f2, f1))))),
-        Service.forall(s1, Or(Feature.exists(f1, s1.image.dep.contains(f1)), Service.forall(s2, Not(s1.dependson.contains(s2))))),
-        Service.forall(s1, Not(s1.dependson.contains(s1))),
-        Service.forall(s1, s1.imgfeature.forall(
-            f1, s1.image.features.exists(f2, eq_or_child(f2, f1))
-        ))
-        # Service.forall(s1, Or(s1.mandatory, s1.alive() == Service.exists(s2, s2.dependson.contains(s1))))
-    )
+    cache = ConstraintCache(cachedir) if cachedir else None
+    # the whole script and the model library are hashed, helpers such as afeature included
+    sources = [inspect.getsource(sys.modules[m]) for m in (__name__, Workspace.__module__)]
+    key = get_default_workspace().fingerprint(*sources) if cache else None
+    if cache and cache.load(key):
+        print "Constraints loaded from the cache"
+    else:
+        generate_config_constraints()
+        meta_facts(
+            Service.forall(s1, s1.image.dep.forall(
+                f1, s1.dependson.exists(s2, s2.image.features.exists(f2, eq_or_child(f2, f1))))),
+            Service.forall(s1, Or(Feature.exists(f1, s1.image.dep.contains(f1)), Service.forall(s2, Not(s1.dependson.contains(s2))))),
+            Service.forall(s1, Not(s1.dependson.contains(s1))),
+            Service.forall(s1, s1.imgfeature.forall(
+                f1, s1.image.features.exists(f2, eq_or_child(f2, f1))
+            ))
+            # Service.forall(s1, Or(s1.mandatory, s1.alive() == Service.exists(s2, s2.dependson.contains(s1))))
+        )
+        if cache:
+            cache.save(key)
 
     solver = Optimize()
     solver.add(*get_all_meta_facts())
@@ -200,19 +179,15 @@ def generate(workingdir):
     for cst in specification['constraints']:
         solver.add(eval(cst))
 
-    solver.push()
-    for i in range(0, 3):
-        print 'In %.2f seconds.>>' % timeit.timeit(solver.check, number=1)
-        print_result(solver.model(), i)
+    # each composition maximizes the features that the previous ones did not cover. The first one is
+    # any composition, and the atoms are over the declared services, without quantifier
+    used = [(name, Or([And(srv.alive(), srv['image']['features'].contains(fea)) for srv in services.values()]))
+            for name, fea in features.iteritems()]
+    for i, solution in enumerate(diverse_models(solver, used, 3, optimize_first=False)):
+        print 'In %.2f seconds.>>' % solution.seconds
+        print_result(solution.model, i)
+        covered.extend(solution.new)
         print covered
-        solver.pop()
-        solver.push()
-        solver.maximize(Feature.filter(
-            f1, And(
-                And([f1 != fea for fea in covered]),
-                Service.exists(s1, s1.image.features.contains(f1))
-            )).count()
-        )
 
     finalresult = {
         'watching': specification['services'].keys(),
@@ -225,11 +200,12 @@ def generate(workingdir):
 
 
 
-HELPTEXT = 'dockercompose.py -d <working dir>'
+HELPTEXT = 'dockercompose.py -d <working dir> [-c <constraint cache dir>]'
 def main(argv):
     workingdir = ''
+    cachedir = None
     try:
-        opts, args = getopt.getopt(argv,"hd:",["dir="])
+        opts, args = getopt.getopt(argv,"hd:c:",["dir=", "cache="])
     except getopt.GetoptError:
         print HELPTEXT
         sys.exit(2)
@@ -239,6 +215,8 @@ def main(argv):
             sys.exit()
         elif opt in ("-d", "--dir"):
             workingdir = arg
+        elif opt in ("-c", "--cache"):
+            cachedir = arg
 
     print 'Working directory is ', workingdir
 
@@ -246,7 +224,7 @@ def main(argv):
         print 'working directory required: ' + HELPTEXT
         exit()
 
-    generate(workingdir)
+    generate(workingdir, cachedir)
 
 
 if __name__ == "__main__":